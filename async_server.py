@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Asyncio Chat Relay Server
+Multi-client mode for the chat simulation. A single event loop accepts any
+number of TCP clients and fans every frame out to all other connected peers.
+Frames are relayed as-is, so encrypted messages stay end-to-end between
+clients that share the same password.
+"""
+
+import asyncio
+import json
+from colorama import Fore, Style
+from framing import HEADER, MAX_FRAME_SIZE, encode_frame
+from compression import DEFAULT_CODECS
+from protocol import (CONTROL, CONTROL_BYE, LEGACY_VERSION, MSG_CHAT, MSG_CONTROL, MSG_HELLO, PROTOCOL_VERSION, ProtocolError,
+                      pack_message, peer_version)
+
+# A peer whose unsent data grows past this is too slow to keep up and is dropped
+# rather than being allowed to hold frames for everyone else in memory
+DEFAULT_MAX_BUFFER = 1024 * 1024
+
+class Peer:
+    """One connected client and its outgoing buffer"""
+
+    def __init__(self, peer_id, reader, writer):
+        self.peer_id = peer_id
+        self.reader = reader
+        self.writer = writer
+        self.address = writer.get_extra_info('peername')
+        self.frames_in = 0
+        self.frames_out = 0
+        self.version = LEGACY_VERSION     # From the client's HELLO
+
+    def buffered(self):
+        """Bytes queued in the transport but not yet written to the socket"""
+        return self.writer.transport.get_write_buffer_size()
+
+class AsyncChatSimServer:
+    def __init__(self, host, port, max_buffer=DEFAULT_MAX_BUFFER, backlog=512, verbose=True, reuse_port=False):
+        self.host = host
+        self.port = port
+        self.max_buffer = max_buffer
+        self.backlog = backlog
+        self.verbose = verbose
+        self.reuse_port = reuse_port    # Share the port with other processes (see relay_workers.py)
+        self.peers = {}
+        self.next_peer_id = 1
+        self.frames_relayed = 0
+        self.bytes_relayed = 0
+        self.slow_disconnects = 0
+        self.server = None
+
+    async def start(self):
+        """Bind the listening socket. Returns the port actually bound"""
+        self.server = await asyncio.start_server(
+            self.handle_client, self.host, self.port,
+            reuse_address=True, reuse_port=self.reuse_port or None, backlog=self.backlog
+        )
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.port
+
+    async def serve(self):
+        """Accept clients until cancelled"""
+        await self.start()
+        if self.verbose:
+            print(f"{Fore.GREEN}Async relay listening on {self.host}:{self.port}...{Style.RESET_ALL}")
+            print(f"{Fore.MAGENTA}Messages from each client are relayed to all other clients.{Style.RESET_ALL}")
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def handle_client(self, reader, writer):
+        """Read frames from one client and relay them until it disconnects"""
+        peer = Peer(self.next_peer_id, reader, writer)
+        self.next_peer_id += 1
+        self.peers[peer.peer_id] = peer
+        if self.verbose:
+            print(f"{Fore.GREEN}✓ Client #{peer.peer_id} connected from {peer.address} "
+                  f"({len(self.peers)} online){Style.RESET_ALL}")
+
+        # Clients compress only with codecs we list; every client can decode all of them.
+        # No cipher: frames are relayed as-is, so clients check each other's passwords
+        hello = {'version': PROTOCOL_VERSION, 'max_frame': MAX_FRAME_SIZE, 'compression': list(DEFAULT_CODECS)}
+        writer.write(encode_frame(pack_message(MSG_HELLO, json.dumps(hello).encode('utf-8'))))
+
+        try:
+            while True:
+                header = await reader.readexactly(HEADER.size)
+                (length,) = HEADER.unpack(header)
+                if length > MAX_FRAME_SIZE:
+                    print(f"{Fore.RED}Client #{peer.peer_id} sent an oversized frame{Style.RESET_ALL}")
+                    break
+                payload = await reader.readexactly(length)
+                peer.frames_in += 1
+
+                kind = payload[0] if payload else None
+                if kind == MSG_HELLO:
+                    peer.version = self.client_version(payload)
+                    continue
+
+                # A BYE ends this client's session, not everyone else's. So does a
+                # plaintext quit from a client that predates BYE
+                if kind == MSG_CONTROL:
+                    if payload[1:2] == CONTROL.pack(CONTROL_BYE):
+                        break
+                    continue    # Control messages are about this link, not for the other clients
+                if (kind == MSG_CHAT and peer.version == LEGACY_VERSION and payload[1:2] == b'\x00'
+                        and payload[2:].strip().lower() in (b'quit', b'exit')):
+                    break
+
+                self.broadcast(peer, header + payload)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.peers.pop(peer.peer_id, None)
+            writer.close()
+            if self.verbose:
+                print(f"{Fore.YELLOW}Client #{peer.peer_id} disconnected "
+                      f"({len(self.peers)} online){Style.RESET_ALL}")
+
+    @staticmethod
+    def client_version(payload):
+        """Protocol version from a client's HELLO payload"""
+        try:
+            return peer_version(json.loads(payload[1:].decode('utf-8')))
+        except (ValueError, AttributeError, ProtocolError):
+            return LEGACY_VERSION
+
+    def broadcast(self, sender, frame):
+        """Queue a frame on every other peer without waiting for any of them"""
+        for peer in list(self.peers.values()):
+            if peer is sender:
+                continue
+            if peer.buffered() > self.max_buffer:
+                self.drop_slow_peer(peer)
+                continue
+            peer.writer.write(frame)
+            peer.frames_out += 1
+            self.frames_relayed += 1
+            self.bytes_relayed += len(frame)
+
+    def drop_slow_peer(self, peer):
+        """Disconnect a peer that is not reading fast enough"""
+        self.slow_disconnects += 1
+        self.peers.pop(peer.peer_id, None)
+        print(f"{Fore.RED}Client #{peer.peer_id} is not keeping up "
+              f"({peer.buffered()} bytes pending), disconnecting{Style.RESET_ALL}")
+        peer.writer.transport.abort()
+
+    def print_stats(self):
+        """Print relay totals"""
+        print(f"{Fore.CYAN}Relayed {self.frames_relayed} frames ({self.bytes_relayed} bytes), "
+              f"{self.slow_disconnects} slow client(s) dropped{Style.RESET_ALL}")
+
+    def run(self):
+        """Run the relay on a new event loop until interrupted"""
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            print(f"\n{Fore.YELLOW}Shutting down server...{Style.RESET_ALL}")
+        finally:
+            self.print_stats()
@@ -5,25 +5,35 @@ A terminal-based chat application that allows two devices to communicate via Blu
 This is the client component that connects to a server.
 """
 
-import bluetooth
-import threading
+import argparse
+import os
 import sys
 import time
 from colorama import init, Fore, Style
-from encryption import ChatEncryption, get_chat_password
+from encryption import ChatEncryption
+from headless import add_arguments as add_headless_arguments, chat_password, headless_config
+import profiling
+from reconnect import CONNECT_TIMEOUT
+from transport import RFCOMMTransport
+from device_cache import DeviceCache
+from service_probe import CHAT_SERVICE_UUID, PROBE_TIMEOUT, find_chat_service, probe_devices
 
-# Initialize colorama for Windows compatibility
-init()
+# PyBluez and the chat engine are imported where they are first used, so the
+# password prompt and a cached reconnect don't wait for them
 
 class BluetoothChatClient:
-    def __init__(self):
-        self.client_socket = None
-        self.running = False
+    def __init__(self, options=None, headless=None):
+        self.session = None
         self.username = "Client"
         self.encryption = None
+        self.encryption_configured = False
+        self.cache = DeviceCache()
+        self.options = options
+        self.headless = headless
         
     def discover_devices(self):
         """Discover nearby Bluetooth devices"""
+        import bluetooth
         print(f"{Fore.CYAN}Discovering nearby Bluetooth devices...{Style.RESET_ALL}")
         print(f"{Fore.YELLOW}This may take a few seconds...{Style.RESET_ALL}")
         
@@ -34,23 +44,37 @@ class BluetoothChatClient:
                 print(f"{Fore.RED}No Bluetooth devices found.{Style.RESET_ALL}")
                 return []
                 
-            print(f"{Fore.GREEN}Found {len(nearby_devices)} device(s):{Style.RESET_ALL}")
-            for i, (addr, name) in enumerate(nearby_devices):
-                print(f"{Fore.CYAN}  {i+1}. {name} ({addr}){Style.RESET_ALL}")
-                
+            print(f"{Fore.GREEN}Found {len(nearby_devices)} device(s).{Style.RESET_ALL}")
             return nearby_devices
             
         except bluetooth.BluetoothError as e:
             print(f"{Fore.RED}Error discovering devices: {e}{Style.RESET_ALL}")
             return []
             
+    def find_chat_servers(self, devices):
+        """Probe all devices at once and list the ones running the chat service"""
+        import bluetooth
+        print(f"{Fore.CYAN}Checking which devices run the chat service...{Style.RESET_ALL}")
+        started = time.monotonic()
+        results = probe_devices(devices, bluetooth)
+        servers = [result.match for result in results if result.match]
+        timed_out = sum(1 for result in results if result.timed_out)
+        
+        summary = f"{len(servers)} chat server(s) found in {time.monotonic() - started:.1f}s"
+        if timed_out:
+            summary += f" ({timed_out} device(s) did not answer)"
+        print(f"{Fore.GREEN if servers else Fore.RED}{summary}{Style.RESET_ALL}")
+        for i, server in enumerate(servers):
+            print(f"{Fore.CYAN}  {i+1}. {server.name} ({server.address}) channel {server.port}{Style.RESET_ALL}")
+        return servers
+            
     def find_chat_service(self, target_addr):
         """Find the chat service on the target device"""
+        import bluetooth
         print(f"{Fore.CYAN}Searching for chat service on {target_addr}...{Style.RESET_ALL}")
         
         try:
-            uuid = "94f39d29-7d6d-437d-973b-fba39e49d4ee"
-            service_matches = bluetooth.find_service(uuid=uuid, address=target_addr)
+            service_matches = find_chat_service(bluetooth, target_addr, CHAT_SERVICE_UUID, PROBE_TIMEOUT)
             
             if len(service_matches) == 0:
                 print(f"{Fore.RED}No chat service found on {target_addr}{Style.RESET_ALL}")
@@ -64,48 +88,63 @@ class BluetoothChatClient:
             print(f"{Fore.GREEN}Found service '{name}' on {host}:{port}{Style.RESET_ALL}")
             return port
             
-        except bluetooth.BluetoothError as e:
+        except (bluetooth.BluetoothError, TimeoutError) as e:
             print(f"{Fore.RED}Error finding service: {e}{Style.RESET_ALL}")
             return None
             
-    def connect_to_server(self, server_addr, port):
-        """Connect to the chat server"""
-        # Setup encryption
-        password = get_chat_password()
+    def setup_encryption(self):
+        """Ask for the chat password once per run"""
+        if self.encryption_configured:
+            return
+        password = self.headless.password if self.headless else chat_password(self.options)
         if password:
             self.encryption = ChatEncryption(password)
             print(f"{Fore.GREEN}🔒 Encryption enabled{Style.RESET_ALL}")
         else:
             print(f"{Fore.YELLOW}⚠️  No encryption - messages will be sent in plaintext{Style.RESET_ALL}")
+        self.encryption_configured = True
         
+    def open_transport(self, server_addr, port):
+        """Open an RFCOMM connection, or return None if it fails"""
+        import bluetooth
+        print(f"{Fore.CYAN}Connecting to {server_addr}:{port}...{Style.RESET_ALL}")
         try:
-            print(f"{Fore.CYAN}Connecting to {server_addr}:{port}...{Style.RESET_ALL}")
-            
-            # Create a Bluetooth socket using RFCOMM protocol
-            self.client_socket = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
-            self.client_socket.connect((server_addr, port))
+            return RFCOMMTransport.connect(server_addr, port)
+        except (bluetooth.BluetoothError, OSError) as e:
+            print(f"{Fore.RED}Connection failed: {e}{Style.RESET_ALL}")
+            return None
+        
+    def connect_to_server(self, server_addr, port):
+        """Connect to the chat server"""
+        self.setup_encryption()
+        transport = self.open_transport(server_addr, port)
+        if transport is not None:
+            self.run_chat(transport, server_addr, port)
+        
+    def run_chat(self, transport, server_addr, port):
+        """Chat over an open connection until either side quits"""
+        import bluetooth
+        from chat_engine import ChatSession
+        try:
+            # Reconnects go straight back to this address and channel: no inquiry,
+            # SDP lookup or password prompt
+            reconnect = lambda timeout: RFCOMMTransport.connect(server_addr, port, min(timeout, CONNECT_TIMEOUT))
+            if self.headless:
+                self.session = self.headless.make_session(transport, self.encryption, username=self.username,
+                                                          peer_name="Server", reconnect=reconnect)
+            else:
+                self.session = ChatSession(transport, self.encryption, username=self.username, peer_name="Server",
+                                           reconnect=reconnect)
+            self.session.start()
             
             print(f"{Fore.GREEN}✓ Connected to server!{Style.RESET_ALL}")
-            self.running = True
-            
-            # Start threads for sending and receiving messages
-            receive_thread = threading.Thread(target=self.receive_messages)
-            send_thread = threading.Thread(target=self.send_messages)
-            
-            receive_thread.daemon = True
-            send_thread.daemon = True
+            print(f"{Fore.CYAN}Compression: {self.session.codec.compressor.describe()}{Style.RESET_ALL}")
             
-            receive_thread.start()
-            send_thread.start()
-            
-            print(f"{Fore.GREEN}Chat started! Type your messages below.{Style.RESET_ALL}")
-            print(f"{Fore.YELLOW}Type 'quit' or 'exit' to close the connection.{Style.RESET_ALL}")
-            print("-" * 50)
-            
-            # Keep main thread alive
             try:
-                while self.running:
-                    threading.Event().wait(1)
+                if self.headless:
+                    self.headless.run(self.session)
+                else:
+                    self.session.run()
             except KeyboardInterrupt:
                 self.disconnect()
                 
@@ -115,135 +154,138 @@ class BluetoothChatClient:
             print(f"{Fore.RED}Error: {e}{Style.RESET_ALL}")
         finally:
             self.cleanup()
-            
-    def receive_messages(self):
-        """Receive messages from the server"""
-        while self.running:
-            try:
-                data = self.client_socket.recv(1024)
-                if not data:
-                    break
-                    
-                message = data.decode('utf-8').strip()
-                if message.lower() in ['quit', 'exit']:
-                    print(f"{Fore.RED}Server disconnected.{Style.RESET_ALL}")
-                    self.running = False
-                    break
-                
-                # Decrypt message if encryption is enabled
-                if self.encryption and self.encryption.is_encrypted():
-                    try:
-                        decrypted_message = self.encryption.decrypt_message(message)
-                        print(f"{Fore.BLUE}Server: {decrypted_message} {Fore.GREEN}🔒{Style.RESET_ALL}")
-                    except Exception as e:
-                        print(f"{Fore.RED}Failed to decrypt message from server{Style.RESET_ALL}")
-                        print(f"{Fore.BLUE}Server (encrypted): {message[:50]}...{Style.RESET_ALL}")
-                else:
-                    print(f"{Fore.BLUE}Server: {message}{Style.RESET_ALL}")
-                
-            except bluetooth.BluetoothError:
-                print(f"{Fore.RED}Connection lost.{Style.RESET_ALL}")
-                self.running = False
-                break
-            except Exception as e:
-                print(f"{Fore.RED}Error receiving message: {e}{Style.RESET_ALL}")
-                break
-                
-    def send_messages(self):
-        """Send messages to the server"""
-        while self.running:
-            try:
-                message = input()
-                if not self.running:
-                    break
-                    
-                if message.lower() in ['quit', 'exit']:
-                    self.client_socket.send(message.encode('utf-8'))
-                    self.running = False
-                    break
-                    
-                if message.strip():  # Only send non-empty messages
-                    # Encrypt message if encryption is enabled
-                    if self.encryption and self.encryption.is_encrypted():
-                        encrypted_message = self.encryption.encrypt_message(message)
-                        self.client_socket.send(encrypted_message.encode('utf-8'))
-                        print(f"\033[F{Fore.GREEN}{self.username}: {message} {Fore.GREEN}🔒{Style.RESET_ALL}")
-                    else:
-                        self.client_socket.send(message.encode('utf-8'))
-                        print(f"\033[F{Fore.GREEN}{self.username}: {message}{Style.RESET_ALL}")
-                    
-            except bluetooth.BluetoothError:
-                print(f"{Fore.RED}Connection lost.{Style.RESET_ALL}")
-                self.running = False
-                break
-            except KeyboardInterrupt:
-                self.running = False
-                break
-            except Exception as e:
-                print(f"{Fore.RED}Error sending message: {e}{Style.RESET_ALL}")
-                break
                 
     def disconnect(self):
         """Disconnect from the server"""
-        self.running = False
+        if self.session:
+            self.session.stop()
         print(f"\n{Fore.YELLOW}Disconnecting from server...{Style.RESET_ALL}")
         
     def cleanup(self):
         """Clean up resources"""
-        if self.client_socket:
-            try:
-                self.client_socket.close()
-            except:
-                pass
+        if self.session:
+            self.session.close()
                 
-    def start_client(self):
-        """Start the client and connect to a server"""
+    def connect_cached(self):
+        """Dial the most recently used peer. True if a chat ran"""
+        peer = self.cache.latest()
+        if peer is None:
+            return False
+        print(f"{Fore.CYAN}Using known peer {peer.name} ({peer.address}), "
+              f"last seen {peer.age() / 60:.0f} min ago. Use --rescan to search instead.{Style.RESET_ALL}")
+        transport = self.open_transport(peer.address, peer.port)
+        if transport is None:
+            # The server may have restarted on another channel or be out of range
+            self.cache.forget(peer.address)
+            print(f"{Fore.YELLOW}Known peer not reachable - scanning for devices.{Style.RESET_ALL}")
+            return False
+        self.cache.remember(peer.address, peer.name, peer.port)
+        self.run_chat(transport, peer.address, peer.port)
+        return True
+                
+    def connect_to_peer(self, address, port=None):
+        """Connect to a server given on the command line, looking up its channel if needed"""
+        if port is None:
+            port = self.find_chat_service(address)
+            if port is None:
+                return
+        transport = self.open_transport(address, port)
+        if transport is not None:
+            known = self.cache.peers.get(address)
+            self.cache.remember(address, known.name if known else address, port)
+            self.run_chat(transport, address, port)
+                
+    def start_client(self, rescan=False, peer=None, port=None):
+        """Start the client and connect to a server.
+
+        With peer given, the client connects straight to that address.
+        Otherwise, unless rescan is set, a peer from the device cache is tried
+        first.
+        """
+        self.setup_encryption()
+        if peer:
+            self.connect_to_peer(peer, port)
+            return
+        if not rescan and self.connect_cached():
+            return
+            
         # Discover devices
         devices = self.discover_devices()
         if not devices:
             return
             
-        # Let user choose a device
+        # Keep only the devices that run the chat service
+        servers = self.find_chat_servers(devices)
+        if not servers:
+            return
+            
+        # Let user choose a server, unless there is only one
+        device_index = 0
+        if len(servers) > 1 and self.headless:
+            print(f"{Fore.RED}Several chat servers found - choose one with --peer.{Style.RESET_ALL}")
+            return
         print()
-        while True:
+        while len(servers) > 1:
             try:
-                choice = input(f"{Fore.CYAN}Enter device number to connect to (1-{len(devices)}): {Style.RESET_ALL}")
+                choice = input(f"{Fore.CYAN}Enter server number to connect to (1-{len(servers)}): {Style.RESET_ALL}")
                 device_index = int(choice) - 1
-                if 0 <= device_index < len(devices):
+                if 0 <= device_index < len(servers):
                     break
                 else:
-                    print(f"{Fore.RED}Invalid choice. Please enter a number between 1 and {len(devices)}.{Style.RESET_ALL}")
+                    print(f"{Fore.RED}Invalid choice. Please enter a number between 1 and {len(servers)}.{Style.RESET_ALL}")
             except ValueError:
                 print(f"{Fore.RED}Invalid input. Please enter a number.{Style.RESET_ALL}")
             except KeyboardInterrupt:
                 print(f"\n{Fore.YELLOW}Operation cancelled by user.{Style.RESET_ALL}")
                 return
                 
-        target_addr, target_name = devices[device_index]
-        print(f"{Fore.CYAN}Selected: {target_name} ({target_addr}){Style.RESET_ALL}")
-        
-        # Find chat service on the selected device
-        port = self.find_chat_service(target_addr)
-        if port is None:
-            return
+        server = servers[device_index]
+        print(f"{Fore.CYAN}Selected: {server.name} ({server.address}){Style.RESET_ALL}")
             
         # Connect to the server
-        self.connect_to_server(target_addr, port)
+        transport = self.open_transport(server.address, server.port)
+        if transport is not None:
+            self.cache.remember(server.address, server.name, server.port)
+            self.run_chat(transport, server.address, server.port)
+
+def _env_port():
+    port = os.environ.get('BTCHAT_PORT')
+    return int(port) if port else None
+
+def parse_args(argv):
+    """Parse command line options for the client"""
+    parser = argparse.ArgumentParser(prog='bt_chat_client.py', description="Bluetooth RFCOMM chat client")
+    parser.add_argument('--rescan', action='store_true',
+                        help="ignore known peers and run a fresh device inquiry")
+    parser.add_argument('--peer', metavar='ADDRESS', default=os.environ.get('BTCHAT_PEER'),
+                        help="connect to this server address without scanning (default: $BTCHAT_PEER)")
+    parser.add_argument('--port', type=int, default=_env_port(),
+                        help="RFCOMM channel of --peer; looked up over SDP if not given (default: $BTCHAT_PORT)")
+    add_headless_arguments(parser)
+    profiling.add_arguments(parser)
+    return parser.parse_args(argv)
 
 def main():
     """Main function"""
-    print(f"{Fore.CYAN}████████╗     ██████╗██╗  ██╗ █████╗ ████████╗{Style.RESET_ALL}")
-    print(f"{Fore.CYAN}╚══██╔══╝    ██╔════╝██║  ██║██╔══██╗╚══██╔══╝{Style.RESET_ALL}")
-    print(f"{Fore.CYAN}   ██║       ██║     ███████║███████║   ██║   {Style.RESET_ALL}")
-    print(f"{Fore.CYAN}   ██║       ██║     ██╔══██║██╔══██║   ██║   {Style.RESET_ALL}")
-    print(f"{Fore.CYAN}   ██║       ╚██████╗██║  ██║██║  ██║   ██║   {Style.RESET_ALL}")
-    print(f"{Fore.CYAN}   ╚═╝        ╚═════╝╚═╝  ╚═╝╚═╝  ╚═╝   ╚═╝   {Style.RESET_ALL}")
-    print()
+    args = parse_args(sys.argv[1:])
+    # Initialize colorama for Windows compatibility
+    init()
+    profiling.configure(args)
+    headless = headless_config(args)
+    
+    if not headless:
+        print(f"{Fore.CYAN}████████╗     ██████╗██╗  ██╗ █████╗ ████████╗{Style.RESET_ALL}")
+        print(f"{Fore.CYAN}╚══██╔══╝    ██╔════╝██║  ██║██╔══██╗╚══██╔══╝{Style.RESET_ALL}")
+        print(f"{Fore.CYAN}   ██║       ██║     ███████║███████║   ██║   {Style.RESET_ALL}")
+        print(f"{Fore.CYAN}   ██║       ██║     ██╔══██║██╔══██║   ██║   {Style.RESET_ALL}")
+        print(f"{Fore.CYAN}   ██║       ╚██████╗██║  ██║██║  ██║   ██║   {Style.RESET_ALL}")
+        print(f"{Fore.CYAN}   ╚═╝        ╚═════╝╚═╝  ╚═╝╚═╝  ╚═╝   ╚═╝   {Style.RESET_ALL}")
+        print()
     
-    client = BluetoothChatClient()
+    client = BluetoothChatClient(args, headless)
     
     try:
-        client.start_client()
+        client.start_client(rescan=args.rescan, peer=args.peer, port=args.port)
     except KeyboardInterrupt:
         print(f"\n{Fore.YELLOW}Client interrupted by user.{Style.RESET_ALL}")
     finally:
@@ -5,56 +5,60 @@ A terminal-based chat application that allows two devices to communicate via Blu
 This is the server component that waits for incoming connections.
 """
 
-import bluetooth
-import threading
+import argparse
 import sys
+import time
 import os
 from colorama import init, Fore, Style
-from encryption import ChatEncryption, get_chat_password
+from encryption import ChatEncryption
+from headless import add_arguments as add_headless_arguments, chat_password, headless_config
+import profiling
+from transport import RFCOMMTransport
+from service_probe import CHAT_SERVICE_UUID
 
-# Initialize colorama for Windows compatibility
-init()
+# PyBluez and the chat engine are imported once the password has been asked for
 
 class BluetoothChatServer:
-    def __init__(self):
-        self.server_socket = None
-        self.client_socket = None
+    def __init__(self, options=None, headless=None):
+        self.listener = None
+        self.session = None
         self.client_info = None
-        self.running = False
         self.username = "Server"
         self.encryption = None
+        self.options = options
+        self.headless = headless
         
     def start_server(self):
         """Start the Bluetooth RFCOMM server"""
         # Setup encryption
-        password = get_chat_password()
+        password = self.headless.password if self.headless else chat_password(self.options)
         if password:
             self.encryption = ChatEncryption(password)
             print(f"{Fore.GREEN}🔒 Encryption enabled{Style.RESET_ALL}")
         else:
             print(f"{Fore.YELLOW}⚠️  No encryption - messages will be sent in plaintext{Style.RESET_ALL}")
         
+        import bluetooth
+        from chat_engine import ChatSession
+        from outbox import endpoint_state_dir
+        
         try:
-            # Create a Bluetooth socket using RFCOMM protocol
-            self.server_socket = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
-            
             # Get local Bluetooth adapter address
             local_addr = bluetooth.read_local_bdaddr()[0]
             print(f"{Fore.CYAN}Starting Bluetooth Chat Server...{Style.RESET_ALL}")
             print(f"{Fore.YELLOW}Local Bluetooth Address: {local_addr}{Style.RESET_ALL}")
             
-            # Bind to any available port
-            self.server_socket.bind((local_addr, bluetooth.PORT_ANY))
-            port = self.server_socket.getsockname()[1]
-            
-            # Listen for incoming connections
-            self.server_socket.listen(1)
+            # Listen on any available RFCOMM port
+            self.listener = RFCOMMTransport.listen(local_addr)
+            port = self.listener.address[1]
+            # Separate outbox state from a client on the same machine
+            state_dir = endpoint_state_dir(f"server-{local_addr}")
             print(f"{Fore.GREEN}Server listening on port {port}...{Style.RESET_ALL}")
             
             # Make device discoverable
-            uuid = "94f39d29-7d6d-437d-973b-fba39e49d4ee"
+            uuid = CHAT_SERVICE_UUID
             bluetooth.advertise_service(
-                self.server_socket, 
+                self.listener.sock, 
                 "BluetoothChatServer",
                 service_id=uuid,
                 service_classes=[uuid, bluetooth.SERIAL_PORT_CLASS],
@@ -65,29 +69,24 @@ class BluetoothChatServer:
             print(f"{Fore.CYAN}Service UUID: {uuid}{Style.RESET_ALL}")
             
             # Accept incoming connection
-            self.client_socket, self.client_info = self.server_socket.accept()
+            transport = self.listener.accept()
+            self.client_info = transport.peer
+            if self.headless:
+                self.session = self.headless.make_session(transport, self.encryption, username=self.username,
+                                                          peer_name="Client", reconnect=self.accept_again,
+                                                          state_dir=state_dir)
+            else:
+                self.session = ChatSession(transport, self.encryption, username=self.username, peer_name="Client",
+                                           reconnect=self.accept_again, state_dir=state_dir)
+            self.session.start()
             print(f"{Fore.GREEN}✓ Connected to {self.client_info}{Style.RESET_ALL}")
+            print(f"{Fore.CYAN}Compression: {self.session.codec.compressor.describe()}{Style.RESET_ALL}")
             
-            self.running = True
-            
-            # Start threads for sending and receiving messages
-            receive_thread = threading.Thread(target=self.receive_messages)
-            send_thread = threading.Thread(target=self.send_messages)
-            
-            receive_thread.daemon = True
-            send_thread.daemon = True
-            
-            receive_thread.start()
-            send_thread.start()
-            
-            print(f"{Fore.GREEN}Chat started! Type your messages below.{Style.RESET_ALL}")
-            print(f"{Fore.YELLOW}Type 'quit' or 'exit' to close the connection.{Style.RESET_ALL}")
-            print("-" * 50)
-            
-            # Keep main thread alive
             try:
-                while self.running:
-                    threading.Event().wait(1)
+                if self.headless:
+                    self.headless.run(self.session)
+                else:
+                    self.session.run()
             except KeyboardInterrupt:
                 self.stop_server()
                 
@@ -98,104 +97,57 @@ class BluetoothChatServer:
             print(f"{Fore.RED}Error: {e}{Style.RESET_ALL}")
         finally:
             self.cleanup()
-            
-    def receive_messages(self):
-        """Receive messages from the client"""
-        while self.running:
-            try:
-                data = self.client_socket.recv(1024)
-                if not data:
-                    break
-                    
-                message = data.decode('utf-8').strip()
-                if message.lower() in ['quit', 'exit']:
-                    print(f"{Fore.RED}Client disconnected.{Style.RESET_ALL}")
-                    self.running = False
-                    break
-                
-                # Decrypt message if encryption is enabled
-                if self.encryption and self.encryption.is_encrypted():
-                    try:
-                        decrypted_message = self.encryption.decrypt_message(message)
-                        print(f"{Fore.BLUE}Client: {decrypted_message} {Fore.GREEN}🔒{Style.RESET_ALL}")
-                    except Exception as e:
-                        print(f"{Fore.RED}Failed to decrypt message from client{Style.RESET_ALL}")
-                        print(f"{Fore.BLUE}Client (encrypted): {message[:50]}...{Style.RESET_ALL}")
-                else:
-                    print(f"{Fore.BLUE}Client: {message}{Style.RESET_ALL}")
-                
-            except bluetooth.BluetoothError:
-                print(f"{Fore.RED}Connection lost.{Style.RESET_ALL}")
-                self.running = False
-                break
-            except Exception as e:
-                print(f"{Fore.RED}Error receiving message: {e}{Style.RESET_ALL}")
-                break
-                
-    def send_messages(self):
-        """Send messages to the client"""
-        while self.running:
-            try:
-                message = input()
-                if not self.running:
-                    break
-                    
-                if message.lower() in ['quit', 'exit']:
-                    self.client_socket.send(message.encode('utf-8'))
-                    self.running = False
-                    break
-                    
-                if message.strip():  # Only send non-empty messages
-                    # Encrypt message if encryption is enabled
-                    if self.encryption and self.encryption.is_encrypted():
-                        encrypted_message = self.encryption.encrypt_message(message)
-                        self.client_socket.send(encrypted_message.encode('utf-8'))
-                        print(f"\033[F{Fore.GREEN}{self.username}: {message} {Fore.GREEN}🔒{Style.RESET_ALL}")
-                    else:
-                        self.client_socket.send(message.encode('utf-8'))
-                        print(f"\033[F{Fore.GREEN}{self.username}: {message}{Style.RESET_ALL}")
-                    
-            except bluetooth.BluetoothError:
-                print(f"{Fore.RED}Connection lost.{Style.RESET_ALL}")
-                self.running = False
-                break
-            except KeyboardInterrupt:
-                self.running = False
-                break
-            except Exception as e:
-                print(f"{Fore.RED}Error sending message: {e}{Style.RESET_ALL}")
-                break
                 
+    def accept_again(self, timeout):
+        """Wait up to timeout seconds for the same client to come back after the link dropped"""
+        deadline = time.monotonic() + timeout
+        while True:
+            # socket.timeout once the time is up; the session counts it as a failed attempt
+            transport = self.listener.accept(max(0.0, deadline - time.monotonic()))
+            if transport.peer_address() == self.session.transport.peer_address():
+                return transport
+            print(f"{Fore.YELLOW}Ignoring connection from {transport.peer_address()} "
+                  f"while waiting for {self.session.transport.peer_address()}{Style.RESET_ALL}")
+            transport.close()
+            
     def stop_server(self):
         """Stop the server and close connections"""
-        self.running = False
+        if self.session:
+            self.session.stop()
         print(f"\n{Fore.YELLOW}Shutting down server...{Style.RESET_ALL}")
         
     def cleanup(self):
         """Clean up resources"""
-        if self.client_socket:
-            try:
-                self.client_socket.close()
-            except:
-                pass
-                
-        if self.server_socket:
-            try:
-                self.server_socket.close()
-            except:
-                pass
+        if self.session:
+            self.session.close()
+        if self.listener:
+            self.listener.close()
+
+def parse_args(argv):
+    """Parse command line options for the server"""
+    parser = argparse.ArgumentParser(prog='bt_chat_server.py', description="Bluetooth RFCOMM chat server")
+    add_headless_arguments(parser)
+    profiling.add_arguments(parser)
+    return parser.parse_args(argv)
 
 def main():
     """Main function"""
-    print(f"{Fore.CYAN}████████╗     ██████╗██╗  ██╗ █████╗ ████████╗{Style.RESET_ALL}")
-    print(f"{Fore.CYAN}╚══██╔══╝    ██╔════╝██║  ██║██╔══██╗╚══██╔══╝{Style.RESET_ALL}")
-    print(f"{Fore.CYAN}   ██║       ██║     ███████║███████║   ██║   {Style.RESET_ALL}")
-    print(f"{Fore.CYAN}   ██║       ██║     ██╔══██║██╔══██║   ██║   {Style.RESET_ALL}")
-    print(f"{Fore.CYAN}   ██║       ╚██████╗██║  ██║██║  ██║   ██║   {Style.RESET_ALL}")
-    print(f"{Fore.CYAN}   ╚═╝        ╚═════╝╚═╝  ╚═╝╚═╝  ╚═╝   ╚═╝   {Style.RESET_ALL}")
-    print()
+    args = parse_args(sys.argv[1:])
+    # Initialize colorama for Windows compatibility
+    init()
+    profiling.configure(args)
+    headless = headless_config(args)
+    
+    if not headless:
+        print(f"{Fore.CYAN}████████╗     ██████╗██╗  ██╗ █████╗ ████████╗{Style.RESET_ALL}")
+        print(f"{Fore.CYAN}╚══██╔══╝    ██╔════╝██║  ██║██╔══██╗╚══██╔══╝{Style.RESET_ALL}")
+        print(f"{Fore.CYAN}   ██║       ██║     ███████║███████║   ██║   {Style.RESET_ALL}")
+        print(f"{Fore.CYAN}   ██║       ██║     ██╔══██║██╔══██║   ██║   {Style.RESET_ALL}")
+        print(f"{Fore.CYAN}   ██║       ╚██████╗██║  ██║██║  ██║   ██║   {Style.RESET_ALL}")
+        print(f"{Fore.CYAN}   ╚═╝        ╚═════╝╚═╝  ╚═╝╚═╝  ╚═╝   ╚═╝   {Style.RESET_ALL}")
+        print()
     
-    server = BluetoothChatServer()
+    server = BluetoothChatServer(args, headless)
     
     try:
         server.start_server()
@@ -0,0 +1,629 @@
+#!/usr/bin/env python3
+"""
+Load Generator and Latency Benchmark for the Chat Simulation
+Starts the asyncio relay server in a separate process, connects N synthetic
+clients that send at a fixed rate, and measures end-to-end delivery latency
+and throughput through the relay. Results are printed and written as JSON so
+runs can be compared.
+
+With --transport memory two chat sessions are joined by an in-process socket
+pair instead, which measures the framing, compression, encryption and send
+queue pipeline without network or relay overhead. Add --duplex to have both
+sessions send at once, each from its own session loop as in a real chat.
+--file-size instead times one /send file transfer between the two sessions
+and checks that the file arrived intact.
+"""
+
+import asyncio
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import platform
+import socket
+import tempfile
+import threading
+import time
+from colorama import Fore, Style
+from async_server import AsyncChatSimServer
+from encryption import ChatEncryption, key_cache_stats
+from framing import HEADER, encode_frame
+from protocol import MSG_CHAT, MSG_HELLO, pack_message
+from compression import DEFAULT_CODECS, MessageCompressor
+from message_codec import DecodeError, MessageCodec
+from chat_engine import ChatSession
+from file_transfer import format_size
+from transport import MemoryTransport
+from renderer import Renderer
+
+DEFAULT_PASSWORD = 'bench_password'
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, math.ceil(pct / 100.0 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+def build_message(client_id, seq, size):
+    """Message text carrying the sender, sequence and send timestamp"""
+    prefix = f"{client_id}:{seq}:{time.perf_counter_ns()}:"
+    return prefix + 'x' * max(0, size - len(prefix))
+
+def find_free_port(host):
+    """Ask the OS for a port that is currently unused"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+        probe.bind((host, 0))
+        return probe.getsockname()[1]
+
+def run_server_process(host, port, workers=1):
+    """Entry point for the relay server child process"""
+    if workers > 1:
+        from relay_workers import run_relay_workers
+        run_relay_workers(host, port, workers, verbose=False)
+        return
+    server = AsyncChatSimServer(host, port, verbose=False)
+    try:
+        asyncio.run(server.serve())
+    except KeyboardInterrupt:
+        pass
+
+class BenchStats:
+    """Counters and latency samples shared by all synthetic clients"""
+
+    def __init__(self):
+        self.sent = 0
+        self.sent_bytes = 0
+        self.delivered = 0
+        self.received_bytes = 0
+        self.decode_errors = 0
+        self.latencies_ns = []
+        self.render = None
+
+class BenchClient:
+    def __init__(self, client_id, host, port, stats, encryption=None, compress=False):
+        self.client_id = client_id
+        self.host = host
+        self.port = port
+        self.stats = stats
+        codecs = DEFAULT_CODECS if compress else ()
+        self.codec = MessageCodec(encryption, MessageCompressor(codecs))
+        self.reader = None
+        self.writer = None
+
+    async def connect(self, timeout=10.0):
+        """Connect to the relay, retrying while the server is still starting"""
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+                hello = {'compression': self.codec.compressor.codecs}
+                self.writer.write(encode_frame(pack_message(MSG_HELLO, json.dumps(hello).encode('utf-8'))))
+                return
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.05)
+
+    async def send_loop(self, rate, size, duration):
+        """Send messages at rate per second (0 = as fast as possible)"""
+        interval = 1.0 / rate if rate > 0 else 0.0
+        start = time.perf_counter()
+        next_send = start
+        seq = 0
+        while time.perf_counter() - start < duration:
+            message = build_message(self.client_id, seq, size)
+            frame = encode_frame(pack_message(MSG_CHAT, self.codec.encode(message)))
+            self.writer.write(frame)
+            self.stats.sent += 1
+            self.stats.sent_bytes += len(frame)
+            seq += 1
+
+            if interval:
+                next_send += interval
+                delay = next_send - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                else:
+                    await self.writer.drain()
+            else:
+                await self.writer.drain()
+
+    async def receive_loop(self):
+        """Read relayed frames and record their end-to-end latency"""
+        try:
+            while True:
+                header = await self.reader.readexactly(HEADER.size)
+                (length,) = HEADER.unpack(header)
+                payload = await self.reader.readexactly(length)
+                now = time.perf_counter_ns()
+                self.stats.received_bytes += HEADER.size + length
+
+                if payload[:1] != bytes((MSG_CHAT,)):
+                    continue
+                try:
+                    message = self.codec.decode(payload[1:])
+                    sent_ns = int(message.split(':', 3)[2])
+                except (DecodeError, IndexError, ValueError):
+                    self.stats.decode_errors += 1
+                    continue
+                self.stats.delivered += 1
+                self.stats.latencies_ns.append(now - sent_ns)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+    async def close(self):
+        """Close the connection"""
+        if self.writer:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except ConnectionError:
+                pass
+
+async def run_clients(host, port, clients, rate, size, duration, encryption, compress, drain):
+    """Connect all clients, run the send phase, then wait for stragglers"""
+    stats = BenchStats()
+    bench_clients = [BenchClient(i, host, port, stats, encryption, compress) for i in range(clients)]
+    await asyncio.gather(*(c.connect() for c in bench_clients))
+
+    # Give the relay a moment to register every peer before traffic starts
+    await asyncio.sleep(0.2)
+    receivers = [asyncio.create_task(c.receive_loop()) for c in bench_clients]
+
+    start = time.perf_counter()
+    await asyncio.gather(*(c.send_loop(rate, size, duration) for c in bench_clients))
+    send_elapsed = time.perf_counter() - start
+
+    expected = stats.sent * (clients - 1)
+    drain_deadline = time.perf_counter() + drain
+    while stats.delivered < expected and time.perf_counter() < drain_deadline:
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - start
+
+    for task in receivers:
+        task.cancel()
+    await asyncio.gather(*receivers, return_exceptions=True)
+    await asyncio.gather(*(c.close() for c in bench_clients))
+    return stats, send_elapsed, elapsed
+
+class PipelineSession(ChatSession):
+    """Chat session that records delivery latency instead of printing messages"""
+
+    def __init__(self, transport, stats, encryption=None, codecs=(), decrypt_workers=0, heartbeat=False,
+                 state_dir=None):
+        # In a one-way run the sending side never runs its loop, so it could not answer pings
+        # or acknowledgements. state_dir turns the outbox on, kept in that directory
+        super().__init__(transport, encryption, codecs=codecs, outbox=state_dir is not None, heartbeat=heartbeat,
+                         decrypt_workers=decrypt_workers, state_dir=state_dir)
+        self.stats = stats
+
+    def handle_payload(self, payload):
+        self.stats.received_bytes += HEADER.size + len(payload)
+        return super().handle_payload(payload)
+
+    def show_incoming(self, message):
+        now = time.perf_counter_ns()
+        try:
+            sent_ns = int(message.split(':', 3)[2])
+        except (IndexError, ValueError):
+            self.stats.decode_errors += 1
+            return
+        self.stats.delivered += 1
+        self.stats.latencies_ns.append(now - sent_ns)
+        if self.renderer:
+            super().show_incoming(message)
+
+    def show_outgoing(self, message):
+        pass
+
+def run_pipeline(rate, size, duration, encryption, compress, drain, render=False, decrypt_workers=0):
+    """Send from one chat session to another over an in-memory transport.
+
+    With render=True received messages are also drawn by a Renderer writing
+    to os.devnull, so its cost shows up in the results. decrypt_workers > 0
+    decrypts on the receiving side with a pool of that many threads.
+    """
+    stats = BenchStats()
+    codecs = DEFAULT_CODECS if compress else ()
+    left, right = MemoryTransport.pair()
+    sender = PipelineSession(left, stats, encryption, codecs)
+    receiver = PipelineSession(right, stats, encryption, codecs, decrypt_workers)
+    if render:
+        receiver.renderer = Renderer(stream=open(os.devnull, 'w'))
+    if sender.profiler is not None:
+        # One report for the whole pipeline: send stages from this thread, receive stages from the receiver's
+        receiver.profiler = sender.profiler
+
+    # Each side waits for the other's HELLO, so one of them handshakes on a thread
+    handshake = threading.Thread(target=receiver.start)
+    handshake.start()
+    sender.start()
+    handshake.join()
+    receive_thread = threading.Thread(target=receiver.run, kwargs={'interactive': False}, daemon=True)
+    receive_thread.start()
+
+    sender.writer.flush()
+    hello_bytes = sender.writer.stats.bytes
+    interval = 1.0 / rate if rate > 0 else 0.0
+    start = time.perf_counter()
+    next_send = start
+    while time.perf_counter() - start < duration:
+        sender.send_chat(build_message(0, stats.sent, size), echo=False, wait=True)
+        stats.sent += 1
+        if interval:
+            next_send += interval
+            delay = next_send - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+    sender.writer.flush()
+    send_elapsed = time.perf_counter() - start
+    stats.sent_bytes = sender.writer.stats.bytes - hello_bytes
+
+    drain_deadline = time.perf_counter() + drain
+    while stats.delivered < stats.sent and time.perf_counter() < drain_deadline:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+
+    receiver.stop()
+    receive_thread.join(timeout=1)
+    for session in (sender, receiver):
+        session.writer.close()
+        session.transport.close()
+    if render:
+        receiver.renderer.close()
+        receiver.renderer.stream.close()
+        stats.render = receiver.renderer.summary()
+    if sender.profiler is not None:
+        sender.print_profile()
+    return stats, send_elapsed, elapsed
+
+def feed_lines(stream, stats, client_id, rate, size, duration):
+    """Write messages to stream, one per line, until duration is up, then close it"""
+    interval = 1.0 / rate if rate > 0 else 0.0
+    start = time.perf_counter()
+    next_send = start
+    try:
+        while time.perf_counter() - start < duration:
+            stream.write(build_message(client_id, stats.sent, size) + '\n')
+            stats.sent += 1
+            if interval:
+                stream.flush()
+                next_send += interval
+                delay = next_send - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+    finally:
+        stream.close()
+
+def run_duplex(rate, size, duration, encryption, compress, drain, decrypt_workers=0):
+    """Send both ways between two chat sessions at once.
+
+    Each session reads its messages from a pipe and sends them from its own
+    loop, which is also answering the peer's pings and acknowledging its
+    messages, so a session that stops reading while it waits for send queue
+    space shows up as lost messages. Each side keeps its outbox in a
+    temporary directory.
+    """
+    with tempfile.TemporaryDirectory(prefix='btchat-bench-') as state_dir:
+        return _run_duplex(rate, size, duration, encryption, compress, drain, decrypt_workers, state_dir)
+
+def _run_duplex(rate, size, duration, encryption, compress, drain, decrypt_workers, state_dir):
+    codecs = DEFAULT_CODECS if compress else ()
+    left, right = MemoryTransport.pair()
+    stats = (BenchStats(), BenchStats())
+    # Each side receives what the other sends, so stats[0] counts what left sends and right gets
+    sessions = (PipelineSession(left, stats[1], encryption, codecs, decrypt_workers, heartbeat=True,
+                                state_dir=os.path.join(state_dir, 'left')),
+                PipelineSession(right, stats[0], encryption, codecs, decrypt_workers, heartbeat=True,
+                                state_dir=os.path.join(state_dir, 'right')))
+    handshake = threading.Thread(target=sessions[1].start)
+    handshake.start()
+    sessions[0].start()
+    handshake.join()
+    hello_bytes = [session.writer.stats.bytes for session in sessions]
+
+    threads = []
+    start = time.perf_counter()
+    for client_id, session in enumerate(sessions):
+        read_fd, write_fd = os.pipe()
+        feeder = threading.Thread(target=feed_lines, daemon=True,
+                                  args=(open(write_fd, 'w'), stats[client_id], client_id, rate, size, duration))
+        loop = threading.Thread(target=session.run, daemon=True,
+                                kwargs={'interactive': False, 'input_stream': open(read_fd)})
+        loop.start()
+        feeder.start()
+        threads.append(loop)
+    time.sleep(duration)
+    send_elapsed = time.perf_counter() - start
+
+    drain_deadline = time.perf_counter() + drain
+    while (any(side.delivered < side.sent for side in stats)
+           and time.perf_counter() < drain_deadline):
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+
+    for session in sessions:
+        session.stop()
+    for loop in threads:
+        loop.join(timeout=1)
+    total = BenchStats()
+    for session, side, hello in zip(sessions, stats, hello_bytes):
+        total.sent += side.sent
+        total.delivered += side.delivered
+        total.received_bytes += side.received_bytes
+        total.decode_errors += side.decode_errors
+        total.latencies_ns.extend(side.latencies_ns)
+        total.sent_bytes += session.writer.stats.bytes - hello
+        session.writer.close()
+        session.transport.close()
+        if session.outbox is not None:
+            session.outbox.close()
+    return total, send_elapsed, elapsed
+
+def run_file_transfer(size, encryption, sendfile=True):
+    """Send a file of size random bytes from one chat session to another.
+
+    Returns the seconds it took and whether the received file matches.
+    sendfile=False makes the sender read the file through mmap, as it does
+    on connections os.sendfile can't write to (RFCOMM).
+    """
+    with tempfile.TemporaryDirectory(prefix='btchat-bench-') as directory:
+        path = os.path.join(directory, 'bench.bin')
+        digest = hashlib.sha256()
+        with open(path, 'wb') as f:
+            remaining = size
+            while remaining:
+                chunk = os.urandom(min(remaining, 1024 * 1024))
+                digest.update(chunk)
+                f.write(chunk)
+                remaining -= len(chunk)
+
+        left, right = MemoryTransport.pair()
+        sender = ChatSession(left, encryption, outbox=False, heartbeat=False)
+        receiver = ChatSession(right, encryption, outbox=False, heartbeat=False)
+        handshake = threading.Thread(target=receiver.start)
+        handshake.start()
+        sender.start()
+        handshake.join()
+        sender.writer.sendfile = sendfile
+        receiver.transfers.download_dir = os.path.join(directory, 'downloads')
+        # The sender's loop handles the accept and acknowledgements, the receiver's the data
+        loops = [threading.Thread(target=session.run, kwargs={'interactive': False}, daemon=True)
+                 for session in (sender, receiver)]
+        for loop in loops:
+            loop.start()
+
+        start = time.perf_counter()
+        sent = sender.transfers.send_file(path)
+        elapsed = time.perf_counter() - start
+        verified = False
+        if sent:
+            received = hashlib.sha256()
+            with open(os.path.join(receiver.transfers.download_dir, 'bench.bin'), 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    received.update(chunk)
+            verified = received.digest() == digest.digest()
+
+        for session in (sender, receiver):
+            session.stop()
+        for loop in loops:
+            loop.join(timeout=1)
+        for session in (sender, receiver):
+            session.writer.close()
+            session.transport.close()
+    return elapsed, verified
+
+def run_file_benchmark(size, encrypt=False, password=DEFAULT_PASSWORD, sendfile=True):
+    """Time one file transfer over the memory transport and return the report as a dict"""
+    encryption = ChatEncryption(password) if encrypt else None
+    elapsed, verified = run_file_transfer(size, encryption, sendfile)
+    if encrypt:
+        method = 'encrypted stream'
+    else:
+        method = 'sendfile' if sendfile and hasattr(os, 'sendfile') else 'mmap'
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {'transport': 'memory', 'file_size': size, 'encrypt': encrypt, 'method': method},
+        'results': {
+            'seconds': round(elapsed, 3),
+            'bytes_per_sec': round(size / elapsed, 1) if elapsed else 0.0,
+            'verified': verified,
+        },
+    }
+
+def print_file_report(report):
+    """Print a human-readable summary of a file transfer run"""
+    config = report['config']
+    results = report['results']
+    print(f"{Fore.CYAN}File transfer: {format_size(config['file_size'])} over memory, "
+          f"file data sent by {config['method']}{Style.RESET_ALL}")
+    print(f"{Fore.GREEN}Took {results['seconds']} s ({results['bytes_per_sec'] / 1e6:.2f} MB/s){Style.RESET_ALL}")
+    if results['verified']:
+        print(f"{Fore.GREEN}Received file matches what was sent{Style.RESET_ALL}")
+    else:
+        print(f"{Fore.RED}Transfer failed or the received file differs{Style.RESET_ALL}")
+
+def summarize(stats, clients, send_elapsed, elapsed):
+    """Reduce raw counters and samples to the reported figures"""
+    latencies_ms = sorted(ns / 1e6 for ns in stats.latencies_ns)
+    expected = stats.sent * (clients - 1)
+    return {
+        'sent': stats.sent,
+        'delivered': stats.delivered,
+        'expected_deliveries': expected,
+        'lost': expected - stats.delivered,
+        'decode_errors': stats.decode_errors,
+        'send_seconds': round(send_elapsed, 3),
+        'total_seconds': round(elapsed, 3),
+        'sent_msgs_per_sec': round(stats.sent / send_elapsed, 1) if send_elapsed else 0.0,
+        'delivered_msgs_per_sec': round(stats.delivered / elapsed, 1) if elapsed else 0.0,
+        'sent_bytes_per_sec': round(stats.sent_bytes / send_elapsed, 1) if send_elapsed else 0.0,
+        'received_bytes_per_sec': round(stats.received_bytes / elapsed, 1) if elapsed else 0.0,
+        'latency_ms': {
+            'p50': round(percentile(latencies_ms, 50), 3),
+            'p95': round(percentile(latencies_ms, 95), 3),
+            'p99': round(percentile(latencies_ms, 99), 3),
+            'max': round(latencies_ms[-1], 3) if latencies_ms else 0.0,
+            'mean': round(sum(latencies_ms) / len(latencies_ms), 3) if latencies_ms else 0.0,
+        },
+    }
+
+def print_report(report):
+    """Print a human-readable summary of a benchmark run"""
+    config = report['config']
+    results = report['results']
+    latency = results['latency_ms']
+    print(f"{Fore.CYAN}Transport: {config['transport']}  Clients: {config['clients']}  Rate: {config['rate']}/s per client  "
+          f"Size: {config['size']} B  Encryption: {'on' if config['encrypt'] else 'off'}  "
+          f"Compression: {'on' if config['compress'] else 'off'}{Style.RESET_ALL}")
+    print(f"{Fore.GREEN}Sent:      {results['sent']} msgs "
+          f"({results['sent_msgs_per_sec']} msgs/s, {results['sent_bytes_per_sec'] / 1e6:.2f} MB/s){Style.RESET_ALL}")
+    print(f"{Fore.GREEN}Delivered: {results['delivered']}/{results['expected_deliveries']} "
+          f"({results['delivered_msgs_per_sec']} msgs/s, {results['received_bytes_per_sec'] / 1e6:.2f} MB/s){Style.RESET_ALL}")
+    print(f"{Fore.YELLOW}Latency:   p50 {latency['p50']} ms  p95 {latency['p95']} ms  "
+          f"p99 {latency['p99']} ms  max {latency['max']} ms{Style.RESET_ALL}")
+    if report.get('render'):
+        print(f"{Fore.CYAN}Renderer:  {report['render']}{Style.RESET_ALL}")
+    if results['lost'] or results['decode_errors']:
+        print(f"{Fore.RED}Lost: {results['lost']}  Decode errors: {results['decode_errors']}{Style.RESET_ALL}")
+
+def run_benchmark(clients=10, rate=50.0, size=256, duration=10.0, encrypt=False, compress=False,
+                  password=DEFAULT_PASSWORD, host='127.0.0.1', port=None, drain=2.0, transport='tcp',
+                  render=False, decrypt_workers=0, workers=1, duplex=False):
+    """Run one benchmark and return the report as a dict.
+
+    If port is None a relay server is started in a child process on a free
+    port, otherwise the clients connect to an already running server. The
+    memory transport ignores clients, host and port and runs one sender and
+    one receiver in this process; render adds terminal rendering to it and
+    decrypt_workers a decrypt pool on its receiving side, and duplex sends both
+    ways at once (rate is then per side). workers > 1 runs
+    the relay that is started in that many processes (see relay_workers.py).
+    """
+    if transport == 'memory':
+        clients = 2
+    elif clients < 2:
+        raise ValueError("At least 2 clients are needed to measure delivery")
+
+    encryption = ChatEncryption(password) if encrypt else None
+    server_process = None
+    if transport == 'memory':
+        host = port = None
+    elif port is None:
+        port = find_free_port(host)
+        # Daemon processes can't start the worker processes, so a multi-worker relay is joined in the finally
+        server_process = multiprocessing.Process(target=run_server_process, args=(host, port, workers),
+                                                 daemon=workers <= 1)
+        server_process.start()
+
+    try:
+        if transport == 'memory' and duplex:
+            stats, send_elapsed, elapsed = run_duplex(rate, size, duration, encryption, compress, drain,
+                                                       decrypt_workers)
+        elif transport == 'memory':
+            stats, send_elapsed, elapsed = run_pipeline(rate, size, duration, encryption, compress, drain, render,
+                                                         decrypt_workers)
+        else:
+            stats, send_elapsed, elapsed = asyncio.run(
+                run_clients(host, port, clients, rate, size, duration, encryption, compress, drain)
+            )
+    finally:
+        if server_process:
+            server_process.terminate()
+            server_process.join(timeout=5)
+
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {
+            'transport': transport,
+            'clients': clients,
+            'rate': rate,
+            'size': size,
+            'duration': duration,
+            'encrypt': encrypt,
+            'compress': compress,
+            'render': render,
+            'duplex': duplex and transport == 'memory',
+            'decrypt_workers': decrypt_workers,
+            'server_workers': workers if server_process else None,
+            'host': host,
+            'port': port,
+            'external_server': transport != 'memory' and server_process is None,
+        },
+        'results': summarize(stats, clients, send_elapsed, elapsed),
+        'render': stats.render,
+        'key_cache': key_cache_stats(),
+    }
+
+def write_report(report, path):
+    """Write a report as JSON"""
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+        f.write('\n')
+
+def add_arguments(parser):
+    """Register benchmark options on an argparse parser"""
+    parser.add_argument('--clients', type=int, default=10, help="number of synthetic clients (default: 10)")
+    parser.add_argument('--rate', type=float, default=50.0,
+                        help="messages per second per client, 0 for unthrottled (default: 50)")
+    parser.add_argument('--size', type=int, default=256, help="plaintext message size in bytes (default: 256)")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds to send for (default: 10)")
+    parser.add_argument('--encrypt', action='store_true', help="encrypt messages with ChatEncryption")
+    parser.add_argument('--compress', action='store_true', help="compress messages before encryption")
+    parser.add_argument('--password', default=DEFAULT_PASSWORD, help="password used with --encrypt")
+    parser.add_argument('--transport', choices=('tcp', 'memory'), default='tcp',
+                        help="tcp: clients through the relay server; memory: one in-process "
+                             "session pair, no network (default: tcp)")
+    parser.add_argument('--render', action='store_true',
+                        help="with --transport memory, also render received messages (to /dev/null)")
+    parser.add_argument('--duplex', action='store_true',
+                        help="with --transport memory, send both ways at once from both session loops")
+    parser.add_argument('--file-size', type=int, metavar='BYTES',
+                        help="time one file transfer of BYTES between two in-process sessions instead")
+    parser.add_argument('--no-sendfile', action='store_true',
+                        help="with --file-size, read the file through mmap instead of os.sendfile, as on RFCOMM")
+    parser.add_argument('--decrypt-workers', type=int, default=0, metavar='N',
+                        help="with --transport memory and --encrypt, decrypt on N worker threads (default: 0, inline)")
+    parser.add_argument('--workers', type=int, default=1, metavar='N',
+                        help="run the relay started for the benchmark in N processes (default: 1)")
+    parser.add_argument('--server', metavar='HOST:PORT',
+                        help="benchmark an already running server instead of starting one")
+    parser.add_argument('--output', metavar='FILE', help="write the results as JSON to FILE")
+
+def main(args):
+    """Run the benchmark described by parsed command line options"""
+    host, port = '127.0.0.1', None
+    if args.server:
+        host, _, port = args.server.rpartition(':')
+        port = int(port)
+
+    if args.file_size is not None:
+        report = run_file_benchmark(args.file_size, encrypt=args.encrypt, password=args.password,
+                                    sendfile=not args.no_sendfile)
+        print_file_report(report)
+        if args.output:
+            write_report(report, args.output)
+            print(f"{Fore.GREEN}Results written to {args.output}{Style.RESET_ALL}")
+        if not report['results']['verified']:
+            raise SystemExit(1)
+        return report
+
+    print(f"{Fore.CYAN}Running chat benchmark for {args.duration:g}s...{Style.RESET_ALL}")
+    report = run_benchmark(
+        clients=args.clients, rate=args.rate, size=args.size, duration=args.duration,
+        encrypt=args.encrypt, compress=args.compress, password=args.password, host=host, port=port,
+        transport=args.transport, render=args.render, decrypt_workers=args.decrypt_workers,
+        workers=args.workers, duplex=args.duplex
+    )
+    print_report(report)
+
+    if args.output:
+        write_report(report, args.output)
+        print(f"{Fore.GREEN}Results written to {args.output}{Style.RESET_ALL}")
+    return report
@@ -0,0 +1,1018 @@
+#!/usr/bin/env python3
+"""
+Chat Engine for Bluetooth Chat
+The send/receive/encrypt logic shared by every mode. A ChatSession runs one
+conversation over any Transport; the Bluetooth and simulation entry points
+only set up the connection and hand it over.
+"""
+
+import codecs
+import json
+import os
+import selectors
+import socket
+import stat
+import sys
+import threading
+import time
+from collections import deque
+from colorama import Fore, Style
+from compression import print_compression_stats
+from file_transfer import FileTransferManager, format_size
+from framing import HEADER, MAX_FRAME_SIZE, FrameReader
+from message_codec import DecodeError, negotiate_codec
+from renderer import Renderer
+from history import (DIRECTION_IN, DIRECTION_OUT, FLAG_ENCRYPTED, HistoryWriter,
+                     format_record, open_history)
+from search_index import SearchIndex
+from metrics import METRICS_FILE, ConnectionMetrics, MetricsExporter
+from profiling import session_profiler
+from outbox import OUTBOX_VERSION, SEQ, STATE_DIR, Outbox, ReceivedState, node_id
+from reconnect import RECONNECT, RECONNECT_TIMEOUT, Backoff
+from heartbeat import HEARTBEAT_INTERVAL, HEARTBEAT_VERSION, Heartbeat
+from decrypt_pool import DECRYPT_WORKERS, DecryptPool
+from protocol import (MSG_CHAT, MSG_CHAT_ACK, MSG_CHAT_SEQ, MSG_CONTROL, MSG_PING, MSG_PONG, FILE_MESSAGES,
+                      CONTROL, CONTROL_BYE, LEGACY_QUIT, LEGACY_VERSION, peer_version, send_bye,
+                      send_message, unpack_message)
+from send_queue import OutboundQueue, print_send_queue_stats
+
+QUIT_COMMANDS = ('quit', 'exit')
+INPUT_RETRY = 0.05      # Seconds between retries while typed lines wait for queue space
+BYE_TIMEOUT = 2.0       # Seconds to let queued messages go out before saying goodbye
+READ_SIZE = 64 * 1024   # Bytes of input read at a time
+JSON_ENCODER = json.JSONEncoder(ensure_ascii=False)
+
+class StdinReader:
+    """Reads lines from stdin without blocking the session loop.
+
+    Where the selector can watch stdin (POSIX) the session reads it when it is
+    readable. Elsewhere (Windows consoles) a helper thread reads lines and
+    wakes the loop; fd is None in that case.
+
+    Regular files (a redirected or --input file) and devices like /dev/null
+    never block and can't be watched by every selector, so they are read
+    whenever more lines are wanted; regular is True in that case.
+
+    On a POSIX terminal the reader switches it to cbreak mode and edits the
+    line itself, reporting every change to on_edit so the renderer can keep
+    the input line intact while messages arrive.
+    """
+
+    def __init__(self, wake, stream=None, on_edit=None, on_redraw=None):
+        self.stream = stream or sys.stdin
+        self.eof = False
+        self.fd = None
+        self.regular = False
+        self.editing = False
+        self._lines = deque()
+        self._pending = ''
+        self._escape = False
+        self._saved_mode = None
+        self._on_edit = on_edit
+        self._on_redraw = on_redraw
+        self._decoder = codecs.getincrementaldecoder(getattr(self.stream, 'encoding', None) or 'utf-8')('replace')
+        if os.name != 'nt':
+            try:
+                self.fd = self.stream.fileno()
+            except (AttributeError, OSError, ValueError):
+                self.fd = None
+        if self.fd is not None:
+            self.regular = stat.S_ISREG(os.fstat(self.fd).st_mode)
+        if self.fd is None:
+            self._wake = wake
+            threading.Thread(target=self._read_thread, name='stdin-reader', daemon=True).start()
+        elif on_edit is not None and self.stream.isatty():
+            self._enter_cbreak()
+
+    def _enter_cbreak(self):
+        try:
+            import termios
+            import tty
+            self._saved_mode = termios.tcgetattr(self.fd)
+            tty.setcbreak(self.fd)
+        except (ImportError, OSError):
+            return
+        self.editing = True
+        self._on_edit('')
+
+    def close(self):
+        """Give the terminal back in the mode it was in"""
+        if self._saved_mode is not None:
+            import termios
+            try:
+                termios.tcsetattr(self.fd, termios.TCSADRAIN, self._saved_mode)
+            except OSError:
+                pass
+            self._saved_mode = None
+
+    def read_lines(self):
+        """Read what is available on the fd and return the complete lines"""
+        data = os.read(self.fd, READ_SIZE)
+        if not data:
+            self.eof = True
+        text = self._decoder.decode(data, final=self.eof)
+        if self.editing:
+            return self._edit(text)
+        text = self._pending + text
+        lines = text.split('\n')
+        self._pending = '' if self.eof else lines.pop()
+        return [line.rstrip('\r') for line in lines if line or not self.eof]
+
+    def _edit(self, text):
+        """Apply typed characters to the line being edited"""
+        lines = []
+        line = self._pending
+        for char in text:
+            if self._escape:
+                # Skip cursor keys and other escape sequences
+                self._escape = not (char.isalpha() or char == '~')
+            elif char == '\x1b':
+                self._escape = True
+            elif char in '\r\n':
+                lines.append(line)
+                line = ''
+            elif char in '\x7f\x08':
+                line = line[:-1]
+            elif char == '\x15':        # Ctrl+U
+                line = ''
+            elif char == '\x0c':        # Ctrl+L
+                if self._on_redraw:
+                    self._on_redraw()
+            elif char == '\x04' and not line:     # Ctrl+D on an empty line
+                self.eof = True
+            elif char >= ' ':
+                line += char
+        self._pending = line
+        self._on_edit(line)
+        return lines
+
+    def take_lines(self):
+        """Lines collected by the helper thread so far"""
+        lines = []
+        while self._lines:
+            lines.append(self._lines.popleft())
+        return lines
+
+    def exhausted(self):
+        """True once the input has ended and every line has been taken"""
+        return self.eof and not self._lines
+
+    def _read_thread(self):
+        for line in self.stream:
+            self._lines.append(line.rstrip('\r\n'))
+            self._wake()
+        self.eof = True
+        self._wake()
+
+class ChatSession:
+    """One conversation over a transport.
+
+    With outbox=True (the default) and a peer that supports it, chat messages
+    are numbered and kept in a persistent Outbox until the peer acknowledges
+    them, and anything unacknowledged is sent again after the next handshake.
+    The outbox and this side's node id live in state_dir; a server passes its
+    own (see outbox.endpoint_state_dir) so it and a client on the same machine
+    don't share them.
+
+    reconnect, if given, is called to get a new transport to the same peer
+    when the link drops without the peer quitting (see reconnect.py). It is
+    passed the seconds left to reconnect in and should give up after that.
+
+    With heartbeat=True (the default) and a peer that supports it, the link
+    is pinged while idle and dropped when the peer stops answering (see
+    heartbeat.py).
+
+    With encryption on and decrypt_workers > 0 (default BTCHAT_DECRYPT_WORKERS),
+    received chat messages are decrypted on that many worker threads and
+    shown in arrival order (see decrypt_pool.py).
+    """
+
+    def __init__(self, transport, encryption=None, username="You", peer_name="Peer", codecs=None, outbox=True,
+                 reconnect=None, heartbeat=True, decrypt_workers=DECRYPT_WORKERS, state_dir=STATE_DIR):
+        self.transport = transport
+        self.codecs = codecs
+        self.use_outbox = outbox
+        self.state_dir = state_dir
+        self.node = node_id(state_dir) if outbox else None
+        self.reconnect = reconnect if RECONNECT else None
+        self.encryption = encryption if encryption and encryption.is_encrypted() else None
+        self.username = username
+        self.peer_name = peer_name
+        self.reader = None
+        self.writer = None
+        self.codec = None
+        self.transfers = None
+        self.closed = False
+        self.stdin = None
+        self.renderer = None
+        self.history = None
+        self.outbox = None
+        self.received = None
+        self.peer_node = None
+        self.version = LEGACY_VERSION          # Protocol version agreed with the peer
+        self.peer_max_frame = MAX_FRAME_SIZE   # Largest frame the peer accepts
+        self.metrics = ConnectionMetrics()
+        self.exporter = None
+        self.profiler = session_profiler()
+        self.heartbeat = Heartbeat() if heartbeat and HEARTBEAT_INTERVAL > 0 else None
+        self.decrypt_pool = None
+        if self.encryption and decrypt_workers > 0:
+            self.decrypt_pool = DecryptPool(self.wake, decrypt_workers)
+            if self.encryption.decrypt_time_lock is None:
+                self.encryption.decrypt_time_lock = threading.Lock()
+        self._heartbeat_on = False
+        self._history_cursor = None
+        self._awaiting_resume = False
+        self._ack_due = False
+        self._active = threading.Event()
+        self._stopped = threading.Event()
+        self._link_up = False
+        self._new_link = None
+        self._lost_at = None
+        self._said_quit = False
+        self._selector = None
+        self._input_lines = deque()
+        self._unsent = deque()      # (kind, parts) of messages waiting for queue space, oldest first
+        self._held = 0              # Newest outbox messages, typed while awaiting resume and never sent
+        self._stdin_watched = False
+        self._wake_recv, self._wake_send = socket.socketpair()
+        self._wake_send.setblocking(False)     # A full wake buffer already means "wake up"
+
+    @property
+    def running(self):
+        return self._active.is_set()
+
+    def start(self):
+        """Negotiate session settings with the peer. Must be called before run()"""
+        self._attach(self.transport, *self._handshake(self.transport))
+        self._active.set()
+
+    def _handshake(self, transport):
+        """Set up framing on a new link and negotiate with the peer. Touches no session state"""
+        writer = OutboundQueue(transport.sock)
+        reader = FrameReader(transport.sock)
+        settings = {}
+        if self.use_outbox:
+            settings.update(node=self.node, outbox=OUTBOX_VERSION)
+        if self.heartbeat is not None:
+            settings['heartbeat'] = HEARTBEAT_VERSION
+        try:
+            codec, peer = negotiate_codec(writer, reader, self.encryption, self.codecs, settings)
+            # Control frames skip ahead of queued data, so the HELLO has to be out first
+            writer.flush()
+        except BaseException:
+            writer.close(0)
+            raise
+        return writer, reader, codec, peer
+
+    def _attach(self, transport, writer, reader, codec, peer):
+        """Make a negotiated link the session's connection"""
+        self.transport, self.writer, self.reader, self.codec = transport, writer, reader, codec
+        self.version = peer_version(peer)
+        self.peer_max_frame = int(peer.get('max_frame', MAX_FRAME_SIZE))
+        self.transfers = FileTransferManager(writer, self.encryption, peer_name=self.peer_name)
+        writer.on_space = self.wake
+        self._link_up = True
+        self.metrics.link_up = True
+        self._heartbeat_on = self.heartbeat is not None and peer.get('heartbeat') == HEARTBEAT_VERSION
+        if self._heartbeat_on:
+            self.heartbeat.reset(time.monotonic_ns())
+        if self.profiler is not None:
+            self.profiler.instrument(self)
+        if self.use_outbox and peer.get('outbox') == OUTBOX_VERSION and peer.get('node'):
+            if peer['node'] == self.node:
+                # Both ends use the same state directory: their outboxes would overwrite each other
+                print(f"{Fore.YELLOW}⚠️  {self.peer_name} shares this side's state directory; outbox disabled. "
+                      f"Give one side its own BTCHAT_STATE_DIR.{Style.RESET_ALL}")
+            else:
+                self._open_outbox(peer['node'])
+
+    def _open_outbox(self, peer_node):
+        """Tell the peer what we have from it; our own backlog goes once it answers"""
+        if self.outbox is None or self.peer_node != peer_node:
+            if self.outbox is not None:
+                self.outbox.close()
+            self.outbox = Outbox(peer_node, self.state_dir)
+            self.received = self.received or ReceivedState(self.state_dir)
+            self.peer_node = peer_node
+        self._awaiting_resume = True
+        send_message(self.writer, MSG_CHAT_ACK, SEQ.pack(self.received.last_from(peer_node)),
+                     control=True, key=MSG_CHAT_ACK)
+
+    def run(self, interactive=True, input_stream=None):
+        """Chat until either side quits.
+
+        One selector multiplexes the connection, the terminal and a wake-up
+        socket, so a quit or disconnect on either end is handled at once.
+        With interactive=False lines are read from input_stream, if given,
+        without a renderer or line editing; otherwise the caller sends.
+        """
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self.transport.sock, selectors.EVENT_READ, self._on_readable)
+        self._selector.register(self._wake_recv, selectors.EVENT_READ, self._on_wake)
+        if METRICS_FILE and self.exporter is None:
+            self.exporter = MetricsExporter(self.collect_metrics)
+        if interactive:
+            store = open_history()
+            if store is not None:
+                self.history = HistoryWriter(store, SearchIndex(store))
+            self.renderer = Renderer()
+            self.renderer.capture()
+            self.stdin = StdinReader(self.wake, on_edit=self.renderer.set_input, on_redraw=self.renderer.redraw)
+            print(f"{Fore.GREEN}Chat started! Type your messages below.{Style.RESET_ALL}")
+            print(f"{Fore.YELLOW}Type 'quit' or 'exit' to close the connection.{Style.RESET_ALL}")
+            print(f"{Fore.YELLOW}Type '/send <path>' to send a file, '/stats' for connection stats, "
+                  f"'/ping' to measure the link.{Style.RESET_ALL}")
+            if self.history:
+                print(f"{Fore.YELLOW}Type '/history' to page back through earlier messages, "
+                      f"'/search <words>' to find one.{Style.RESET_ALL}")
+            print("-" * 50)
+        elif input_stream is not None:
+            self.stdin = StdinReader(self.wake, stream=input_stream)
+        if self.profiler is not None:
+            self.profiler.instrument(self)     # Again, now that the renderer exists
+            self.profiler.start()
+
+        try:
+            # Frames that arrived together with the handshake are already buffered
+            self._on_readable(recv=False)
+            while self.running:
+                self._process_input()
+                self._watch_stdin()
+                if self._input_lines or self._unsent:
+                    # Lines and messages left over wait for queue space (the writer wakes us
+                    # when it drains) or for the link to come back
+                    timeout = INPUT_RETRY if self.writer.full() or not self._link_up else 0
+                else:
+                    timeout = None
+                if self._heartbeat_on and self._link_up:
+                    due = self.heartbeat.time_left(time.monotonic_ns())
+                    timeout = due if timeout is None else min(timeout, due)
+                for key, _ in self._selector.select(timeout):
+                    key.data()
+                    if not self.running:
+                        break
+                if self._heartbeat_on and self._link_up and self.running:
+                    self._beat()
+        finally:
+            if self.decrypt_pool is not None:
+                self._deliver_decrypted(wait=True)
+            if self.profiler is not None:
+                self.profiler.stop()
+            self._selector.close()
+            self._selector = None
+            if self.stdin:
+                self.stdin.close()
+            if interactive:
+                self.renderer.close()
+
+    def stop(self):
+        """Ask the session to end. Safe to call from any thread"""
+        self._stopped.set()
+        self._active.clear()
+        self.wake()
+
+    def wake(self):
+        """Interrupt the session loop's wait"""
+        try:
+            self._wake_send.send(b'\0')
+        except OSError:
+            pass
+
+    def _on_wake(self):
+        try:
+            self._wake_recv.recv(4096)
+        except OSError:
+            pass
+        if self.stdin and self.stdin.fd is None:
+            self._input_lines.extend(self.stdin.take_lines())
+        if self.decrypt_pool is not None:
+            self._deliver_decrypted()
+        link, self._new_link = self._new_link, None
+        if link is not None and self.running:
+            self._resume(*link)
+
+    # Reconnecting
+
+    def _link_lost(self, message):
+        """The link dropped without the peer quitting: end the session or start reconnecting"""
+        if self.running:
+            print(f"{Fore.RED}{message}{Style.RESET_ALL}")
+        if self.reconnect is None or not self.running:
+            self._link_up = False
+            self._active.clear()
+            return
+        self._selector.unregister(self.transport.sock)
+        self._link_up = False
+        self.metrics.link_up = False
+        self._ack_due = False
+        self._awaiting_resume = self.outbox is not None
+        self._unsent.clear()        # The outbox resends them after the next handshake
+        self.transfers.close()
+        self.writer.close(0)
+        self.metrics.retire_writer(self.writer)
+        self.transport.close()
+        self._lost_at = time.monotonic()
+        if self.outbox is not None:
+            print(f"{Fore.YELLOW}Reconnecting... messages you type will be sent when the link is back.{Style.RESET_ALL}")
+        else:
+            print(f"{Fore.YELLOW}Reconnecting...{Style.RESET_ALL}")
+        threading.Thread(target=self._reconnect_loop, name='reconnect', daemon=True).start()
+
+    def _reconnect_loop(self):
+        """Get a new link to the peer and hand it to the session loop"""
+        backoff = Backoff()
+        deadline = time.monotonic() + RECONNECT_TIMEOUT
+        while self.running and time.monotonic() < deadline:
+            if self._stopped.wait(backoff.next_delay()):
+                return
+            try:
+                transport = self.reconnect(max(0.0, deadline - time.monotonic()))
+            except OSError:     # Including socket.timeout: a server that saw no one come back
+                continue
+            if self._stopped.is_set():
+                transport.close()
+                return
+            try:
+                link = self._handshake(transport)
+            except OSError:
+                transport.close()
+                continue
+            if self._stopped.is_set():
+                link[0].close(0)
+                transport.close()
+                return
+            self._new_link = (transport,) + link
+            self.wake()
+            return
+        if self.running:
+            print(f"{Fore.RED}Could not reconnect to {self.peer_name.lower()}.{Style.RESET_ALL}")
+            self.stop()
+
+    def _resume(self, transport, writer, reader, codec, peer):
+        """Continue the conversation on a new link"""
+        self._attach(transport, writer, reader, codec, peer)
+        self.metrics.reconnects += 1
+        self._selector.register(transport.sock, selectors.EVENT_READ, self._on_readable)
+        elapsed = (time.monotonic() - self._lost_at) * 1000
+        print(f"{Fore.GREEN}✓ Reconnected to {self.peer_name.lower()} in {elapsed:.0f} ms{Style.RESET_ALL}")
+        self._on_readable(recv=False)
+
+    # Receiving
+
+    def _on_readable(self, recv=True):
+        """Read what the connection has available and handle complete messages"""
+        try:
+            if recv and self.reader.recv_once() == 0:
+                self._link_lost(f"Connection closed by {self.peer_name.lower()}.")
+                return
+            if self._heartbeat_on:
+                self.heartbeat.heard(time.monotonic_ns())
+            self._receive_buffered()
+            self._send_ack()
+        except OSError:
+            self._link_lost("Connection lost.")
+        except Exception as e:
+            print(f"{Fore.RED}Error receiving message: {e}{Style.RESET_ALL}")
+            self._active.clear()
+
+    def _receive_buffered(self):
+        pool = self.decrypt_pool
+        while self.running:
+            if pool is not None and pool.full():
+                # Stop reading until the oldest message is decrypted
+                pool.wait_oldest()
+                self._deliver_decrypted()
+            payload = self.reader.next_frame()
+            if payload is None:
+                break
+            if not self.handle_payload(payload):
+                return
+        if pool is not None:
+            self._deliver_decrypted()
+
+    def handle_payload(self, payload):
+        """Act on one message from the peer. Returns False when the session should end"""
+        self.metrics.bytes_in += HEADER.size + len(payload)
+        kind, body = unpack_message(payload)
+        if kind in FILE_MESSAGES:
+            self.transfers.handle_message(kind, body)
+            return True
+        if kind == MSG_CHAT_ACK:
+            self._on_chat_ack(SEQ.unpack_from(body)[0])
+            return True
+        if kind == MSG_PING:
+            send_message(self.writer, MSG_PONG, body, control=True)
+            return True
+        if kind == MSG_PONG:
+            self._on_pong(body)
+            return True
+        if kind == MSG_CONTROL:
+            return self._on_control(body)
+        if kind == MSG_CHAT_SEQ:
+            seq = SEQ.unpack_from(body)[0]
+            body = body[SEQ.size:]
+            if self.received is not None:
+                self._ack_due = True
+                if not self.received.accept(self.peer_node, seq):
+                    return True     # Already delivered before a reconnect
+        elif kind != MSG_CHAT:
+            return True
+
+        if self.version == LEGACY_VERSION:
+            # Older peers leave by sending "quit" as plaintext chat
+            message = self.codec.plaintext(body)
+            if message is not None and message.strip().lower() in LEGACY_QUIT:
+                return self._peer_left()
+
+        if self.decrypt_pool is not None:
+            self.decrypt_pool.submit(self.codec.decode, body)
+            return True
+
+        # Decompress and decrypt the message
+        try:
+            message = self.codec.decode(body)
+        except DecodeError as e:
+            self._decode_failed(e)
+            return True
+        self.deliver(message)
+        return True
+
+    def deliver(self, message):
+        """Count, store and show a decoded message from the peer"""
+        self.metrics.messages_in += 1
+        self.record(DIRECTION_IN, message)
+        self.show_incoming(message)
+
+    def _decode_failed(self, error):
+        self.metrics.decode_errors += 1
+        print(f"{Fore.RED}Failed to decode message from {self.peer_name.lower()}: {error}{Style.RESET_ALL}")
+
+    def _deliver_decrypted(self, wait=False):
+        """Show the messages the decrypt pool has finished, in arrival order. wait=True waits for all"""
+        for message, error in self.decrypt_pool.ready(wait):
+            if error is None:
+                self.deliver(message)
+            elif isinstance(error, DecodeError):
+                self._decode_failed(error)
+            else:
+                raise error
+
+    def _on_control(self, body):
+        """Act on a CONTROL message. Returns False when the session should end"""
+        (code,) = CONTROL.unpack_from(body)
+        if code == CONTROL_BYE:
+            return self._peer_left()
+        return True     # A control code from a newer version
+
+    def _peer_left(self):
+        if self.decrypt_pool is not None:
+            self._deliver_decrypted(wait=True)     # Show what the peer said before leaving
+        print(f"{Fore.RED}{self.peer_name} disconnected.{Style.RESET_ALL}")
+        self._said_quit = True
+        self._active.clear()
+        return False
+
+    def _on_chat_ack(self, seq):
+        if self.outbox is None:
+            return
+        if not self._awaiting_resume:
+            self.outbox.acknowledge(seq)
+            return
+        # First acknowledgement after the handshake: resend what the peer missed,
+        # then what was typed meanwhile, as queue space allows (see _process_input)
+        self._awaiting_resume = False
+        backlog = self.outbox.resume(seq)
+        self._unsent.extend((MSG_CHAT_SEQ, (SEQ.pack(seq), body)) for seq, body in backlog)
+        self._held = min(self._held, len(backlog))
+        resent = len(backlog) - self._held
+        if resent:
+            self.display(f"{Fore.CYAN}Resending {resent} unacknowledged message(s).{Style.RESET_ALL}")
+
+    # Heartbeat
+
+    def _beat(self):
+        """Send a ping if one is due, or drop the link if the peer stopped answering"""
+        body = self.heartbeat.tick(time.monotonic_ns())
+        if body is None:
+            return
+        if self.heartbeat.missed:
+            self.metrics.heartbeat_misses += 1
+        if self.heartbeat.dead():
+            silent = self.heartbeat.missed * self.heartbeat.interval_ns / 1e9
+            self._link_lost(f"No answer from {self.peer_name.lower()} for {silent:g}s - the link is dead.")
+            return
+        try:
+            send_message(self.writer, MSG_PING, body, control=True)
+        except OSError:
+            self._link_lost("Connection lost.")
+
+    def _on_pong(self, body):
+        if self.heartbeat is None:
+            return
+        rtt, requested = self.heartbeat.pong(body, time.monotonic_ns())
+        self.metrics.rtt.observe(rtt)
+        if requested:
+            self.display(f"{Fore.CYAN}Pong from {self.peer_name.lower()} in {rtt / 1e6:.1f} ms "
+                         f"({self.heartbeat.summary()}){Style.RESET_ALL}")
+
+    def ping(self):
+        """Measure the round trip to the peer now; the answer is shown when it arrives"""
+        if not self._heartbeat_on:
+            reason = "heartbeats are off" if self.heartbeat is None else f"{self.peer_name} doesn't answer pings"
+            self.display(f"{Fore.YELLOW}Can't ping: {reason}.{Style.RESET_ALL}")
+            return
+        if not self._link_up:
+            self.display(f"{Fore.YELLOW}Not connected - try again once the link is back.{Style.RESET_ALL}")
+            return
+        send_message(self.writer, MSG_PING, self.heartbeat.ping(time.monotonic_ns(), requested=True), control=True)
+
+    def _send_ack(self):
+        """Acknowledge everything received in the last read with one message"""
+        if self._ack_due and self.running:
+            self._ack_due = False
+            send_message(self.writer, MSG_CHAT_ACK, SEQ.pack(self.received.last_from(self.peer_node)),
+                         control=True, key=MSG_CHAT_ACK)
+            self.received.save()
+
+    def display(self, line):
+        """Hand a line of output to the renderer"""
+        if self.renderer:
+            self.renderer.line(line)
+        else:
+            print(line)
+
+    def show_incoming(self, message):
+        """Display a message from the peer"""
+        if self.encryption:
+            self.display(f"{Fore.BLUE}{self.peer_name}: {message} {Fore.GREEN}🔒{Style.RESET_ALL}")
+        else:
+            self.display(f"{Fore.BLUE}{self.peer_name}: {message}{Style.RESET_ALL}")
+
+    # Sending
+
+    def _watch_stdin(self):
+        """Read the terminal only while earlier lines are not waiting for queue space"""
+        if not self.stdin or self.stdin.fd is None:
+            return
+        wanted = not self._input_lines and not self.stdin.eof
+        if self.stdin.regular:
+            while not self._input_lines and not self.stdin.eof:
+                self._on_stdin()
+            return
+        if wanted != self._stdin_watched:
+            if wanted:
+                try:
+                    self._selector.register(self.stdin.fd, selectors.EVENT_READ, self._on_stdin)
+                except PermissionError:
+                    # epoll refuses files that are always readable
+                    self.stdin.regular = True
+                    return self._watch_stdin()
+            else:
+                self._selector.unregister(self.stdin.fd)
+            self._stdin_watched = wanted
+
+    def _on_stdin(self):
+        self._input_lines.extend(self.stdin.read_lines())
+
+    def _process_input(self):
+        """Send what is waiting for queue space, then handle typed lines, pausing while the send queue is full"""
+        if self._unsent and self._link_up:
+            self._send_backlog()
+        lines = self._input_lines
+        # Lines wait behind the backlog, so the peer gets sequence numbers in order
+        while lines and self.running and not self._unsent:
+            # Outbox messages are never dropped, so they wait for space under every policy
+            if (self.outbox is not None or self.writer.policy != 'drop') and self.writer.full():
+                break
+            try:
+                if not self.handle_input(lines.popleft()):
+                    lines.clear()
+            except OSError:
+                print(f"{Fore.RED}Connection lost.{Style.RESET_ALL}")
+                self._active.clear()
+            except Exception as e:
+                print(f"{Fore.RED}Error sending message: {e}{Style.RESET_ALL}")
+        if self.outbox is not None:
+            self.outbox.flush()
+
+    def _send_backlog(self):
+        """Send messages that found the queue full, as far as space allows without waiting"""
+        try:
+            while self._unsent:
+                kind, parts = self._unsent[0]
+                if not send_message(self.writer, kind, *parts, wait=False):
+                    break
+                if len(self._unsent) <= self._held:
+                    self._held -= 1
+                self._unsent.popleft()
+        except OSError:
+            self._link_lost("Connection lost.")
+
+    def handle_input(self, line):
+        """Act on one line of user input. Returns False when the session should end"""
+        if line.lower() in QUIT_COMMANDS:
+            self.quit()
+            return False
+
+        if line.startswith('/send ') and not self._link_up:
+            self.display(f"{Fore.YELLOW}Not connected - try again once the link is back.{Style.RESET_ALL}")
+            return True
+
+        if line.startswith('/send '):
+            # Transfers wait for the peer's replies, which arrive through this loop
+            sender = threading.Thread(target=self.transfers.send_file, args=(line[len('/send '):],),
+                                      name='file-sender', daemon=True)
+            sender.start()
+            return True
+
+        if line.strip() == '/history':
+            self.show_history()
+            return True
+
+        if line.startswith('/search '):
+            self.show_search(line[len('/search '):])
+            return True
+
+        if line.strip() == '/stats':
+            self.show_stats()
+            return True
+
+        if line.strip() == '/ping':
+            self.ping()
+            return True
+
+        if line.strip():  # Only send non-empty messages
+            self.send_chat(line)
+        return True
+
+    def quit(self):
+        """End the session and tell the peer, so it doesn't try to reconnect"""
+        self._say_bye()
+        self._said_quit = True
+        self._active.clear()
+
+    def _say_bye(self):
+        """Give waiting messages up to BYE_TIMEOUT to go out, then send BYE ahead of anything left"""
+        deadline = time.monotonic() + BYE_TIMEOUT
+        while self._link_up:
+            self._send_backlog()
+            if not self.writer.flush(max(0.0, deadline - time.monotonic())) or not self._unsent:
+                break
+        if self._link_up:
+            send_bye(self.writer, self.version, self.codec, control=True)
+
+    def send_chat(self, text, echo=True, wait=False):
+        """Compress, encrypt and queue a chat message. False if it was dropped
+
+        The session loop must not wait for queue space, so by default a message
+        that finds the queue full is kept and sent by a later pass of the loop.
+        wait=True waits for space instead, for callers on other threads.
+        """
+        if not self._link_up and self.outbox is None:
+            self.display(f"{Fore.YELLOW}⚠️  Not connected - message not sent{Style.RESET_ALL}")
+            return False
+        body = self.codec.encode(text)
+        if 1 + SEQ.size + len(body) > self.peer_max_frame:
+            self.display(f"{Fore.YELLOW}⚠️  Message too long for {self.peer_name.lower()} "
+                         f"({format_size(len(body))}) - not sent{Style.RESET_ALL}")
+            return False
+        if self.outbox is not None:
+            # Lines still queued behind this one are flushed together by _process_input
+            seq = self.outbox.add(body, flush=not self._input_lines)
+            if self._awaiting_resume:
+                self._held += 1
+            elif self._unsent or not send_message(self.writer, MSG_CHAT_SEQ, SEQ.pack(seq), body, wait=wait):
+                self._unsent.append((MSG_CHAT_SEQ, (SEQ.pack(seq), body)))
+                self._held += 1
+        elif self._unsent or not send_message(self.writer, MSG_CHAT, body, droppable=True, wait=wait):
+            if self.writer.policy == 'drop':
+                print(f"{Fore.YELLOW}⚠️  Message dropped - send queue is full{Style.RESET_ALL}")
+                return False
+            self._unsent.append((MSG_CHAT, (body,)))
+        self.metrics.messages_out += 1
+        self.record(DIRECTION_OUT, text)
+        if echo:
+            self.show_outgoing(text)
+        return True
+
+    def show_outgoing(self, message):
+        """Display a sent message in place of the typed line"""
+        # When the terminal echoed the line itself, move up and overwrite it
+        prefix = '\033[F' if self.stdin and not self.stdin.editing and self.stdin.stream.isatty() else ''
+        if self.encryption:
+            self.display(f"{prefix}{Fore.GREEN}{self.username}: {message} {Fore.GREEN}🔒{Style.RESET_ALL}")
+        else:
+            self.display(f"{prefix}{Fore.GREEN}{self.username}: {message}{Style.RESET_ALL}")
+
+    # Metrics
+
+    def collect_metrics(self):
+        """This session's metrics snapshot and the labels identifying it"""
+        snapshot = self.metrics.snapshot(self.writer, self.encryption)
+        return snapshot, {'peer': self.transport.peer_address(), 'role': self.username.lower()}
+
+    def show_stats(self):
+        """Show the connection metrics"""
+        stats, _ = self.collect_metrics()
+        uptime = int(stats['uptime_seconds'])
+        link = "up" if stats['link_up'] else "down"
+        self.display(f"{Fore.CYAN}── Connection stats ──{Style.RESET_ALL}")
+        self.display(f"{Fore.CYAN}Uptime {uptime // 3600}h {uptime // 60 % 60:02d}m {uptime % 60:02d}s, "
+                     f"link {link}, {stats['reconnects']} reconnect(s){Style.RESET_ALL}")
+        self.display(f"{Fore.CYAN}Messages: {stats['messages_in']} in, {stats['messages_out']} out; "
+                     f"{format_size(stats['bytes_in'])} in, {format_size(stats['bytes_out'])} out; "
+                     f"{stats['decode_errors']} decode error(s){Style.RESET_ALL}")
+        self.display(f"{Fore.CYAN}Send queue: waited {stats['send_queue_wait_seconds'] * 1000:.0f} ms "
+                     f"({stats['send_queue_full_events']} time(s) full), depth {stats['send_queue_depth']}, "
+                     f"dropped {stats['send_queue_dropped']}{Style.RESET_ALL}")
+        if self._heartbeat_on:
+            self.display(f"{Fore.CYAN}Round trip: {self.heartbeat.summary()}; "
+                         f"{stats['heartbeat_misses']} missed ping(s){Style.RESET_ALL}")
+        if self.encryption:
+            self.display(f"{Fore.CYAN}Encrypt: {self.encryption.encrypt_time.summary()}{Style.RESET_ALL}")
+            self.display(f"{Fore.CYAN}Decrypt: {self.encryption.decrypt_time.summary()}{Style.RESET_ALL}")
+        if self.decrypt_pool is not None:
+            pool = self.decrypt_pool
+            self.display(f"{Fore.CYAN}Decrypt pool: {pool.workers} worker(s), {len(pool)} in flight "
+                         f"(max {pool.max_depth} of {pool.depth}){Style.RESET_ALL}")
+
+    def print_profile(self):
+        """Report the stage timings (and cProfile/tracemalloc results) of a profiled session"""
+        report = self.profiler.report()
+        print(f"{Fore.CYAN}{report.rstrip()}{Style.RESET_ALL}")
+        try:
+            path = self.profiler.write(report)
+        except OSError as e:
+            print(f"{Fore.RED}Could not write the profile: {e}{Style.RESET_ALL}")
+            return
+        if path:
+            print(f"{Fore.GREEN}Profile written to {path}{Style.RESET_ALL}")
+
+    # History
+
+    def record(self, direction, text):
+        """Store a message in the history log, if enabled"""
+        if self.history:
+            self.history.record(direction, self.transport.peer_address(), text,
+                                FLAG_ENCRYPTED if self.encryption else 0)
+            self._history_cursor = None
+
+    def show_history(self):
+        """Show the page of stored messages before the one shown last"""
+        if not self.history:
+            self.display(f"{Fore.YELLOW}History is off. Set BTCHAT_HISTORY_DIR to keep messages.{Style.RESET_ALL}")
+            return
+        self.history.flush(1.0)
+        store = self.history.store
+        end = len(store) if self._history_cursor is None else self._history_cursor
+        records = store.page(end)
+        if not records:
+            self.display(f"{Fore.YELLOW}No earlier messages.{Style.RESET_ALL}")
+            return
+        self._history_cursor = end - len(records)
+        self.display(f"{Fore.CYAN}── History {self._history_cursor + 1}-{end} of {len(store)} ──{Style.RESET_ALL}")
+        for record in records:
+            self.display(format_record(record))
+
+    def show_search(self, query):
+        """Show the newest stored messages matching query"""
+        if not self.history:
+            self.display(f"{Fore.YELLOW}History is off. Set BTCHAT_HISTORY_DIR to keep messages.{Style.RESET_ALL}")
+            return
+        self.history.flush(1.0)
+        started = time.perf_counter()
+        numbers = self.history.search.search(query)
+        elapsed = time.perf_counter() - started
+        for number in reversed(numbers):
+            self.display(format_record(self.history.store.get(number)))
+        self.display(f"{Fore.CYAN}{len(numbers)} result(s) for '{query.strip()}' "
+                     f"in {elapsed * 1000:.1f} ms{Style.RESET_ALL}")
+
+    def close(self):
+        """Flush pending output, report session stats and close the transport"""
+        if self.closed:
+            return
+        self.closed = True
+        self._stopped.set()
+        self._active.clear()
+        if self._link_up and not self._said_quit:
+            # Leaving without typing quit (Ctrl+C): tell the peer so it doesn't reconnect
+            try:
+                self._say_bye()
+            except OSError:
+                pass
+        if self._new_link is not None:
+            self._new_link[1].close(0)
+            self._new_link[0].close()
+        if self.transfers:
+            self.transfers.close()
+        if self.decrypt_pool is not None:
+            self.decrypt_pool.close()
+        if self.codec:
+            print_compression_stats(self.codec.compressor)
+        if self.writer and self.writer.close():
+            print_send_queue_stats(self.writer)
+        if self.profiler is not None:
+            self.print_profile()
+        if self.history:
+            self.history.close()
+        if self.exporter is not None:
+            self.metrics.link_up = False
+            self.exporter.close()
+        if self.outbox is not None:
+            if len(self.outbox):
+                print(f"{Fore.YELLOW}{len(self.outbox)} message(s) not yet acknowledged; "
+                      f"they will be resent on the next connection.{Style.RESET_ALL}")
+            self.outbox.close()
+        if self.received is not None:
+            self.received.save(force=True)
+        self.transport.close()
+        self._wake_recv.close()
+        self._wake_send.close()
+
+class HeadlessSession(ChatSession):
+    """A session driven by a script instead of a person (see headless.py).
+
+    Each line of the input stream is sent as a message and nothing is echoed.
+    Received messages are written to output as one JSON object per line.
+    Unless keep_open is set, the session quits once the input has ended and
+    the peer has everything that was sent.
+    """
+
+    def __init__(self, transport, encryption=None, output=None, keep_open=False, **kwargs):
+        super().__init__(transport, encryption, **kwargs)
+        self.output = output or sys.stdout
+        self.keep_open = keep_open
+
+    def run(self, input_stream=None):
+        super().run(interactive=False, input_stream=input_stream)
+
+    def _receive_buffered(self):
+        try:
+            super()._receive_buffered()
+        finally:
+            self._flush_output()
+
+    def _deliver_decrypted(self, wait=False):
+        super()._deliver_decrypted(wait)
+        self._flush_output()
+
+    def _flush_output(self):
+        try:
+            self.output.flush()
+        except BrokenPipeError:
+            print(f"{Fore.YELLOW}Output closed - ending the session.{Style.RESET_ALL}", file=sys.stderr)
+            self._active.clear()
+
+    def _process_input(self):
+        if not self._link_up:
+            return      # Hold lines until the link is back instead of dropping them
+        super()._process_input()
+        self._quit_if_done()
+
+    def _watch_stdin(self):
+        super()._watch_stdin()
+        # A regular file's end is found here, after the input was processed;
+        # nothing else may wake the loop (a relay sends no acknowledgements)
+        if self._quit_if_done():
+            self.wake()
+
+    def _quit_if_done(self):
+        """Quit once the input has ended and the peer has everything. True if it did"""
+        if self.running and not self.keep_open and self._input_done() and self._delivered():
+            self.quit()
+            return True
+        return False
+
+    def handle_input(self, line):
+        # Every input line is data. Only peers that leave on a plaintext "quit" need it kept back
+        if line.lower() in QUIT_COMMANDS and (self.version > LEGACY_VERSION or self.encryption):
+            self.send_chat(line)
+            return True
+        return super().handle_input(line)
+
+    def _input_done(self):
+        # The helper thread (no fd) may have lines the loop hasn't taken yet
+        return self.stdin is not None and self.stdin.exhausted() and not self._input_lines
+
+    def _delivered(self):
+        """True once nothing sent is waiting for the peer"""
+        if self.transfers.outgoing or self._awaiting_resume or self._unsent:
+            return False
+        return self.outbox is None or not len(self.outbox)
+
+    def display(self, line):
+        print(line, file=sys.stderr)
+
+    def show_incoming(self, message):
+        record = {'time': round(time.time(), 6), 'from': self.peer_name,
+                  'peer': self.transport.peer_address(), 'text': message,
+                  'encrypted': self.encryption is not None}
+        try:
+            self.output.write(JSON_ENCODER.encode(record) + '\n')
+        except BrokenPipeError:
+            self._active.clear()
+
+    def show_outgoing(self, message):
+        pass
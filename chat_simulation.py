@@ -5,77 +5,86 @@ A simulation version of the Bluetooth chat for testing purposes when PyBluez is
 This uses standard sockets over localhost to simulate the Bluetooth communication.
 """
 
-import socket
-import threading
+import argparse
 import sys
 from colorama import init, Fore, Style
-from encryption import ChatEncryption, get_chat_password
+from encryption import ChatEncryption
+from headless import add_arguments as add_headless_arguments, chat_password, headless_config
+import profiling
+from reconnect import CONNECT_TIMEOUT
 
-# Initialize colorama for Windows compatibility
-init()
+# The chat engine, the asyncio relay and the benchmark are imported by the
+# modes that use them, so the usage screen and the password prompt come up fast
+
+# Fixed address for the simulation
+SIM_HOST = 'localhost'
+SIM_PORT = 12345
 
 class BluetoothChatSimServer:
-    def __init__(self):
-        self.server_socket = None
-        self.client_socket = None
+    def __init__(self, unix_path=None, host=SIM_HOST, port=SIM_PORT, options=None, headless=None):
+        self.listener = None
+        self.session = None
         self.client_info = None
-        self.running = False
         self.username = "Server"
         self.encryption = None
+        self.unix_path = unix_path
+        self.host = host
+        self.port = port
+        self.options = options
+        self.headless = headless
         
     def start_server(self):
         """Start the simulation server"""
         # Setup encryption
-        password = get_chat_password()
+        password = self.headless.password if self.headless else chat_password(self.options)
         if password:
             self.encryption = ChatEncryption(password)
             print(f"{Fore.GREEN}🔒 Encryption enabled{Style.RESET_ALL}")
         else:
             print(f"{Fore.YELLOW}⚠️  No encryption - messages will be sent in plaintext{Style.RESET_ALL}")
         
+        from chat_engine import ChatSession
+        from outbox import endpoint_state_dir
+        from transport import TCPTransport, UnixTransport
+        
         try:
-            # Create a TCP socket (simulating Bluetooth RFCOMM)
-            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            
-            # Bind to localhost
-            host = 'localhost'
-            port = 12345  # Fixed port for simulation
-            self.server_socket.bind((host, port))
+            # Listen on TCP (simulating Bluetooth RFCOMM) or a Unix domain socket
+            if self.unix_path:
+                self.listener = UnixTransport.listen(self.unix_path)
+                address = self.unix_path
+                note = "Unix domain sockets"
+            else:
+                self.listener = TCPTransport.listen(self.host, self.port)
+                address = f"{self.host}:{self.port}"
+                note = "TCP sockets"
+            # Separate outbox state from a client on the same machine
+            state_dir = endpoint_state_dir(f"server-{address}")
             
             print(f"{Fore.CYAN}Starting Bluetooth Chat Server Simulation...{Style.RESET_ALL}")
-            print(f"{Fore.YELLOW}Simulation Address: {host}:{port}{Style.RESET_ALL}")
-            print(f"{Fore.MAGENTA}Note: This is a simulation using TCP sockets{Style.RESET_ALL}")
-            
-            # Listen for incoming connections
-            self.server_socket.listen(1)
-            print(f"{Fore.GREEN}Server listening on {host}:{port}...{Style.RESET_ALL}")
+            print(f"{Fore.YELLOW}Simulation Address: {address}{Style.RESET_ALL}")
+            print(f"{Fore.MAGENTA}Note: This is a simulation using {note}{Style.RESET_ALL}")
+            print(f"{Fore.GREEN}Server listening on {address}...{Style.RESET_ALL}")
             print(f"{Fore.MAGENTA}Waiting for client connection...{Style.RESET_ALL}")
             
             # Accept incoming connection
-            self.client_socket, self.client_info = self.server_socket.accept()
+            transport = self.listener.accept()
+            self.client_info = transport.peer or address
+            if self.headless:
+                self.session = self.headless.make_session(transport, self.encryption, username=self.username,
+                                                          peer_name="Client", reconnect=self.listener.accept,
+                                                          state_dir=state_dir)
+            else:
+                self.session = ChatSession(transport, self.encryption, username=self.username, peer_name="Client",
+                                           reconnect=self.listener.accept, state_dir=state_dir)
+            self.session.start()
             print(f"{Fore.GREEN}✓ Connected to {self.client_info}{Style.RESET_ALL}")
+            print(f"{Fore.CYAN}Compression: {self.session.codec.compressor.describe()}{Style.RESET_ALL}")
             
-            self.running = True
-            
-            # Start threads for sending and receiving messages
-            receive_thread = threading.Thread(target=self.receive_messages)
-            send_thread = threading.Thread(target=self.send_messages)
-            
-            receive_thread.daemon = True
-            send_thread.daemon = True
-            
-            receive_thread.start()
-            send_thread.start()
-            
-            print(f"{Fore.GREEN}Chat started! Type your messages below.{Style.RESET_ALL}")
-            print(f"{Fore.YELLOW}Type 'quit' or 'exit' to close the connection.{Style.RESET_ALL}")
-            print("-" * 50)
-            
-            # Keep main thread alive
             try:
-                while self.running:
-                    threading.Event().wait(1)
+                if self.headless:
+                    self.headless.run(self.session)
+                else:
+                    self.session.run()
             except KeyboardInterrupt:
                 self.stop_server()
                 
@@ -83,255 +92,190 @@ class BluetoothChatSimServer:
             print(f"{Fore.RED}Error: {e}{Style.RESET_ALL}")
         finally:
             self.cleanup()
-            
-    def receive_messages(self):
-        """Receive messages from the client"""
-        while self.running:
-            try:
-                data = self.client_socket.recv(1024)
-                if not data:
-                    break
-                    
-                message = data.decode('utf-8').strip()
-                if message.lower() in ['quit', 'exit']:
-                    print(f"{Fore.RED}Client disconnected.{Style.RESET_ALL}")
-                    self.running = False
-                    break
-                
-                # Decrypt message if encryption is enabled
-                if self.encryption and self.encryption.is_encrypted():
-                    try:
-                        decrypted_message = self.encryption.decrypt_message(message)
-                        print(f"{Fore.BLUE}Client: {decrypted_message} {Fore.GREEN}🔒{Style.RESET_ALL}")
-                    except Exception as e:
-                        print(f"{Fore.RED}Failed to decrypt message from client{Style.RESET_ALL}")
-                        print(f"{Fore.BLUE}Client (encrypted): {message[:50]}...{Style.RESET_ALL}")
-                else:
-                    print(f"{Fore.BLUE}Client: {message}{Style.RESET_ALL}")
-                
-            except socket.error:
-                print(f"{Fore.RED}Connection lost.{Style.RESET_ALL}")
-                self.running = False
-                break
-            except Exception as e:
-                print(f"{Fore.RED}Error receiving message: {e}{Style.RESET_ALL}")
-                break
-                
-    def send_messages(self):
-        """Send messages to the client"""
-        while self.running:
-            try:
-                message = input()
-                if not self.running:
-                    break
-                    
-                if message.lower() in ['quit', 'exit']:
-                    self.client_socket.send(message.encode('utf-8'))
-                    self.running = False
-                    break
-                    
-                if message.strip():  # Only send non-empty messages
-                    # Encrypt message if encryption is enabled
-                    if self.encryption and self.encryption.is_encrypted():
-                        encrypted_message = self.encryption.encrypt_message(message)
-                        self.client_socket.send(encrypted_message.encode('utf-8'))
-                        print(f"\033[F{Fore.GREEN}{self.username}: {message} {Fore.GREEN}🔒{Style.RESET_ALL}")
-                    else:
-                        self.client_socket.send(message.encode('utf-8'))
-                        print(f"\033[F{Fore.GREEN}{self.username}: {message}{Style.RESET_ALL}")
-                    
-            except socket.error:
-                print(f"{Fore.RED}Connection lost.{Style.RESET_ALL}")
-                self.running = False
-                break
-            except KeyboardInterrupt:
-                self.running = False
-                break
-            except Exception as e:
-                print(f"{Fore.RED}Error sending message: {e}{Style.RESET_ALL}")
-                break
                 
     def stop_server(self):
         """Stop the server and close connections"""
-        self.running = False
+        if self.session:
+            self.session.stop()
         print(f"\n{Fore.YELLOW}Shutting down server...{Style.RESET_ALL}")
         
     def cleanup(self):
         """Clean up resources"""
-        if self.client_socket:
-            try:
-                self.client_socket.close()
-            except:
-                pass
-                
-        if self.server_socket:
-            try:
-                self.server_socket.close()
-            except:
-                pass
+        if self.session:
+            self.session.close()
+        if self.listener:
+            self.listener.close()
 
 class BluetoothChatSimClient:
-    def __init__(self):
-        self.client_socket = None
-        self.running = False
+    def __init__(self, unix_path=None, host=SIM_HOST, port=SIM_PORT, options=None, headless=None):
+        self.session = None
         self.username = "Client"
         self.encryption = None
+        self.unix_path = unix_path
+        self.host = host
+        self.port = port
+        self.options = options
+        self.headless = headless
         
     def connect_to_server(self):
         """Connect to the simulation server"""
         # Setup encryption
-        password = get_chat_password()
+        password = self.headless.password if self.headless else chat_password(self.options)
         if password:
             self.encryption = ChatEncryption(password)
             print(f"{Fore.GREEN}🔒 Encryption enabled{Style.RESET_ALL}")
         else:
             print(f"{Fore.YELLOW}⚠️  No encryption - messages will be sent in plaintext{Style.RESET_ALL}")
         
+        from chat_engine import ChatSession
+        from transport import TCPTransport, UnixTransport
+        
         try:
-            host = 'localhost'
-            port = 12345
-            
-            print(f"{Fore.CYAN}Connecting to simulation server at {host}:{port}...{Style.RESET_ALL}")
-            print(f"{Fore.MAGENTA}Note: This is a simulation using TCP sockets{Style.RESET_ALL}")
+            if self.unix_path:
+                print(f"{Fore.CYAN}Connecting to simulation server at {self.unix_path}...{Style.RESET_ALL}")
+                print(f"{Fore.MAGENTA}Note: This is a simulation using Unix domain sockets{Style.RESET_ALL}")
+                transport = UnixTransport.connect(self.unix_path)
+            else:
+                print(f"{Fore.CYAN}Connecting to simulation server at {self.host}:{self.port}...{Style.RESET_ALL}")
+                print(f"{Fore.MAGENTA}Note: This is a simulation using TCP sockets{Style.RESET_ALL}")
+                transport = TCPTransport.connect(self.host, self.port)
             
-            # Create a TCP socket (simulating Bluetooth RFCOMM)
-            self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.client_socket.connect((host, port))
+            if self.headless:
+                self.session = self.headless.make_session(transport, self.encryption, username=self.username,
+                                                          peer_name="Server", reconnect=self.reconnect)
+            else:
+                self.session = ChatSession(transport, self.encryption, username=self.username, peer_name="Server",
+                                           reconnect=self.reconnect)
+            self.session.start()
             
             print(f"{Fore.GREEN}✓ Connected to server!{Style.RESET_ALL}")
-            self.running = True
-            
-            # Start threads for sending and receiving messages
-            receive_thread = threading.Thread(target=self.receive_messages)
-            send_thread = threading.Thread(target=self.send_messages)
-            
-            receive_thread.daemon = True
-            send_thread.daemon = True
+            print(f"{Fore.CYAN}Compression: {self.session.codec.compressor.describe()}{Style.RESET_ALL}")
             
-            receive_thread.start()
-            send_thread.start()
-            
-            print(f"{Fore.GREEN}Chat started! Type your messages below.{Style.RESET_ALL}")
-            print(f"{Fore.YELLOW}Type 'quit' or 'exit' to close the connection.{Style.RESET_ALL}")
-            print("-" * 50)
-            
-            # Keep main thread alive
             try:
-                while self.running:
-                    threading.Event().wait(1)
+                if self.headless:
+                    self.headless.run(self.session)
+                else:
+                    self.session.run()
             except KeyboardInterrupt:
                 self.disconnect()
                 
-        except ConnectionRefusedError:
+        except (ConnectionRefusedError, FileNotFoundError):
             print(f"{Fore.RED}Connection refused. Make sure the server is running first.{Style.RESET_ALL}")
         except Exception as e:
             print(f"{Fore.RED}Error: {e}{Style.RESET_ALL}")
         finally:
             self.cleanup()
-            
-    def receive_messages(self):
-        """Receive messages from the server"""
-        while self.running:
-            try:
-                data = self.client_socket.recv(1024)
-                if not data:
-                    break
-                    
-                message = data.decode('utf-8').strip()
-                if message.lower() in ['quit', 'exit']:
-                    print(f"{Fore.RED}Server disconnected.{Style.RESET_ALL}")
-                    self.running = False
-                    break
-                
-                # Decrypt message if encryption is enabled
-                if self.encryption and self.encryption.is_encrypted():
-                    try:
-                        decrypted_message = self.encryption.decrypt_message(message)
-                        print(f"{Fore.BLUE}Server: {decrypted_message} {Fore.GREEN}🔒{Style.RESET_ALL}")
-                    except Exception as e:
-                        print(f"{Fore.RED}Failed to decrypt message from server{Style.RESET_ALL}")
-                        print(f"{Fore.BLUE}Server (encrypted): {message[:50]}...{Style.RESET_ALL}")
-                else:
-                    print(f"{Fore.BLUE}Server: {message}{Style.RESET_ALL}")
-                
-            except socket.error:
-                print(f"{Fore.RED}Connection lost.{Style.RESET_ALL}")
-                self.running = False
-                break
-            except Exception as e:
-                print(f"{Fore.RED}Error receiving message: {e}{Style.RESET_ALL}")
-                break
-                
-    def send_messages(self):
-        """Send messages to the server"""
-        while self.running:
-            try:
-                message = input()
-                if not self.running:
-                    break
-                    
-                if message.lower() in ['quit', 'exit']:
-                    self.client_socket.send(message.encode('utf-8'))
-                    self.running = False
-                    break
-                    
-                if message.strip():  # Only send non-empty messages
-                    # Encrypt message if encryption is enabled
-                    if self.encryption and self.encryption.is_encrypted():
-                        encrypted_message = self.encryption.encrypt_message(message)
-                        self.client_socket.send(encrypted_message.encode('utf-8'))
-                        print(f"\033[F{Fore.GREEN}{self.username}: {message} {Fore.GREEN}🔒{Style.RESET_ALL}")
-                    else:
-                        self.client_socket.send(message.encode('utf-8'))
-                        print(f"\033[F{Fore.GREEN}{self.username}: {message}{Style.RESET_ALL}")
-                    
-            except socket.error:
-                print(f"{Fore.RED}Connection lost.{Style.RESET_ALL}")
-                self.running = False
-                break
-            except KeyboardInterrupt:
-                self.running = False
-                break
-            except Exception as e:
-                print(f"{Fore.RED}Error sending message: {e}{Style.RESET_ALL}")
-                break
                 
+    def reconnect(self, timeout):
+        """Dial the same server again after the link dropped"""
+        from transport import TCPTransport, UnixTransport
+        if self.unix_path:
+            return UnixTransport.connect(self.unix_path, min(timeout, CONNECT_TIMEOUT))
+        return TCPTransport.connect(self.host, self.port, min(timeout, CONNECT_TIMEOUT))
+        
     def disconnect(self):
         """Disconnect from the server"""
-        self.running = False
+        if self.session:
+            self.session.stop()
         print(f"\n{Fore.YELLOW}Disconnecting from server...{Style.RESET_ALL}")
         
     def cleanup(self):
         """Clean up resources"""
-        if self.client_socket:
-            try:
-                self.client_socket.close()
-            except:
-                pass
+        if self.session:
+            self.session.close()
+
+def parse_args(argv):
+    """Parse command line options for the simulation"""
+    parser = argparse.ArgumentParser(prog='chat_simulation.py',
+                                     description="TCP simulation of Bluetooth RFCOMM chat")
+    modes = parser.add_subparsers(dest='mode', required=True)
+    
+    server_parser = modes.add_parser('server', help="start as server")
+    server_parser.add_argument('--async', dest='use_async', action='store_true',
+                               help="relay between many clients on one asyncio event loop")
+    server_parser.add_argument('--workers', type=int, default=1, metavar='N',
+                               help="run the relay (implies --async) in N processes sharing the port (default: 1)")
+    server_parser.add_argument('--unix', metavar='PATH',
+                               help="listen on a Unix domain socket instead of TCP")
+    server_parser.add_argument('--host', default=SIM_HOST, help=f"address to listen on (default: {SIM_HOST})")
+    server_parser.add_argument('--port', type=int, default=SIM_PORT, help=f"TCP port (default: {SIM_PORT})")
+    add_headless_arguments(server_parser)
+    profiling.add_arguments(server_parser)
+    
+    client_parser = modes.add_parser('client', help="start as client")
+    client_parser.add_argument('--unix', metavar='PATH',
+                               help="connect to a Unix domain socket instead of TCP")
+    client_parser.add_argument('--host', default=SIM_HOST, help=f"server address (default: {SIM_HOST})")
+    client_parser.add_argument('--port', type=int, default=SIM_PORT, help=f"server TCP port (default: {SIM_PORT})")
+    add_headless_arguments(client_parser)
+    profiling.add_arguments(client_parser)
+    
+    bench_parser = modes.add_parser('bench', help="measure relay throughput and latency")
+    if argv[:1] == ['bench']:
+        import chat_bench
+        chat_bench.add_arguments(bench_parser)
+        profiling.add_arguments(bench_parser)
+    
+    return parser.parse_args(argv)
 
 def main():
     """Main function"""
-    if len(sys.argv) != 2 or sys.argv[1] not in ['server', 'client']:
+    # Initialize colorama for Windows compatibility
+    init()
+    
+    if len(sys.argv) < 2 or sys.argv[1] not in ['server', 'client', 'bench']:
         print(f"{Fore.CYAN}╔══════════════════════════════════════╗{Style.RESET_ALL}")
         print(f"{Fore.CYAN}║   Bluetooth Chat Simulation         ║{Style.RESET_ALL}")
         print(f"{Fore.CYAN}╚══════════════════════════════════════╝{Style.RESET_ALL}")
         print()
         print(f"{Fore.YELLOW}Usage:{Style.RESET_ALL}")
-        print(f"{Fore.GREEN}  python chat_simulation.py server   # Start as server{Style.RESET_ALL}")
-        print(f"{Fore.GREEN}  python chat_simulation.py client   # Start as client{Style.RESET_ALL}")
+        print(f"{Fore.GREEN}  python chat_simulation.py server           # Start as server{Style.RESET_ALL}")
+        print(f"{Fore.GREEN}  python chat_simulation.py server --async   # Multi-client relay server{Style.RESET_ALL}")
+        print(f"{Fore.GREEN}  python chat_simulation.py server --workers 4 # Relay on 4 processes{Style.RESET_ALL}")
+        print(f"{Fore.GREEN}  python chat_simulation.py client           # Start as client{Style.RESET_ALL}")
+        print(f"{Fore.GREEN}  python chat_simulation.py server --unix P  # Use a Unix socket at P{Style.RESET_ALL}")
+        print(f"{Fore.GREEN}  python chat_simulation.py client --headless # Pipe messages in, JSON lines out{Style.RESET_ALL}")
+        print(f"{Fore.GREEN}  python chat_simulation.py bench --help     # Load test the relay server{Style.RESET_ALL}")
         print()
         print(f"{Fore.MAGENTA}Note: This is a TCP simulation of Bluetooth RFCOMM with encryption support.{Style.RESET_ALL}")
         return
     
-    mode = sys.argv[1]
+    args = parse_args(sys.argv[1:])
+    mode = args.mode
+    profiling.configure(args)
     
-    if mode == 'server':
+    if mode == 'bench':
+        print(f"{Fore.CYAN}╔══════════════════════════════════════╗{Style.RESET_ALL}")
+        print(f"{Fore.CYAN}║   Chat Simulation Benchmark         ║{Style.RESET_ALL}")
+        print(f"{Fore.CYAN}╚══════════════════════════════════════╝{Style.RESET_ALL}")
+        print()
+        
+        import chat_bench
+        chat_bench.main(args)
+        
+    elif mode == 'server' and (args.use_async or args.workers > 1):
         print(f"{Fore.CYAN}╔══════════════════════════════════════╗{Style.RESET_ALL}")
-        print(f"{Fore.CYAN}║   Bluetooth Chat Simulation Server  ║{Style.RESET_ALL}")
+        print(f"{Fore.CYAN}║   Chat Simulation Relay (asyncio)   ║{Style.RESET_ALL}")
         print(f"{Fore.CYAN}╚══════════════════════════════════════╝{Style.RESET_ALL}")
         print()
         
-        server = BluetoothChatSimServer()
+        if args.workers > 1:
+            from relay_workers import run_relay_workers
+            run_relay_workers(args.host, args.port, args.workers)
+        else:
+            from async_server import AsyncChatSimServer
+            AsyncChatSimServer(args.host, args.port).run()
+        print(f"{Fore.GREEN}Server closed.{Style.RESET_ALL}")
+        
+    elif mode == 'server':
+        headless = headless_config(args)
+        if not headless:
+            print(f"{Fore.CYAN}╔══════════════════════════════════════╗{Style.RESET_ALL}")
+            print(f"{Fore.CYAN}║   Bluetooth Chat Simulation Server  ║{Style.RESET_ALL}")
+            print(f"{Fore.CYAN}╚══════════════════════════════════════╝{Style.RESET_ALL}")
+            print()
+        
+        server = BluetoothChatSimServer(args.unix, args.host, args.port, args, headless)
         try:
             server.start_server()
         except KeyboardInterrupt:
@@ -341,12 +285,14 @@ def main():
             print(f"{Fore.GREEN}Server closed.{Style.RESET_ALL}")
             
     else:  # client
-        print(f"{Fore.CYAN}╔══════════════════════════════════════╗{Style.RESET_ALL}")
-        print(f"{Fore.CYAN}║   Bluetooth Chat Simulation Client  ║{Style.RESET_ALL}")
-        print(f"{Fore.CYAN}╚══════════════════════════════════════╝{Style.RESET_ALL}")
-        print()
+        headless = headless_config(args)
+        if not headless:
+            print(f"{Fore.CYAN}╔══════════════════════════════════════╗{Style.RESET_ALL}")
+            print(f"{Fore.CYAN}║   Bluetooth Chat Simulation Client  ║{Style.RESET_ALL}")
+            print(f"{Fore.CYAN}╚══════════════════════════════════════╝{Style.RESET_ALL}")
+            print()
         
-        client = BluetoothChatSimClient()
+        client = BluetoothChatSimClient(args.unix, args.host, args.port, args, headless)
         try:
             client.connect_to_server()
         except KeyboardInterrupt:
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Message Compression for Bluetooth Chat
+Optional per-message compression for the slow RFCOMM link. Both ends list the
+codecs they are willing to send in their HELLO and each side only compresses
+with codecs the other side offered. Small messages are sent as-is.
+
+Compression is applied before encryption. That means the ciphertext length
+depends on how well the plaintext compressed, which can leak information when
+an attacker can get chosen text into the same message as a secret. Set
+BTCHAT_COMPRESSION=off to disable it.
+"""
+
+import lzma
+import os
+import zlib
+from colorama import Fore, Style
+from framing import MAX_FRAME_SIZE
+
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+
+CODEC_IDS = {'zlib': CODEC_ZLIB, 'lzma': CODEC_LZMA}
+CODEC_NAMES = {CODEC_NONE: 'none', CODEC_ZLIB: 'zlib', CODEC_LZMA: 'lzma'}
+
+DEFAULT_CODECS = ('zlib', 'lzma')
+COMPRESS_THRESHOLD = 256            # Smaller messages are never compressed
+LZMA_THRESHOLD = 32 * 1024          # Bodies at least this large use lzma when available
+ZLIB_LEVEL = 6
+
+class CompressionError(ValueError):
+    """Raised when a compressed message cannot be decoded"""
+
+def local_codecs():
+    """Codecs this side is willing to send, from BTCHAT_COMPRESSION"""
+    setting = os.environ.get('BTCHAT_COMPRESSION', 'on').strip().lower()
+    if setting in ('off', 'none', '0', 'false', 'no'):
+        return []
+    if setting in ('on', '1', 'true', 'yes', ''):
+        return list(DEFAULT_CODECS)
+    return [name for name in setting.replace(' ', '').split(',') if name in CODEC_IDS]
+
+def negotiate_codecs(local, remote):
+    """Codecs both sides support, in our order of preference"""
+    remote = set(remote or ())
+    return [name for name in local if name in remote]
+
+class CompressionStats:
+    def __init__(self):
+        self.messages = 0
+        self.compressed = 0
+        self.bytes_in = 0       # Uncompressed size of everything offered
+        self.bytes_out = 0      # Size actually sent
+        self.reported = False
+
+    def saved(self):
+        return self.bytes_in - self.bytes_out
+
+    def summary(self):
+        if not self.bytes_in:
+            return "no data"
+        ratio = 100.0 * self.saved() / self.bytes_in
+        return (f"{self.compressed}/{self.messages} messages compressed, "
+                f"{self.bytes_in} -> {self.bytes_out} bytes ({ratio:.1f}% saved)")
+
+class MessageCompressor:
+    def __init__(self, codecs=DEFAULT_CODECS, threshold=COMPRESS_THRESHOLD, lzma_threshold=LZMA_THRESHOLD):
+        self.codecs = [name for name in codecs if name in CODEC_IDS]
+        self.threshold = threshold
+        self.lzma_threshold = lzma_threshold
+        self.stats = CompressionStats()
+
+    def enabled(self):
+        return bool(self.codecs)
+
+    def compress(self, data):
+        """Return (codec id, body), falling back to CODEC_NONE when it doesn't help"""
+        self.stats.messages += 1
+        self.stats.bytes_in += len(data)
+
+        codec = CODEC_NONE
+        if len(data) >= self.threshold and self.codecs:
+            if 'lzma' in self.codecs and (len(data) >= self.lzma_threshold or 'zlib' not in self.codecs):
+                codec = CODEC_LZMA
+            else:
+                codec = CODEC_ZLIB
+
+        if codec == CODEC_ZLIB:
+            body = zlib.compress(data, ZLIB_LEVEL)
+        elif codec == CODEC_LZMA:
+            body = lzma.compress(data, format=lzma.FORMAT_XZ, preset=6)
+        else:
+            body = data
+
+        if codec != CODEC_NONE and len(body) >= len(data):
+            codec, body = CODEC_NONE, data
+        if codec != CODEC_NONE:
+            self.stats.compressed += 1
+        self.stats.bytes_out += len(body)
+        return codec, body
+
+    def decompress(self, codec, data, max_size=MAX_FRAME_SIZE):
+        """Decode a body from the peer. Any known codec is accepted regardless of negotiation"""
+        try:
+            if codec == CODEC_NONE:
+                return data
+            if codec == CODEC_ZLIB:
+                decompressor = zlib.decompressobj()
+                result = decompressor.decompress(data, max_size)
+                if decompressor.unconsumed_tail:
+                    raise CompressionError("Decompressed message too large")
+                return result
+            if codec == CODEC_LZMA:
+                decompressor = lzma.LZMADecompressor()
+                result = decompressor.decompress(bytes(data), max_size)
+                if not decompressor.eof:
+                    raise CompressionError("Decompressed message too large or truncated")
+                return result
+        except (zlib.error, lzma.LZMAError) as e:
+            raise CompressionError(f"Corrupt {CODEC_NAMES[codec]} data: {e}") from None
+        raise CompressionError(f"Unknown compression codec {codec}")
+
+    def describe(self):
+        return ', '.join(self.codecs) if self.codecs else 'off'
+
+def print_compression_stats(compressor):
+    """Report how much bandwidth compression saved in this session (once)"""
+    if compressor and compressor.stats.messages and not compressor.stats.reported:
+        compressor.stats.reported = True
+        print(f"{Fore.CYAN}Compression: {compressor.stats.summary()}{Style.RESET_ALL}")
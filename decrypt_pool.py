@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Decrypt Worker Pool for Bluetooth Chat
+With encryption on, the session loop normally verifies and decrypts each
+chat message before it reads the next bytes from the socket, so a burst of
+large messages backs up the socket buffer while a single thread does
+crypto. With BTCHAT_DECRYPT_WORKERS set to N > 0, received chat messages are
+decoded (decrypt, decompress, UTF-8) on a pool of N threads instead; the
+cryptography primitives and zlib/lzma release the GIL on large buffers, so
+the work spreads over several cores.
+
+Results are handed back to the session in the order the messages arrived,
+however the workers finish. At most BTCHAT_DECRYPT_QUEUE messages (default
+256) are in flight; past that the session waits for the oldest before it
+reads more, so a fast peer can't make it buffer without limit.
+"""
+
+import os
+from collections import deque
+
+DECRYPT_WORKERS = int(os.environ.get('BTCHAT_DECRYPT_WORKERS', '0'))
+DECRYPT_QUEUE = int(os.environ.get('BTCHAT_DECRYPT_QUEUE', '256'))
+
+class DecryptPool:
+    """Decodes message bodies on worker threads and returns them in arrival order.
+
+    Only the session loop calls submit() and ready(). on_ready is called from
+    a worker thread whenever the oldest message in flight is done, so the
+    loop can wake up and collect it.
+    """
+
+    def __init__(self, on_ready, workers=DECRYPT_WORKERS, depth=DECRYPT_QUEUE):
+        from concurrent.futures import ThreadPoolExecutor
+        self.on_ready = on_ready
+        self.workers = max(1, workers)
+        self.depth = max(1, depth)
+        self.max_depth = 0
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='decrypt')
+        self._pending = deque()     # Futures in arrival order
+
+    def __len__(self):
+        return len(self._pending)
+
+    def full(self):
+        return len(self._pending) >= self.depth
+
+    def submit(self, decode, body):
+        """Start decoding body with decode(body), which may raise"""
+        future = self._executor.submit(decode, body)
+        self._pending.append(future)
+        if len(self._pending) > self.max_depth:
+            self.max_depth = len(self._pending)
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        # Later messages finishing first don't wake anyone: the loop takes
+        # them along once the oldest is done
+        pending = self._pending
+        if pending and pending[0] is future:
+            self.on_ready()
+
+    def ready(self, wait=False):
+        """(text, error) for each finished message at the head, in order.
+
+        With wait=True, waits for every message in flight.
+        """
+        results = []
+        pending = self._pending
+        while pending and (wait or pending[0].done()):
+            future = pending.popleft()
+            try:
+                results.append((future.result(), None))
+            except Exception as e:
+                results.append((None, e))
+        return results
+
+    def wait_oldest(self):
+        """Block until the oldest message in flight is done"""
+        if self._pending:
+            self._pending[0].exception()
+
+    def close(self):
+        """Stop the workers. Messages still in flight are dropped"""
+        self._pending.clear()
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Known Peer Cache for Bluetooth Chat
+Remembers chat servers the client has connected to (address, device name,
+RFCOMM channel, when it was last seen) in BTCHAT_STATE_DIR/devices.json, so
+the next launch can dial a known peer straight away instead of running an
+inquiry and an SDP lookup. Entries older than BTCHAT_DEVICE_TTL seconds
+(default one day) are ignored, since a server's channel can change when it
+restarts.
+"""
+
+import json
+import os
+import time
+from outbox import STATE_DIR, _replace_file
+
+CACHE_PATH = os.path.join(STATE_DIR, 'devices.json')
+CACHE_TTL = float(os.environ.get('BTCHAT_DEVICE_TTL', str(24 * 60 * 60)))
+
+class CachedPeer:
+    def __init__(self, address, name, port, last_seen):
+        self.address = address
+        self.name = name
+        self.port = port
+        self.last_seen = last_seen
+
+    def age(self, now=None):
+        return (now or time.time()) - self.last_seen
+
+class DeviceCache:
+    """Chat servers seen before, keyed by Bluetooth address"""
+
+    def __init__(self, path=CACHE_PATH, ttl=CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.peers = {}
+        try:
+            with open(path) as f:
+                for address, entry in json.load(f).get('devices', {}).items():
+                    self.peers[address] = CachedPeer(address, entry['name'], int(entry['port']),
+                                                     float(entry['last_seen']))
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            self.peers = {}
+
+    def fresh(self):
+        """Peers seen within the TTL, most recent first"""
+        now = time.time()
+        peers = [peer for peer in self.peers.values() if peer.age(now) < self.ttl]
+        return sorted(peers, key=lambda peer: peer.last_seen, reverse=True)
+
+    def latest(self):
+        """The most recently seen peer within the TTL, or None"""
+        peers = self.fresh()
+        return peers[0] if peers else None
+
+    def remember(self, address, name, port):
+        self.peers[address] = CachedPeer(address, name, port, time.time())
+        self.save()
+
+    def forget(self, address):
+        if self.peers.pop(address, None) is not None:
+            self.save()
+
+    def save(self):
+        devices = {peer.address: {'name': peer.name, 'port': peer.port, 'last_seen': peer.last_seen}
+                   for peer in self.peers.values()}
+        try:
+            os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+            _replace_file(self.path, json.dumps({'devices': devices}, indent=1).encode('utf-8'))
+        except OSError:
+            pass    # The cache only saves time; never fail a connection over it
@@ -2,42 +2,247 @@
 """
 Encryption Module for Bluetooth Chat
 Provides secure message encryption and decryption using Fernet symmetric encryption.
+
+The cryptography package is imported when encryption is first set up, so the
+plaintext path and the password prompt don't pay for loading it.
 """
 
 import base64
+import hashlib
 import os
-from cryptography.fernet import Fernet
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+import struct
+import threading
+import time
+from collections import OrderedDict
 from colorama import Fore, Style
+from metrics import Histogram
+
+KDF_SALT = b'bluetooth_chat_salt_2024'  # Fixed salt for simplicity
+KDF_ITERATIONS = 100000
+KDF_ALGORITHMS = {
+    'sha256': 'SHA256',
+    'sha512': 'SHA512',
+}
+KEY_CACHE_SIZE = 16
+
+# Streaming encryption: each chunk is sealed with AES-256-GCM under a key
+# derived from the chat key, using a nonce built from a random per-stream
+# prefix, the chunk counter and a last-chunk flag
+STREAM_KEY_INFO = b'bluetooth_chat_stream_v1'
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_ID_SIZE = 7
+STREAM_CHUNK_HEADER = struct.Struct('!IB')  # counter, final flag
+
+class DerivedKeyCache:
+    """In-process LRU cache of PBKDF2-derived keys.
+
+    PBKDF2 is deliberately slow, so every ChatEncryption built with the same
+    secret reuses the key derived the first time. Entries are looked up by a
+    SHA-256 digest of the password rather than the password itself.
+    """
+
+    def __init__(self, maxsize=KEY_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def derive(self, password, salt=KDF_SALT, iterations=KDF_ITERATIONS, algorithm='sha256', length=32):
+        """Return the derived key for these parameters, running PBKDF2 only on a miss"""
+        if isinstance(password, str):
+            password = password.encode()
+        cache_key = (hashlib.sha256(password).digest(), salt, iterations, algorithm, length)
+
+        with self._lock:
+            key = self._keys.get(cache_key)
+            if key is not None:
+                self._keys.move_to_end(cache_key)
+                self.hits += 1
+                return key
+            self.misses += 1
+
+        # Derive outside the lock so a slow derivation doesn't block cache hits
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+        kdf = PBKDF2HMAC(
+            algorithm=getattr(hashes, KDF_ALGORITHMS[algorithm])(),
+            length=length,
+            salt=salt,
+            iterations=iterations,
+        )
+        key = kdf.derive(password)
+
+        with self._lock:
+            self._keys[cache_key] = key
+            self._keys.move_to_end(cache_key)
+            while len(self._keys) > self.maxsize:
+                self._keys.popitem(last=False)
+                self.evictions += 1
+        return key
+
+    def stats(self):
+        """Hit/miss counters and current size"""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._keys),
+                'maxsize': self.maxsize,
+            }
+
+    def clear(self):
+        """Forget all cached keys and reset the counters"""
+        with self._lock:
+            self._keys.clear()
+            self.hits = self.misses = self.evictions = 0
+
+# Shared by every ChatEncryption instance in the process
+key_cache = DerivedKeyCache()
+
+def key_cache_stats():
+    """Counters for the process-wide derived key cache"""
+    return key_cache.stats()
+
+class StreamError(ValueError):
+    """Raised when a stream chunk is forged, reordered, replayed or truncated"""
+
+def _stream_nonce(stream_id, counter, final):
+    return stream_id + STREAM_CHUNK_HEADER.pack(counter, 1 if final else 0)
+
+class StreamEncryptor:
+    """Encrypts one stream chunk by chunk.
+
+    header must reach the receiver before the first chunk. Every chunk record
+    carries its counter and final flag in the clear; both are bound into the
+    nonce, so the receiver detects dropped, reordered or truncated chunks.
+    """
+
+    def __init__(self, key, stream_id=None):
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+        self._aead = AESGCM(key)
+        self.stream_id = stream_id or os.urandom(STREAM_ID_SIZE)
+        self.counter = 0
+        self.finished = False
+
+    @property
+    def header(self):
+        return self.stream_id
+
+    def encrypt_chunk(self, data, final=False):
+        """Seal one chunk and return its record"""
+        if self.finished:
+            raise StreamError("Stream already finished")
+        nonce = _stream_nonce(self.stream_id, self.counter, final)
+        record = STREAM_CHUNK_HEADER.pack(self.counter, 1 if final else 0) + \
+            self._aead.encrypt(nonce, bytes(data), self.stream_id)
+        self.counter += 1
+        self.finished = final
+        return record
+
+class StreamDecryptor:
+    """Decrypts the chunk records produced by a StreamEncryptor, in order"""
+
+    def __init__(self, key, header):
+        if len(header) != STREAM_ID_SIZE:
+            raise StreamError("Invalid stream header")
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+        self._aead = AESGCM(key)
+        self.stream_id = bytes(header)
+        self.counter = 0
+        self.finished = False
+
+    def decrypt_chunk(self, record):
+        """Verify and decrypt one chunk record"""
+        if self.finished:
+            raise StreamError("Data after the final chunk")
+        if len(record) < STREAM_CHUNK_HEADER.size:
+            raise StreamError("Truncated chunk record")
+        counter, final = STREAM_CHUNK_HEADER.unpack_from(record)
+        if counter != self.counter:
+            raise StreamError(f"Expected chunk {self.counter}, got {counter}")
+        nonce = _stream_nonce(self.stream_id, counter, final)
+        from cryptography.exceptions import InvalidTag
+        try:
+            data = self._aead.decrypt(nonce, bytes(record[STREAM_CHUNK_HEADER.size:]), self.stream_id)
+        except InvalidTag:
+            raise StreamError(f"Chunk {counter} failed authentication") from None
+        self.counter += 1
+        self.finished = bool(final)
+        return data
+
+def _iter_chunks(source, chunk_size):
+    """Yield chunks of at most chunk_size from bytes-like, file-like or iterable sources"""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        view = memoryview(source)
+        for offset in range(0, len(view), chunk_size):
+            yield view[offset:offset + chunk_size]
+    elif hasattr(source, 'read'):
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    else:
+        yield from source
 
 class ChatEncryption:
+    CIPHER = 'fernet'   # Named in the HELLO so both sides can check they match
+
     def __init__(self, password=None):
         """Initialize encryption with a password"""
         self.fernet = None
+        self.stream_key = None
+        # Time per encrypt_bytes/decrypt_bytes call, read by the session metrics
+        self.encrypt_time = Histogram()
+        self.decrypt_time = Histogram()
+        self.decrypt_time_lock = None   # Set when decrypt workers (decrypt_pool.py) share the histogram
         if password:
             self.setup_encryption(password)
     
     def setup_encryption(self, password):
         """Setup encryption using a password"""
         try:
-            # Generate a salt for key derivation
-            salt = b'bluetooth_chat_salt_2024'  # Fixed salt for simplicity
+            from cryptography.fernet import Fernet
+            from cryptography.hazmat.primitives import hashes
+            from cryptography.hazmat.primitives.kdf.hkdf import HKDF
             
-            # Derive a key from the password
-            kdf = PBKDF2HMAC(
+            # Derive a key from the password (cached after the first derivation)
+            derived = key_cache.derive(password, KDF_SALT, KDF_ITERATIONS, 'sha256')
+            key = base64.urlsafe_b64encode(derived)
+            self.fernet = Fernet(key)
+            self.stream_key = HKDF(
                 algorithm=hashes.SHA256(),
                 length=32,
-                salt=salt,
-                iterations=100000,
-            )
-            key = base64.urlsafe_b64encode(kdf.derive(password.encode()))
-            self.fernet = Fernet(key)
+                salt=None,
+                info=STREAM_KEY_INFO,
+            ).derive(derived)
             return True
         except Exception as e:
             print(f"{Fore.RED}Error setting up encryption: {e}{Style.RESET_ALL}")
             return False
     
+    def encrypt_bytes(self, data):
+        """Encrypt raw bytes into a Fernet token (raises on failure)"""
+        started = time.perf_counter_ns()
+        token = self.fernet.encrypt(bytes(data))
+        self.encrypt_time.observe(time.perf_counter_ns() - started)
+        return token
+    
+    def decrypt_bytes(self, token):
+        """Verify and decrypt a Fernet token (raises InvalidToken on failure)"""
+        started = time.perf_counter_ns()
+        data = self.fernet.decrypt(bytes(token))
+        elapsed = time.perf_counter_ns() - started
+        if self.decrypt_time_lock is None:
+            self.decrypt_time.observe(elapsed)
+        else:
+            with self.decrypt_time_lock:
+                self.decrypt_time.observe(elapsed)
+        return data
+    
     def encrypt_message(self, message):
         """Encrypt a message"""
         if not self.fernet:
@@ -68,6 +273,53 @@ class ChatEncryption:
     def is_encrypted(self):
         """Check if encryption is enabled"""
         return self.fernet is not None
+    
+    def new_stream_encryptor(self):
+        """Start a new chunked encryption stream"""
+        return StreamEncryptor(self.stream_key)
+    
+    def new_stream_decryptor(self, header):
+        """Start decrypting a stream from its header"""
+        return StreamDecryptor(self.stream_key, header)
+    
+    def encrypt_stream(self, source, chunk_size=STREAM_CHUNK_SIZE):
+        """Encrypt a payload incrementally.
+
+        source may be bytes, a file object or an iterable of byte chunks. Yields
+        the stream header followed by one record per chunk, so only one chunk
+        is held in memory at a time. Without encryption the chunks are yielded
+        unchanged and no header is sent.
+        """
+        if not self.stream_key:
+            yield from _iter_chunks(source, chunk_size)
+            return
+        
+        encryptor = self.new_stream_encryptor()
+        yield encryptor.header
+        
+        # Hold back one chunk so the last one can be flagged as final
+        pending = None
+        for chunk in _iter_chunks(source, chunk_size):
+            if pending is not None:
+                yield encryptor.encrypt_chunk(pending)
+            pending = chunk
+        yield encryptor.encrypt_chunk(pending if pending is not None else b'', final=True)
+    
+    def decrypt_stream(self, records):
+        """Decrypt the output of encrypt_stream, yielding plaintext chunks as they arrive"""
+        if not self.stream_key:
+            yield from records
+            return
+        
+        records = iter(records)
+        header = next(records, None)
+        if header is None:
+            raise StreamError("Missing stream header")
+        decryptor = self.new_stream_decryptor(header)
+        for record in records:
+            yield decryptor.decrypt_chunk(record)
+        if not decryptor.finished:
+            raise StreamError("Stream ended before the final chunk")
 
 def get_chat_password():
     """Get password from user for encryption"""
@@ -126,6 +378,16 @@ def test_encryption():
         print(f"{Fore.GREEN}✓ Encryption test passed!{Style.RESET_ALL}")
     else:
         print(f"{Fore.RED}✗ Encryption test failed!{Style.RESET_ALL}")
+    
+    # Test chunked streaming encryption
+    payload = os.urandom(3 * STREAM_CHUNK_SIZE + 123)
+    records = list(crypto.encrypt_stream(payload))
+    print(f"{Fore.MAGENTA}Stream: {len(payload)} bytes in {len(records) - 1} chunks{Style.RESET_ALL}")
+    
+    if b''.join(crypto.decrypt_stream(records)) == payload:
+        print(f"{Fore.GREEN}✓ Stream encryption test passed!{Style.RESET_ALL}")
+    else:
+        print(f"{Fore.RED}✗ Stream encryption test failed!{Style.RESET_ALL}")
 
 if __name__ == "__main__":
     test_encryption()
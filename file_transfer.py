@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+"""
+File Transfer for Bluetooth Chat
+Streams files to the peer with the /send command. The sender reads the file
+through mmap (or hands it to os.sendfile on plaintext TCP connections) so it is
+never loaded into Python objects, and the receiver writes into a .part file and
+acknowledges its progress, so an interrupted transfer resumes from the last
+acknowledged offset when the same file is offered again.
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from colorama import Fore, Style
+from encryption import STREAM_CHUNK_SIZE, StreamError
+from protocol import (
+    MSG_FILE_OFFER, MSG_FILE_ACCEPT, MSG_FILE_REJECT, MSG_FILE_BEGIN,
+    MSG_FILE_DATA, MSG_FILE_END, MSG_FILE_ACK, type_byte, send_message,
+)
+
+DOWNLOAD_DIR = os.environ.get('BTCHAT_DOWNLOAD_DIR', 'downloads')
+CHUNK_SIZE = STREAM_CHUNK_SIZE
+ACK_INTERVAL = 1024 * 1024    # Receiver acknowledges after this many bytes
+ACCEPT_TIMEOUT = 30.0
+COMPLETE_TIMEOUT = 60.0
+PROGRESS_INTERVAL = 1.0
+
+# Transfer id followed by a byte offset; used by BEGIN, DATA, END and ACK
+POSITION = struct.Struct('!16sQ')
+
+def format_size(size):
+    """Human-readable byte count"""
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024.0
+
+def transfer_id_for(path, stat):
+    """Stable id for a file version, so a resent unchanged file resumes"""
+    identity = f"{os.path.basename(path)}\0{stat.st_size}\0{stat.st_mtime_ns}"
+    return hashlib.sha256(identity.encode('utf-8')).digest()[:16]
+
+class OutgoingTransfer:
+    def __init__(self, transfer_id, path, size):
+        self.transfer_id = transfer_id
+        self.path = path
+        self.name = os.path.basename(path)
+        self.size = size
+        self.offset = 0
+        self.acked = 0
+        self.reject_reason = None
+        self.accepted = threading.Event()
+        self.completed = threading.Event()
+
+class IncomingTransfer:
+    def __init__(self, transfer_id, name, size, part_path, offset):
+        self.transfer_id = transfer_id
+        self.name = name
+        self.size = size
+        self.part_path = part_path
+        self.meta_path = part_path + '.json'
+        self.offset = offset
+        self.acked = offset
+        self.started = False
+        self.decryptor = None
+        self.file = None
+        self.last_progress = 0.0
+
+class FileTransferManager:
+    """Runs file transfers over one chat connection.
+
+    send_file() is called from the send loop and blocks until the transfer
+    finishes; handle_message() is called from the receive loop for every file
+    transfer message.
+    """
+
+    def __init__(self, writer, encryption=None, peer_name="Peer", download_dir=DOWNLOAD_DIR):
+        self.writer = writer
+        self.encryption = encryption if encryption and encryption.is_encrypted() else None
+        self.peer_name = peer_name
+        self.download_dir = download_dir
+        self.outgoing = {}
+        self.incoming = {}
+
+    # Sending
+
+    def send_file(self, path):
+        """Offer a file to the peer and stream it. Returns True on success"""
+        path = os.path.expanduser(path.strip().strip('"\''))
+        try:
+            stat = os.stat(path)
+        except OSError as e:
+            print(f"{Fore.RED}Cannot send {path}: {e.strerror}{Style.RESET_ALL}")
+            return False
+        if not os.path.isfile(path):
+            print(f"{Fore.RED}Cannot send {path}: not a regular file{Style.RESET_ALL}")
+            return False
+
+        transfer = OutgoingTransfer(transfer_id_for(path, stat), path, stat.st_size)
+        self.outgoing[transfer.transfer_id] = transfer
+        try:
+            return self._run_outgoing(transfer)
+        finally:
+            self.outgoing.pop(transfer.transfer_id, None)
+
+    def _run_outgoing(self, transfer):
+        offer = {'id': transfer.transfer_id.hex(), 'name': transfer.name, 'size': transfer.size}
+        send_message(self.writer, MSG_FILE_OFFER, json.dumps(offer).encode('utf-8'))
+        print(f"{Fore.CYAN}Offering {transfer.name} ({format_size(transfer.size)}) "
+              f"to {self.peer_name}...{Style.RESET_ALL}")
+
+        if not transfer.accepted.wait(ACCEPT_TIMEOUT):
+            print(f"{Fore.RED}{self.peer_name} did not answer the file offer{Style.RESET_ALL}")
+            return False
+        if transfer.reject_reason:
+            print(f"{Fore.RED}{self.peer_name} refused {transfer.name}: {transfer.reject_reason}{Style.RESET_ALL}")
+            return False
+        if transfer.offset:
+            print(f"{Fore.YELLOW}Resuming {transfer.name} at {format_size(transfer.offset)}{Style.RESET_ALL}")
+
+        with open(transfer.path, 'rb') as f:
+            if not self._stream_file(transfer, f):
+                print(f"{Fore.RED}{self.peer_name} aborted {transfer.name}: {transfer.reject_reason}{Style.RESET_ALL}")
+                return False
+
+        send_message(self.writer, MSG_FILE_END, POSITION.pack(transfer.transfer_id, transfer.size))
+        if not transfer.completed.wait(COMPLETE_TIMEOUT) or transfer.reject_reason:
+            reason = transfer.reject_reason or "no confirmation from peer"
+            print(f"{Fore.RED}Transfer of {transfer.name} failed: {reason}{Style.RESET_ALL}")
+            return False
+
+        print(f"{Fore.GREEN}✓ Sent {transfer.name} ({format_size(transfer.size)}){Style.RESET_ALL}")
+        return True
+
+    def _stream_file(self, transfer, f):
+        """Send the file from the accepted offset to the end. False if the peer aborted"""
+        stream_header = b''
+        encryptor = None
+        if self.encryption:
+            encryptor = self.encryption.new_stream_encryptor()
+            stream_header = encryptor.header
+        send_message(self.writer, MSG_FILE_BEGIN,
+                     POSITION.pack(transfer.transfer_id, transfer.offset), stream_header)
+
+        data_type = type_byte(MSG_FILE_DATA)
+        use_sendfile = encryptor is None and self.writer.can_sendfile()
+        started = time.monotonic()
+        last_progress = started
+        position = transfer.offset
+
+        # mmap cannot map an empty file, and sendfile does not need a mapping
+        mapping = None
+        if transfer.size and not use_sendfile:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(mapping) if mapping is not None else None
+        try:
+            while position < transfer.size:
+                if transfer.reject_reason:
+                    return False
+                count = min(CHUNK_SIZE, transfer.size - position)
+                prefix = data_type + POSITION.pack(transfer.transfer_id, position)
+                if use_sendfile:
+                    self.writer.send_file_region(prefix, f.fileno(), position, count)
+                elif encryptor:
+                    final = position + count >= transfer.size
+                    self.writer.send(prefix, encryptor.encrypt_chunk(view[position:position + count], final))
+                else:
+                    self.writer.send(prefix, view[position:position + count])
+                position += count
+
+                now = time.monotonic()
+                if now - last_progress >= PROGRESS_INTERVAL:
+                    last_progress = now
+                    self._print_progress("Sending", transfer.name, position, transfer.size,
+                                         position - transfer.offset, now - started)
+        finally:
+            # Queued frames may still reference the mapping or the file
+            self.writer.flush()
+            if view is not None:
+                view.release()
+            if mapping is not None:
+                mapping.close()
+
+        if encryptor and not encryptor.finished:
+            # Nothing left to send (empty file or fully resumed): still close the stream
+            self.writer.send(data_type + POSITION.pack(transfer.transfer_id, position),
+                             encryptor.encrypt_chunk(b'', final=True))
+        self.writer.flush()
+        return True
+
+    def _print_progress(self, verb, name, position, size, transferred, elapsed):
+        percent = 100.0 * position / size if size else 100.0
+        rate = transferred / elapsed if elapsed > 0 else 0.0
+        print(f"{Fore.MAGENTA}{verb} {name}: {percent:.0f}% "
+              f"({format_size(position)} of {format_size(size)}, {format_size(rate)}/s){Style.RESET_ALL}")
+
+    # Receiving
+
+    def handle_message(self, kind, body):
+        """Dispatch one file transfer message from the peer"""
+        if kind == MSG_FILE_DATA:
+            self._on_data(body)
+        elif kind == MSG_FILE_OFFER:
+            self._on_offer(body)
+        elif kind == MSG_FILE_BEGIN:
+            self._on_begin(body)
+        elif kind == MSG_FILE_END:
+            self._on_end(body)
+        elif kind == MSG_FILE_ACCEPT:
+            self._on_accept(body)
+        elif kind == MSG_FILE_ACK:
+            self._on_ack(body)
+        elif kind == MSG_FILE_REJECT:
+            self._on_reject(body)
+
+    def _reply(self, kind, transfer_id, **fields):
+        fields['id'] = transfer_id.hex()
+        send_message(self.writer, kind, json.dumps(fields).encode('utf-8'), control=True)
+
+    def _on_offer(self, body):
+        offer = json.loads(bytes(body).decode('utf-8'))
+        transfer_id = bytes.fromhex(offer['id'])
+        name = os.path.basename(offer.get('name', ''))
+        size = int(offer['size'])
+        if not name or name in ('.', '..'):
+            self._reply(MSG_FILE_REJECT, transfer_id, reason="invalid file name")
+            return
+
+        os.makedirs(self.download_dir, exist_ok=True)
+        part_path = os.path.join(self.download_dir, name + '.part')
+        offset = self._resume_offset(part_path, transfer_id, size)
+
+        transfer = IncomingTransfer(transfer_id, name, size, part_path, offset)
+        transfer.file = open(part_path, 'r+b' if offset else 'wb')
+        transfer.file.truncate(offset)
+        transfer.file.seek(offset)
+        self._save_meta(transfer)
+        self.incoming[transfer_id] = transfer
+
+        if offset:
+            print(f"{Fore.CYAN}Resuming {name} from {self.peer_name} at "
+                  f"{format_size(offset)} of {format_size(size)}{Style.RESET_ALL}")
+        else:
+            print(f"{Fore.CYAN}Receiving {name} ({format_size(size)}) from {self.peer_name}...{Style.RESET_ALL}")
+        self._reply(MSG_FILE_ACCEPT, transfer_id, offset=offset)
+
+    def _resume_offset(self, part_path, transfer_id, size):
+        """Acknowledged offset of an earlier partial download of the same file"""
+        try:
+            with open(part_path + '.json') as f:
+                meta = json.load(f)
+            if meta.get('id') == transfer_id.hex() and meta.get('size') == size:
+                return min(int(meta.get('acked', 0)), os.path.getsize(part_path))
+        except (OSError, ValueError):
+            pass
+        return 0
+
+    def _save_meta(self, transfer):
+        meta = {'id': transfer.transfer_id.hex(), 'name': transfer.name,
+                'size': transfer.size, 'acked': transfer.acked}
+        tmp_path = transfer.meta_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, transfer.meta_path)
+
+    def _on_begin(self, body):
+        transfer_id, offset = POSITION.unpack_from(body)
+        transfer = self.incoming.get(transfer_id)
+        if transfer is None:
+            return
+        if offset != transfer.offset:
+            self._fail(transfer, f"sender started at {offset}, expected {transfer.offset}")
+            return
+        stream_header = bytes(body[POSITION.size:])
+        if self.encryption:
+            transfer.decryptor = self.encryption.new_stream_decryptor(stream_header)
+        transfer.started = True
+        transfer.last_progress = time.monotonic()
+
+    def _on_data(self, body):
+        transfer_id, position = POSITION.unpack_from(body)
+        transfer = self.incoming.get(transfer_id)
+        if transfer is None or not transfer.started:
+            return
+        if position != transfer.offset:
+            self._fail(transfer, f"data at {position}, expected {transfer.offset}")
+            return
+
+        data = body[POSITION.size:]
+        if transfer.decryptor:
+            try:
+                data = transfer.decryptor.decrypt_chunk(data)
+            except StreamError as e:
+                self._fail(transfer, str(e))
+                return
+        transfer.file.write(data)
+        transfer.offset += len(data)
+
+        # The final acknowledgement is sent once END has been verified
+        if transfer.offset - transfer.acked >= ACK_INTERVAL and transfer.offset < transfer.size:
+            self._acknowledge(transfer)
+            now = time.monotonic()
+            if now - transfer.last_progress >= PROGRESS_INTERVAL:
+                transfer.last_progress = now
+                percent = 100.0 * transfer.offset / transfer.size if transfer.size else 100.0
+                print(f"{Fore.MAGENTA}Receiving {transfer.name}: {percent:.0f}%{Style.RESET_ALL}")
+
+    def _acknowledge(self, transfer):
+        """Flush received data to disk, record it, and tell the sender"""
+        transfer.file.flush()
+        os.fsync(transfer.file.fileno())
+        transfer.acked = transfer.offset
+        self._save_meta(transfer)
+        send_message(self.writer, MSG_FILE_ACK, POSITION.pack(transfer.transfer_id, transfer.acked),
+                     control=True, key=(MSG_FILE_ACK, transfer.transfer_id))
+
+    def _on_end(self, body):
+        transfer_id, size = POSITION.unpack_from(body)
+        transfer = self.incoming.get(transfer_id)
+        if transfer is None:
+            return
+        if transfer.offset != transfer.size or size != transfer.size:
+            self._fail(transfer, f"received {transfer.offset} of {transfer.size} bytes")
+            return
+        if transfer.decryptor and not transfer.decryptor.finished:
+            self._fail(transfer, "encrypted stream was truncated")
+            return
+
+        # Move the file into place before confirming, so a confirmed transfer is complete on disk
+        self.incoming.pop(transfer_id, None)
+        transfer.file.flush()
+        os.fsync(transfer.file.fileno())
+        transfer.file.close()
+        final_path = self._unique_path(os.path.join(self.download_dir, transfer.name))
+        os.replace(transfer.part_path, final_path)
+        os.remove(transfer.meta_path)
+        send_message(self.writer, MSG_FILE_ACK, POSITION.pack(transfer_id, transfer.size),
+                     control=True, key=(MSG_FILE_ACK, transfer_id))
+        print(f"{Fore.GREEN}✓ Received {transfer.name} ({format_size(transfer.size)}) "
+              f"saved to {final_path}{Style.RESET_ALL}")
+
+    def _unique_path(self, path):
+        base, ext = os.path.splitext(path)
+        candidate = path
+        counter = 1
+        while os.path.exists(candidate):
+            candidate = f"{base} ({counter}){ext}"
+            counter += 1
+        return candidate
+
+    def _fail(self, transfer, reason):
+        """Abandon an incoming transfer, keeping acknowledged data for a resume"""
+        print(f"{Fore.RED}Transfer of {transfer.name} failed: {reason}{Style.RESET_ALL}")
+        self._close_incoming(transfer)
+        self._reply(MSG_FILE_REJECT, transfer.transfer_id, reason=reason)
+
+    def _close_incoming(self, transfer):
+        self.incoming.pop(transfer.transfer_id, None)
+        if transfer.file and not transfer.file.closed:
+            transfer.file.close()
+
+    # Replies to our own transfers
+
+    def _on_accept(self, body):
+        reply = json.loads(bytes(body).decode('utf-8'))
+        transfer = self.outgoing.get(bytes.fromhex(reply['id']))
+        if transfer:
+            transfer.offset = transfer.acked = int(reply.get('offset', 0))
+            transfer.accepted.set()
+
+    def _on_reject(self, body):
+        reply = json.loads(bytes(body).decode('utf-8'))
+        transfer = self.outgoing.get(bytes.fromhex(reply['id']))
+        if transfer:
+            transfer.reject_reason = reply.get('reason', 'rejected')
+            transfer.accepted.set()
+            transfer.completed.set()
+
+    def _on_ack(self, body):
+        transfer_id, offset = POSITION.unpack_from(body)
+        transfer = self.outgoing.get(transfer_id)
+        if transfer:
+            transfer.acked = offset
+            if offset >= transfer.size:
+                transfer.completed.set()
+
+    def close(self):
+        """Release waiting senders and close partial downloads (kept for resume)"""
+        for transfer in list(self.outgoing.values()):
+            transfer.reject_reason = transfer.reject_reason or "connection closed"
+            transfer.accepted.set()
+            transfer.completed.set()
+        for transfer in list(self.incoming.values()):
+            self._close_incoming(transfer)
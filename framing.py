@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+Message Framing for Bluetooth Chat
+Length-prefixed frames over stream sockets (RFCOMM or TCP).
+A single recv() is not a message: reads can be split or coalesced, so every
+payload is sent with a 4-byte big-endian length header and reassembled on the
+receiving side in a preallocated buffer.
+"""
+
+import os
+import socket
+import struct
+import threading
+
+HEADER = struct.Struct('!I')
+DEFAULT_BUFFER_SIZE = 64 * 1024
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# Payloads above this size are written as header + payload instead of being
+# concatenated first, so large messages are not copied just to prepend 4 bytes
+COALESCE_LIMIT = 16 * 1024
+
+class FrameError(ConnectionError):
+    """Raised when the peer sends a frame that cannot be valid"""
+
+def encode_frame(payload):
+    """Return the wire representation of a single payload"""
+    return HEADER.pack(len(payload)) + payload
+
+def sendall(sock, data):
+    """Write all of data, even on sockets without a native sendall()"""
+    native = getattr(sock, 'sendall', None)
+    if native is not None:
+        native(data)
+        return
+    view = memoryview(data)
+    while view:
+        sent = sock.send(view)
+        view = view[sent:]
+
+class FrameReader:
+    """Reassembles length-prefixed frames from a stream socket.
+
+    Incoming bytes are received straight into a preallocated bytearray through
+    a memoryview, so partial reads are completed in place rather than by
+    concatenating chunks. The buffer is compacted or grown only when a frame
+    does not fit in the space that is left.
+    """
+
+    def __init__(self, sock, buffer_size=DEFAULT_BUFFER_SIZE, max_frame_size=MAX_FRAME_SIZE):
+        self.sock = sock
+        self.max_frame_size = max_frame_size
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0  # First unread byte
+        self._end = 0    # One past the last received byte
+        self._recv_into = getattr(sock, 'recv_into', None)
+
+    def pending(self):
+        """Number of received bytes not yet returned as a frame"""
+        return self._end - self._start
+
+    def _reserve(self, size):
+        """Make sure size bytes starting at the first unread byte fit in the buffer"""
+        if self._start + size <= len(self._buffer):
+            return
+        pending = self._end - self._start
+        if size <= len(self._buffer):
+            # Move the partial frame to the front of the existing buffer
+            self._buffer[:pending] = self._view[self._start:self._end]
+        else:
+            # Frame is larger than the buffer: grow it once to fit
+            new_buffer = bytearray(max(size, 2 * len(self._buffer)))
+            new_buffer[:pending] = self._view[self._start:self._end]
+            self._view.release()
+            self._buffer = new_buffer
+            self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = pending
+
+    def recv_once(self):
+        """Receive whatever the socket has available. Returns 0 on EOF"""
+        if self._end == len(self._buffer):
+            self._reserve(self.pending() + 1)
+        if self._recv_into is not None:
+            received = self._recv_into(self._view[self._end:])
+        else:
+            data = self.sock.recv(len(self._buffer) - self._end)
+            received = len(data)
+            self._buffer[self._end:self._end + received] = data
+        self._end += received
+        return received
+
+    def next_frame(self):
+        """Return the next complete payload already buffered, or None"""
+        pending = self._end - self._start
+        if pending < HEADER.size:
+            return None
+
+        (length,) = HEADER.unpack_from(self._buffer, self._start)
+        if length > self.max_frame_size:
+            raise FrameError(f"Frame of {length} bytes exceeds limit of {self.max_frame_size}")
+
+        total = HEADER.size + length
+        if pending < total:
+            self._reserve(total)
+            return None
+
+        payload = bytes(self._view[self._start + HEADER.size:self._start + total])
+        self._start += total
+        if self._start == self._end:
+            self._start = self._end = 0
+        return payload
+
+    def read_frame(self):
+        """Block until a full payload is available. Returns None on clean EOF"""
+        while True:
+            payload = self.next_frame()
+            if payload is not None:
+                return payload
+            if self.recv_once() == 0:
+                if self.pending():
+                    raise FrameError("Connection closed in the middle of a frame")
+                return None
+
+class FrameWriter:
+    """Writes length-prefixed frames with sendall, safe to share between threads"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self._lock = threading.Lock()
+
+    def send(self, *parts, droppable=False, control=False, key=None, wait=True):
+        """Send the concatenation of parts as a single frame. Always returns True.
+
+        Writes are synchronous, so control frames need no lane of their own.
+        """
+        length = sum(len(part) for part in parts)
+        header = HEADER.pack(length)
+        with self._lock:
+            if length <= COALESCE_LIMIT:
+                sendall(self.sock, header + b''.join(parts))
+                return True
+
+            # Coalesce the header with any small leading parts, then write
+            # large parts straight from their own buffers
+            head = [header]
+            index = 0
+            while index < len(parts) and len(parts[index]) <= COALESCE_LIMIT:
+                head.append(parts[index])
+                index += 1
+            sendall(self.sock, b''.join(head))
+            for part in parts[index:]:
+                sendall(self.sock, part)
+        return True
+
+    def can_sendfile(self):
+        """True if file regions can be handed to the kernel with os.sendfile"""
+        return hasattr(os, 'sendfile') and isinstance(self.sock, socket.socket)
+
+    def send_file_region(self, prefix, fd, offset, count):
+        """Send prefix followed by count bytes of fd at offset as one frame.
+
+        The file bytes are copied by the kernel and never enter Python.
+        """
+        with self._lock:
+            sendall(self.sock, HEADER.pack(len(prefix) + count) + prefix)
+            while count:
+                sent = os.sendfile(self.sock.fileno(), fd, offset, count)
+                if sent == 0:
+                    raise ConnectionError("sendfile wrote no data")
+                offset += sent
+                count -= sent
+        return True
+
+    def flush(self, timeout=None):
+        """Frames are written synchronously, so there is never anything pending"""
+        return True
+
+    def close(self, timeout=None):
+        return True
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Headless Mode for Bluetooth Chat
+Runs the chat entry points without prompts or menus so scripts and pipelines
+can drive them. Every line of the input (a file, or stdin by default) is sent
+as a message as fast as the link takes it, and every message received is
+written to stdout as one line of JSON:
+
+  {"time": 1760700000.123456, "from": "Server", "peer": "...", "text": "hi", "encrypted": true}
+
+Status output goes to stderr, so stdout carries nothing but messages. When
+the input ends the session waits until the peer has acknowledged everything
+sent and then quits; with --keep-open it stays and keeps writing what arrives
+until the peer quits.
+
+The password is taken from, in order: --no-encryption, --password-file,
+$BTCHAT_PASSWORD, then the file named by $BTCHAT_PASSWORD_FILE. These also
+skip the security prompt in interactive mode.
+"""
+
+import os
+import sys
+
+PASSWORD_ENV = 'BTCHAT_PASSWORD'
+PASSWORD_FILE_ENV = 'BTCHAT_PASSWORD_FILE'
+
+class HeadlessConfig:
+    """Settings for a headless run, resolved from the command line"""
+
+    def __init__(self, password, input_path='-', keep_open=False, output=None):
+        self.password = password
+        self.input_path = input_path
+        self.keep_open = keep_open
+        self.output = output or sys.stdout
+
+    def make_session(self, transport, encryption=None, **kwargs):
+        """A HeadlessSession writing to this run's output"""
+        from chat_engine import HeadlessSession
+        return HeadlessSession(transport, encryption, output=self.output, keep_open=self.keep_open, **kwargs)
+
+    def run(self, session):
+        """Send the input through a started session until it is done"""
+        if self.input_path == '-':
+            session.run(sys.stdin)
+            return
+        with open(self.input_path, encoding='utf-8') as stream:
+            session.run(stream)
+
+def add_arguments(parser):
+    """Add the headless and password options to an entry point's parser"""
+    parser.add_argument('--headless', action='store_true',
+                        help="no prompts: send lines from --input, print received messages as JSON lines")
+    parser.add_argument('--input', metavar='FILE', default='-',
+                        help="with --headless, read messages from FILE instead of stdin")
+    parser.add_argument('--keep-open', action='store_true',
+                        help="with --headless, stay connected after the input ends")
+    parser.add_argument('--password-file', metavar='FILE',
+                        help=f"read the encryption password from FILE (or set ${PASSWORD_ENV})")
+    parser.add_argument('--no-encryption', action='store_true',
+                        help="send messages in plaintext without asking")
+
+def _read_password_file(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            password = f.readline().rstrip('\r\n')
+    except OSError as e:
+        raise SystemExit(f"Cannot read password file {path}: {e.strerror}")
+    if not password:
+        raise SystemExit(f"Password file {path} is empty")
+    return password
+
+def configured_password(args=None):
+    """The password given by options or environment: (found, password or None)"""
+    if args is not None and args.no_encryption:
+        return True, None
+    if args is not None and args.password_file:
+        return True, _read_password_file(args.password_file)
+    if os.environ.get(PASSWORD_ENV):
+        return True, os.environ[PASSWORD_ENV]
+    if os.environ.get(PASSWORD_FILE_ENV):
+        return True, _read_password_file(os.environ[PASSWORD_FILE_ENV])
+    return False, None
+
+def chat_password(args=None):
+    """The encryption password for this run, asking only if nothing was configured"""
+    found, password = configured_password(args)
+    if found:
+        return password
+    if args is not None and args.headless:
+        raise SystemExit(f"--headless needs a password: set ${PASSWORD_ENV}, "
+                         f"use --password-file or --no-encryption")
+    from encryption import get_chat_password
+    return get_chat_password()
+
+def headless_config(args):
+    """A HeadlessConfig for --headless, or None. Moves status output to stderr"""
+    if not args.headless:
+        return None
+    # The real stdout, not the colorama wrapper: JSON lines need no colour handling
+    config = HeadlessConfig(chat_password(args), args.input, args.keep_open, output=sys.__stdout__)
+    if config.input_path != '-' and not os.path.exists(config.input_path):
+        raise SystemExit(f"Input file {config.input_path} not found")
+    sys.stdout = sys.stderr
+    return config
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Heartbeat for Bluetooth Chat
+A peer that walks out of radio range doesn't close the connection; reads
+just stop arriving. To notice, each side pings the other every
+BTCHAT_HEARTBEAT_INTERVAL seconds (default 5, 0 turns it off) and the peer
+answers with a pong carrying the ping back, which also gives a round-trip
+time for the link.
+
+A ping counts as missed when its interval passes with no pong and nothing
+else received either. After BTCHAT_HEARTBEAT_MISSES misses in a row (default
+3) the link is declared dead and dropped, which starts a reconnect where the
+session has one. Heartbeats are only used when both sides advertise them in
+their HELLO.
+"""
+
+import os
+import statistics
+import struct
+from collections import deque
+
+HEARTBEAT_VERSION = 1
+HEARTBEAT_INTERVAL = float(os.environ.get('BTCHAT_HEARTBEAT_INTERVAL', '5'))
+HEARTBEAT_MISSES = int(os.environ.get('BTCHAT_HEARTBEAT_MISSES', '3'))
+RTT_WINDOW = 100    # Recent round trips kept for /ping
+
+PING = struct.Struct('!QQ')     # Ping id, sender's monotonic clock in ns (echoed back in the pong)
+
+class Heartbeat:
+    """Ping schedule, miss counting and recent round-trip times for one session.
+
+    Only the session loop uses it, so it needs no locking. Times are
+    time.monotonic_ns() values.
+    """
+
+    def __init__(self, interval=HEARTBEAT_INTERVAL, misses=HEARTBEAT_MISSES):
+        self.interval_ns = int(interval * 1e9)
+        self.max_misses = max(1, misses)
+        self.rtts = deque(maxlen=RTT_WINDOW)
+        self.requested = set()     # Ids of pings sent by /ping, reported when answered
+        self.missed = 0
+        self._next_id = 1
+        self._outstanding = None   # (id, sent at) of the last scheduled ping not yet answered
+        self._next_due = 0
+        self._last_heard = 0
+
+    def reset(self, now):
+        """Start over on a new link"""
+        self.missed = 0
+        self.requested.clear()
+        self._outstanding = None
+        self._next_due = now + self.interval_ns
+        self._last_heard = now
+
+    def heard(self, now):
+        """Something arrived from the peer"""
+        self._last_heard = now
+
+    def time_left(self, now):
+        """Seconds until the next ping is due"""
+        return max(0.0, (self._next_due - now) / 1e9)
+
+    def ping(self, now, requested=False):
+        """Body of a new ping"""
+        ping_id = self._next_id
+        self._next_id += 1
+        if requested:
+            self.requested.add(ping_id)
+        return PING.pack(ping_id, now)
+
+    def tick(self, now):
+        """A ping body if one is due now, else None. Counts a miss for the previous ping"""
+        if now < self._next_due:
+            return None
+        self._next_due = now + self.interval_ns
+        if self._outstanding is not None and self._last_heard < self._outstanding[1]:
+            self.missed += 1
+        else:
+            self.missed = 0
+        body = self.ping(now)
+        self._outstanding = (PING.unpack(body)[0], now)
+        return body
+
+    def dead(self):
+        """True once too many pings in a row went unanswered"""
+        return self.missed >= self.max_misses
+
+    def pong(self, body, now):
+        """Handle a pong. Returns (round trip in ns, whether /ping asked for it)"""
+        ping_id, sent = PING.unpack_from(body)
+        rtt = now - sent
+        self.rtts.append(rtt)
+        if self._outstanding is not None and ping_id >= self._outstanding[0]:
+            self._outstanding = None
+            self.missed = 0
+        requested = ping_id in self.requested
+        self.requested.discard(ping_id)
+        return rtt, requested
+
+    def summary(self):
+        """Recent round-trip times in milliseconds"""
+        if not self.rtts:
+            return "no round trips measured yet"
+        rtts = sorted(rtt / 1e6 for rtt in self.rtts)
+        p95 = rtts[min(len(rtts) - 1, int(len(rtts) * 0.95))]
+        return (f"last {len(rtts)}: min {rtts[0]:.1f} ms, median {statistics.median(rtts):.1f} ms, "
+                f"p95 {p95:.1f} ms, max {rtts[-1]:.1f} ms")
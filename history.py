@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+"""
+Message History for Bluetooth Chat
+An append-only log of chat messages on disk, enabled by pointing
+BTCHAT_HISTORY_DIR at a directory. Messages are stored as decrypted text, so
+the directory is created readable by the owner only.
+
+Layout:
+  segment-NNNNNN.log  records appended back to back; a new segment is started
+                      once the current one reaches SEGMENT_SIZE
+  index.dat           one fixed-width (segment, offset) entry per message,
+                      memory-mapped for reads
+
+Message n lives where index entry n points, so opening a history only looks
+at the last entry and reading a page of scrollback touches only the records
+on that page. Records are written before their index entry; a record left
+without one by a crash is cut off the next time the history is opened.
+"""
+
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+from colorama import Fore, Style
+
+HISTORY_DIR = os.environ.get('BTCHAT_HISTORY_DIR', '')
+SEGMENT_SIZE = 64 * 1024 * 1024
+PAGE_SIZE = 20
+
+# crc32, body length, timestamp, direction, flags, peer length
+RECORD_HEADER = struct.Struct('!IIdBBH')
+INDEX_ENTRY = struct.Struct('!IQ')      # segment number, offset in segment
+INDEX_NAME = 'index.dat'
+
+DIRECTION_IN = 0
+DIRECTION_OUT = 1
+
+FLAG_ENCRYPTED = 0x01   # Message was encrypted on the wire
+
+OPEN_FLAGS = os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+READ_FLAGS = os.O_RDONLY | getattr(os, 'O_BINARY', 0)
+
+def _pread(fd, size, offset):
+    if hasattr(os, 'pread'):
+        return os.pread(fd, size, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, size)
+
+def _pwrite(fd, data, offset):
+    if hasattr(os, 'pwrite'):
+        return os.pwrite(fd, data, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.write(fd, data)
+
+class HistoryError(OSError):
+    """Raised when a history record is missing or corrupt"""
+
+class MessageRecord:
+    def __init__(self, timestamp, direction, peer, text, flags=0):
+        self.timestamp = timestamp
+        self.direction = direction
+        self.peer = peer
+        self.text = text
+        self.flags = flags
+
+    def encode(self):
+        peer = self.peer.encode('utf-8')
+        body = self.text.encode('utf-8')
+        header = RECORD_HEADER.pack(0, len(body), self.timestamp, self.direction, self.flags, len(peer))
+        crc = zlib.crc32(body, zlib.crc32(peer, zlib.crc32(header[4:])))
+        return struct.pack('!I', crc) + header[4:] + peer + body
+
+    @classmethod
+    def decode(cls, data):
+        crc, body_length, timestamp, direction, flags, peer_length = RECORD_HEADER.unpack_from(data)
+        start = RECORD_HEADER.size
+        peer = data[start:start + peer_length]
+        body = data[start + peer_length:start + peer_length + body_length]
+        if zlib.crc32(data[4:start + peer_length + body_length]) != crc:
+            raise HistoryError("History record failed its checksum")
+        return cls(timestamp, direction, str(peer, 'utf-8'), str(body, 'utf-8'), flags)
+
+class HistoryStore:
+    """Segmented message log with an mmap'd offset index. Safe to share between threads.
+
+    With read_only=True nothing is created or repaired, so a history that a
+    running chat is appending to can be read alongside it: the store holds
+    the messages indexed when it was opened, and an index entry still being
+    written is ignored. Opening a directory with no history raises OSError.
+    """
+
+    def __init__(self, path, segment_size=SEGMENT_SIZE, read_only=False):
+        self.path = path
+        self.segment_size = segment_size
+        self.read_only = read_only
+        self._lock = threading.Lock()
+        self._segments = {}      # segment number -> open fd
+        self._index_map = None
+        self._mapped_entries = 0
+        if read_only:
+            self._index_fd = os.open(os.path.join(path, INDEX_NAME), READ_FLAGS)
+            self.count = os.fstat(self._index_fd).st_size // INDEX_ENTRY.size
+            return
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        self._index_fd = os.open(os.path.join(path, INDEX_NAME), OPEN_FLAGS | os.O_APPEND, 0o600)
+        self._recover()
+
+    def _recover(self):
+        """Find the append position from the last index entry, dropping partial writes"""
+        index_size = os.fstat(self._index_fd).st_size
+        self.count = index_size // INDEX_ENTRY.size
+        if index_size % INDEX_ENTRY.size:
+            os.ftruncate(self._index_fd, self.count * INDEX_ENTRY.size)
+
+        if self.count == 0:
+            self.segment, self.offset = 0, 0
+        else:
+            entry = _pread(self._index_fd, INDEX_ENTRY.size, (self.count - 1) * INDEX_ENTRY.size)
+            segment, offset = INDEX_ENTRY.unpack(entry)
+            header = _pread(self._segment_fd(segment), RECORD_HEADER.size, offset)
+            _, body_length, _, _, _, peer_length = RECORD_HEADER.unpack(header)
+            self.segment = segment
+            self.offset = offset + RECORD_HEADER.size + peer_length + body_length
+
+        fd = self._segment_fd(self.segment)
+        if os.fstat(fd).st_size > self.offset:
+            os.ftruncate(fd, self.offset)
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, f"segment-{segment:06d}.log")
+
+    def _segment_fd(self, segment):
+        fd = self._segments.get(segment)
+        if fd is None:
+            if self.read_only:
+                fd = os.open(self._segment_path(segment), READ_FLAGS)
+            else:
+                fd = os.open(self._segment_path(segment), OPEN_FLAGS, 0o600)
+            self._segments[segment] = fd
+        return fd
+
+    def __len__(self):
+        return self.count
+
+    # Writing
+
+    def append(self, records):
+        """Append records, writing each touched segment and the index once. Returns the new count"""
+        if self.read_only:
+            raise HistoryError("History was opened read-only")
+        with self._lock:
+            entries = []
+            chunks = []
+            for record in records:
+                data = record.encode()
+                if self.offset and self.offset + len(data) > self.segment_size:
+                    self._write_segment(chunks)
+                    chunks = []
+                    self.segment += 1
+                    self.offset = 0
+                entries.append(INDEX_ENTRY.pack(self.segment, self.offset))
+                chunks.append(data)
+                self.offset += len(data)
+            self._write_segment(chunks)
+            os.write(self._index_fd, b''.join(entries))
+            self.count += len(entries)
+            return self.count
+
+    def _write_segment(self, chunks):
+        if not chunks:
+            return
+        data = b''.join(chunks)
+        _pwrite(self._segment_fd(self.segment), data, self.offset - len(data))
+
+    def sync(self):
+        """Force appended records to disk"""
+        with self._lock:
+            os.fsync(self._segment_fd(self.segment))
+            os.fsync(self._index_fd)
+
+    # Reading
+
+    def _entry(self, number):
+        if number >= self._mapped_entries:
+            if self._index_map is not None:
+                self._index_map.close()
+            self._mapped_entries = self.count
+            self._index_map = mmap.mmap(self._index_fd, self.count * INDEX_ENTRY.size, access=mmap.ACCESS_READ)
+        return INDEX_ENTRY.unpack_from(self._index_map, number * INDEX_ENTRY.size)
+
+    def get(self, number):
+        """Message number (0 is the oldest)"""
+        with self._lock:
+            if not 0 <= number < self.count:
+                raise IndexError("History record out of range")
+            segment, offset = self._entry(number)
+            fd = self._segment_fd(segment)
+            header = _pread(fd, RECORD_HEADER.size, offset)
+            if len(header) < RECORD_HEADER.size:
+                raise HistoryError(f"History record {number} is truncated")
+            _, body_length, _, _, _, peer_length = RECORD_HEADER.unpack(header)
+            data = header + _pread(fd, peer_length + body_length, offset + RECORD_HEADER.size)
+        return MessageRecord.decode(data)
+
+    def page(self, end=None, count=PAGE_SIZE):
+        """The count messages before message number end (default: the newest)"""
+        end = self.count if end is None else min(end, self.count)
+        return [self.get(number) for number in range(max(0, end - count), end)]
+
+    def iter_from(self, start=0):
+        """Yield (number, record) from message number start to the current end"""
+        for number in range(start, self.count):
+            yield number, self.get(number)
+
+    def close(self):
+        with self._lock:
+            if self._index_map is not None:
+                self._index_map.close()
+                self._index_map = None
+            for fd in self._segments.values():
+                os.close(fd)
+            self._segments.clear()
+            os.close(self._index_fd)
+
+class HistoryWriter:
+    """Appends messages to a HistoryStore on a background thread.
+
+    If a search index is given it is brought up to date first and then
+    updated with every batch, on the same thread.
+    """
+
+    def __init__(self, store, search=None):
+        self.store = store
+        self.search = search
+        self._queue = queue.SimpleQueue()
+        self._pending = 0           # Records queued and not yet written, guarded by _written
+        self._written = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='history-writer', daemon=True)
+        self._thread.start()
+
+    def record(self, direction, peer, text, flags=0):
+        """Queue a message for writing. Never blocks on disk"""
+        with self._written:
+            self._pending += 1
+        self._queue.put(MessageRecord(time.time(), direction, peer, text, flags))
+
+    def flush(self, timeout=None):
+        """Wait until queued messages have been written. False on timeout"""
+        with self._written:
+            return self._written.wait_for(lambda: not self._pending, timeout)
+
+    def close(self):
+        """Write what is queued, sync to disk and close the store"""
+        self._queue.put(None)
+        self._thread.join()
+        if self.search is not None:
+            self.search.close()
+        self.store.sync()
+        self.store.close()
+
+    def _run(self):
+        if self.search is not None:
+            try:
+                self.search.catch_up()
+            except OSError as e:
+                print(f"{Fore.RED}Search index update failed: {e}{Style.RESET_ALL}")
+        while True:
+            records = [self._queue.get()]
+            # Write everything that piled up in one go
+            while True:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            closing = None in records
+            records = [record for record in records if record is not None]
+            if records:
+                try:
+                    count = self.store.append(records)
+                    if self.search is not None:
+                        self.search.add(count - len(records), records)
+                except OSError as e:
+                    print(f"{Fore.RED}History write failed: {e}{Style.RESET_ALL}")
+            with self._written:
+                self._pending -= len(records)
+                if not self._pending:
+                    self._written.notify_all()
+            if closing:
+                return
+
+def format_record(record):
+    """One line of scrollback for a stored message"""
+    when = time.strftime('%Y-%m-%d %H:%M', time.localtime(record.timestamp))
+    if record.direction == DIRECTION_OUT:
+        return f"{Style.DIM}{when}{Style.RESET_ALL} {Fore.GREEN}You: {record.text}{Style.RESET_ALL}"
+    return f"{Style.DIM}{when}{Style.RESET_ALL} {Fore.BLUE}{record.peer}: {record.text}{Style.RESET_ALL}"
+
+def open_history(path=None):
+    """The history store in path or BTCHAT_HISTORY_DIR, or None if history is off"""
+    path = path or HISTORY_DIR
+    if not path:
+        return None
+    return HistoryStore(os.path.expanduser(path))
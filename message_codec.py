@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Chat Message Encoding for Bluetooth Chat
+Turns chat text into the body of a CHAT message and back:
+UTF-8 encode, compress, then encrypt. The body starts with one flags byte
+holding the compression codec and whether the rest is encrypted.
+"""
+
+from compression import MessageCompressor, CompressionError, local_codecs, negotiate_codecs
+from protocol import PROTOCOL_VERSION, check_cipher, exchange_hello
+
+FLAG_ENCRYPTED = 0x80
+CODEC_MASK = 0x0F
+
+class DecodeError(ValueError):
+    """Raised when a chat message cannot be decrypted or decompressed"""
+
+class MessageCodec:
+    def __init__(self, encryption=None, compressor=None):
+        self.encryption = encryption if encryption and encryption.is_encrypted() else None
+        self.compressor = compressor or MessageCompressor(codecs=())
+
+    def encode(self, text, encrypt=True):
+        """Body bytes for a chat message"""
+        codec, data = self.compressor.compress(text.encode('utf-8'))
+        flags = codec
+        if encrypt and self.encryption:
+            data = self.encryption.encrypt_bytes(data)
+            flags |= FLAG_ENCRYPTED
+        return bytes((flags,)) + data
+
+    def plaintext(self, body):
+        """Text of an unencrypted, uncompressed body, else None"""
+        if not body or body[0] != 0:
+            return None
+        try:
+            return str(body[1:], 'utf-8')
+        except UnicodeDecodeError:
+            return None
+
+    def decode(self, body):
+        """Chat text from a message body"""
+        if not body:
+            raise DecodeError("Empty chat message")
+        flags = body[0]
+        data = body[1:]
+
+        if flags & FLAG_ENCRYPTED:
+            if not self.encryption:
+                raise DecodeError("Message is encrypted but encryption is off")
+            try:
+                data = self.encryption.decrypt_bytes(data)
+            except Exception:
+                raise DecodeError("Message failed to decrypt") from None
+        elif self.encryption:
+            raise DecodeError("Unencrypted message on an encrypted session")
+
+        try:
+            data = self.compressor.decompress(flags & CODEC_MASK, data)
+            return str(data, 'utf-8')
+        except (CompressionError, UnicodeDecodeError) as e:
+            raise DecodeError(str(e)) from None
+
+def negotiate_codec(writer, reader, encryption=None, codecs=None, settings=None):
+    """Exchange HELLO with the peer and build the codec for this connection.
+
+    codecs overrides the compression codecs offered (default: BTCHAT_COMPRESSION).
+    settings are extra HELLO fields to send. Raises ProtocolError if the peer
+    encrypts differently. Returns (codec, peer settings).
+    """
+    local = local_codecs() if codecs is None else list(codecs)
+    cipher = encryption.CIPHER if encryption and encryption.is_encrypted() else 'none'
+    hello = dict(settings or {}, version=PROTOCOL_VERSION, cipher=cipher,
+                 max_frame=reader.max_frame_size, compression=local)
+    peer = exchange_hello(writer, reader, hello)
+    check_cipher(cipher, peer)
+    compressor = MessageCompressor(negotiate_codecs(local, peer.get('compression')))
+    return MessageCodec(encryption, compressor), peer
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+Connection Metrics for Bluetooth Chat
+Counters and timing histograms for one chat session: messages and bytes in
+each direction, encryption and decryption time, send queue waits, decode
+errors, reconnects, heartbeat round trips and uptime.
+
+Every value has a single writer (the session loop, the send queue's writer
+thread, or the thread doing the encryption), so recording is plain attribute
+arithmetic with no locks. The one exception is the decrypt histogram while
+decrypt workers are running: they share it under a lock. Readers such as
+/stats and the exporter may see a value one message out of date, which is
+fine for monitoring.
+
+With BTCHAT_METRICS_FILE set, a snapshot is written to that file every
+BTCHAT_METRICS_INTERVAL seconds (default 15) and when the session ends: in
+the Prometheus text format if the name ends in .prom (for node_exporter's
+textfile collector), as JSON otherwise.
+"""
+
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+
+METRICS_FILE = os.environ.get('BTCHAT_METRICS_FILE')
+METRICS_INTERVAL = float(os.environ.get('BTCHAT_METRICS_INTERVAL', '15'))
+
+# Histogram bucket upper bounds in nanoseconds (10 µs to 1 s), plus +Inf.
+# Also used for round-trip times, which over Bluetooth are a few ms to a few 100 ms
+DURATION_BUCKETS_NS = tuple(int(us * 1000) for us in
+                            (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000,
+                             100000, 250000, 500000, 1000000))
+
+class Histogram:
+    """Fixed-bucket histogram of durations in nanoseconds"""
+
+    def __init__(self, bounds=DURATION_BUCKETS_NS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given fraction of samples, or None"""
+        if not self.count:
+            return None
+        target = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float('inf')
+
+    def snapshot(self):
+        """Count, sum and cumulative buckets, in seconds"""
+        cumulative = []
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            cumulative.append([bound / 1e9, seen])
+        return {'count': self.count, 'sum': self.sum / 1e9, 'buckets': cumulative}
+
+    def summary(self):
+        if not self.count:
+            return "none"
+        return (f"{self.count} in avg {self.sum / self.count / 1000:.0f} µs, "
+                f"p50 ≤{_format_bound(self.percentile(0.5))}, p99 ≤{_format_bound(self.percentile(0.99))}")
+
+def _format_bound(bound):
+    if bound == float('inf'):
+        return f">{DURATION_BUCKETS_NS[-1] / 1e6:.0f} ms"
+    if bound >= 1000000:
+        return f"{bound / 1e6:g} ms"
+    return f"{bound / 1000:g} µs"
+
+class ConnectionMetrics:
+    """Counters for one session, kept across reconnects"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.messages_in = 0
+        self.messages_out = 0
+        self.bytes_in = 0            # Frame bytes received, headers included
+        self.decode_errors = 0
+        self.reconnects = 0
+        self.heartbeat_misses = 0
+        self.rtt = Histogram()         # Heartbeat round-trip times
+        self.link_up = True
+        # Send queue totals of links that have been replaced
+        self.retired_bytes_out = 0
+        self.retired_wait_time = 0.0
+        self.retired_full_events = 0
+        self.retired_dropped = 0
+
+    def retire_writer(self, writer):
+        """Keep the totals of a send queue that is being closed after a drop"""
+        stats = writer.stats
+        self.retired_bytes_out += stats.bytes
+        self.retired_wait_time += stats.wait_time
+        self.retired_full_events += stats.full_events
+        self.retired_dropped += stats.dropped
+
+    def uptime(self):
+        return time.monotonic() - self.started
+
+    def snapshot(self, writer=None, encryption=None):
+        """Every metric as a JSON-friendly dict"""
+        stats = writer.stats if writer is not None else None
+        snapshot = {
+            'uptime_seconds': round(self.uptime(), 3),
+            'link_up': self.link_up,
+            'reconnects': self.reconnects,
+            'messages_in': self.messages_in,
+            'messages_out': self.messages_out,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.retired_bytes_out + (stats.bytes if stats else 0),
+            'decode_errors': self.decode_errors,
+            'send_queue_wait_seconds': round(self.retired_wait_time + (stats.wait_time if stats else 0.0), 6),
+            'send_queue_full_events': self.retired_full_events + (stats.full_events if stats else 0),
+            'send_queue_dropped': self.retired_dropped + (stats.dropped if stats else 0),
+            'send_queue_depth': writer.depth() if writer is not None else 0,
+            'heartbeat_misses': self.heartbeat_misses,
+            'rtt_seconds': self.rtt.snapshot(),
+        }
+        if encryption is not None:
+            snapshot['encrypt_seconds'] = encryption.encrypt_time.snapshot()
+            snapshot['decrypt_seconds'] = encryption.decrypt_time.snapshot()
+        return snapshot
+
+# Counters whose Prometheus name ends in _total, with their help text
+PROMETHEUS_COUNTERS = {
+    'reconnects': "Reconnections after a dropped link",
+    'messages_in': "Chat messages received",
+    'messages_out': "Chat messages sent",
+    'bytes_in': "Bytes received, frame headers included",
+    'bytes_out': "Bytes sent, frame headers included",
+    'decode_errors': "Received messages that failed to decrypt or decompress",
+    'send_queue_wait_seconds': "Time producers spent waiting for send queue space",
+    'send_queue_full_events': "Times a producer found the send queue full",
+    'send_queue_dropped': "Chat messages dropped because the send queue was full",
+    'heartbeat_misses': "Heartbeat pings that went unanswered",
+}
+PROMETHEUS_GAUGES = {
+    'uptime_seconds': "Seconds since the session started",
+    'link_up': "1 while the link to the peer is up",
+    'send_queue_depth': "Frames waiting in the send queue",
+}
+PROMETHEUS_HISTOGRAMS = {
+    'rtt_seconds': "Heartbeat round-trip time",
+    'encrypt_seconds': "Time to encrypt one chat message",
+    'decrypt_seconds': "Time to decrypt one chat message",
+}
+
+def _label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_prometheus(snapshot, labels):
+    """A snapshot in the Prometheus text exposition format"""
+    label_text = ','.join(f'{name}="{_label_value(value)}"' for name, value in labels.items())
+    lines = []
+    for key, help_text in PROMETHEUS_GAUGES.items():
+        lines += [f"# HELP btchat_{key} {help_text}", f"# TYPE btchat_{key} gauge",
+                  f"btchat_{key}{{{label_text}}} {float(snapshot[key])}"]
+    for key, help_text in PROMETHEUS_COUNTERS.items():
+        name = f"btchat_{key}_total"
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter",
+                  f"{name}{{{label_text}}} {snapshot[key]}"]
+    for key, help_text in PROMETHEUS_HISTOGRAMS.items():
+        if key not in snapshot:
+            continue
+        histogram = snapshot[key]
+        name = f"btchat_{key}"
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+        prefix = f"{label_text}," if label_text else ""
+        for bound, count in histogram['buckets']:
+            lines.append(f'{name}_bucket{{{prefix}le="{bound:g}"}} {count}')
+        lines += [f'{name}_bucket{{{prefix}le="+Inf"}} {histogram["count"]}',
+                  f"{name}_sum{{{label_text}}} {histogram['sum']:.9f}",
+                  f"{name}_count{{{label_text}}} {histogram['count']}"]
+    return '\n'.join(lines) + '\n'
+
+class MetricsExporter:
+    """Writes a session's metrics to a file every interval seconds.
+
+    collect returns (snapshot, labels). The file is replaced atomically so a
+    collector never reads half of it.
+    """
+
+    def __init__(self, collect, path=METRICS_FILE, interval=METRICS_INTERVAL):
+        self.collect = collect
+        self.path = path
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='metrics-exporter', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.write()
+
+    def write(self):
+        snapshot, labels = self.collect()
+        if self.path.endswith('.prom'):
+            text = format_prometheus(snapshot, labels)
+        else:
+            text = json.dumps(dict(labels, time=round(time.time(), 3), **snapshot)) + '\n'
+        temporary = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(temporary, 'w') as f:
+                f.write(text)
+            os.replace(temporary, self.path)
+        except OSError:
+            pass    # Metrics are best effort; never fail a chat over them
+
+    def close(self):
+        """Stop the timer and write the final numbers"""
+        self._stopped.set()
+        self._thread.join(1.0)
+        self.write()
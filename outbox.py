@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""
+Store-and-Forward Outbox for Bluetooth Chat
+Every chat message sent to a peer that supports it gets a sequence number and
+is kept in an on-disk outbox until the peer acknowledges it. After a
+handshake each side tells the other the highest sequence number it has
+received from it; anything newer still in the outbox is sent again, and the
+receiver drops sequence numbers it has already seen.
+
+Peers are told apart by a random node id created once per state directory.
+State lives in BTCHAT_STATE_DIR (default ~/.btchat):
+  node_id               this installation's id
+  outbox/<peer>.log     unacknowledged messages, appended as they are sent
+  outbox/<peer>.ack     highest sequence number the peer acknowledged
+  received.json         highest sequence number received from each peer
+  endpoints/<name>/     the same files for a server endpoint, so a server and
+                        a client on one machine are separate nodes
+
+Messages are stored exactly as sent, so with encryption on the outbox only
+holds ciphertext.
+"""
+
+import json
+import os
+import re
+import struct
+import tempfile
+import threading
+import time
+from collections import deque
+
+STATE_DIR = os.path.expanduser(os.environ.get('BTCHAT_STATE_DIR', os.path.join('~', '.btchat')))
+OUTBOX_VERSION = 1
+COMPACT_BYTES = 1024 * 1024      # Rewrite the log once this much of it is acknowledged
+SAVE_INTERVAL = 1.0              # Minimum seconds between writes of received.json
+
+SEQ = struct.Struct('!Q')
+ENTRY = struct.Struct('!QI')     # sequence number, body length
+
+def _safe_name(name):
+    return re.sub(r'[^0-9A-Za-z_-]', '_', name)
+
+def endpoint_state_dir(endpoint, state_dir=STATE_DIR):
+    """State directory of a named endpoint, such as a server's listening address"""
+    return os.path.join(state_dir, 'endpoints', _safe_name(endpoint))
+
+def _state_dir(state_dir):
+    os.makedirs(state_dir, mode=0o700, exist_ok=True)
+    return state_dir
+
+def _open_private(path, mode):
+    """Open a file that only the owner can read, as the outbox may hold plaintext"""
+    flags = os.O_WRONLY | os.O_CREAT | (os.O_APPEND if mode == 'ab' else os.O_TRUNC)
+    return open(os.open(path, flags | getattr(os, 'O_BINARY', 0), 0o600), mode)
+
+def _replace_file(path, data):
+    # A unique temporary name, as another process may be replacing the same file
+    fd, temporary = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp',
+                                     dir=os.path.dirname(path))
+    try:
+        with open(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+
+def node_id(state_dir=STATE_DIR):
+    """The id of the node using state_dir, created on first use"""
+    path = os.path.join(_state_dir(state_dir), 'node_id')
+    try:
+        with open(path) as f:
+            value = f.read().strip()
+        if value:
+            return value
+    except OSError:
+        pass
+    value = os.urandom(16).hex()
+    _replace_file(path, value.encode('ascii'))
+    return value
+
+class Outbox:
+    """Outgoing messages to one peer, kept on disk until acknowledged"""
+
+    def __init__(self, peer, state_dir=STATE_DIR):
+        directory = os.path.join(_state_dir(state_dir), 'outbox')
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        name = _safe_name(peer)
+        self.log_path = os.path.join(directory, name + '.log')
+        self.ack_path = os.path.join(directory, name + '.ack')
+        self.pending = deque()       # (seq, body) not yet acknowledged, oldest first
+        self.acked = self._load_ack()
+        self.next_seq = self.acked + 1
+        self._log_bytes = 0
+        self._lock = threading.Lock()
+        self._load_log()
+        self._log = _open_private(self.log_path, 'ab')
+
+    def _load_ack(self):
+        try:
+            with open(self.ack_path, 'rb') as f:
+                return SEQ.unpack(f.read(SEQ.size))[0]
+        except (OSError, struct.error):
+            return 0
+
+    def _load_log(self):
+        try:
+            with open(self.log_path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return
+        offset = 0
+        while offset + ENTRY.size <= len(data):
+            seq, length = ENTRY.unpack_from(data, offset)
+            end = offset + ENTRY.size + length
+            if end > len(data):
+                break    # Torn write at the end of the log
+            if seq > self.acked:
+                self.pending.append((seq, data[offset + ENTRY.size:end]))
+                self.next_seq = max(self.next_seq, seq + 1)
+            offset = end
+        self._log_bytes = offset
+        if offset < len(data):
+            with open(self.log_path, 'r+b') as f:
+                f.truncate(offset)
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, body, flush=True):
+        """Store a message body and return its sequence number.
+
+        With flush=False the entry stays buffered until the next flush(), so
+        a run of messages costs one write.
+        """
+        body = bytes(body)
+        with self._lock:
+            seq = self.next_seq
+            self.next_seq += 1
+            self._log.write(ENTRY.pack(seq, len(body)) + body)
+            if flush:
+                self._log.flush()
+            self._log_bytes += ENTRY.size + len(body)
+            self.pending.append((seq, body))
+            return seq
+
+    def flush(self):
+        with self._lock:
+            self._log.flush()
+
+    def acknowledge(self, seq):
+        """Forget messages up to and including seq"""
+        with self._lock:
+            if seq <= self.acked:
+                return
+            while self.pending and self.pending[0][0] <= seq:
+                self.pending.popleft()
+            self.acked = seq
+            _replace_file(self.ack_path, SEQ.pack(seq))
+            if not self.pending:
+                self._log.truncate(0)
+                self._log_bytes = 0
+            elif self._log_bytes > COMPACT_BYTES:
+                self._rewrite_log()
+
+    def resume(self, peer_received):
+        """Apply the peer's handshake acknowledgement. Returns the messages to resend"""
+        if peer_received >= self.next_seq:
+            # The peer has seen numbers we have not used: our state was lost or
+            # reset, so renumber what is pending to follow on from the peer
+            with self._lock:
+                self.pending = deque((peer_received + 1 + i, body) for i, (_, body) in enumerate(self.pending))
+                self.next_seq = peer_received + 1 + len(self.pending)
+                self.acked = peer_received
+                _replace_file(self.ack_path, SEQ.pack(peer_received))
+                self._rewrite_log()
+        else:
+            self.acknowledge(peer_received)
+        with self._lock:
+            return list(self.pending)
+
+    def _rewrite_log(self):
+        data = b''.join(ENTRY.pack(seq, len(body)) + body for seq, body in self.pending)
+        self._log.close()
+        _replace_file(self.log_path, data)
+        self._log = _open_private(self.log_path, 'ab')
+        self._log_bytes = len(data)
+
+    def close(self):
+        with self._lock:
+            self._log.flush()
+            os.fsync(self._log.fileno())
+            self._log.close()
+
+class ReceivedState:
+    """Highest sequence number received from each peer, used to drop replays"""
+
+    def __init__(self, state_dir=STATE_DIR):
+        self.path = os.path.join(_state_dir(state_dir), 'received.json')
+        self._dirty = False
+        self._saved_at = 0.0
+        try:
+            with open(self.path) as f:
+                self.last = {peer: int(seq) for peer, seq in json.load(f).items()}
+        except (OSError, ValueError, AttributeError):
+            self.last = {}
+
+    def last_from(self, peer):
+        return self.last.get(peer, 0)
+
+    def accept(self, peer, seq):
+        """Record seq from peer. False if it was already received"""
+        if seq <= self.last.get(peer, 0):
+            return False
+        self.last[peer] = seq
+        self._dirty = True
+        return True
+
+    def save(self, force=False):
+        """Write the state if it changed, at most every SAVE_INTERVAL seconds unless forced"""
+        now = time.monotonic()
+        if not self._dirty or (not force and now - self._saved_at < SAVE_INTERVAL):
+            return
+        _replace_file(self.path, json.dumps(self.last).encode('utf-8'))
+        self._dirty = False
+        self._saved_at = now
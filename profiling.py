@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""
+Hot-Path Profiling for Bluetooth Chat
+Opt-in timing of every stage a message goes through, for finding where a
+slow message spent its time. Turn it on with --profile or BTCHAT_PROFILE,
+giving a comma-separated list of modes:
+
+  stages      time each send and receive stage (the default for --profile)
+  cprofile    also run the session loop under cProfile
+  tracemalloc also trace memory allocations
+
+Stages are timed by wrapping the methods that do the work (codec,
+compressor, encryption, send queue, reader, display) on the session's own
+objects, so with profiling off the hot path runs exactly as before. The
+send queue's socket writes and the renderer's redraws happen on their own
+threads and are timed there; cProfile sees the session loop only.
+
+A summary is printed when the session ends and, with --profile-output FILE
+(or BTCHAT_PROFILE_OUTPUT), written to FILE, with cProfile's raw data in
+FILE.pstats for tools such as snakeviz.
+"""
+
+import os
+import threading
+import time
+
+PROFILE_MODES = ('stages', 'cprofile', 'tracemalloc')
+PROFILE = os.environ.get('BTCHAT_PROFILE', '')
+PROFILE_OUTPUT = os.environ.get('BTCHAT_PROFILE_OUTPUT')
+TOP_FUNCTIONS = 25
+TOP_ALLOCATIONS = 15
+
+# Log2 bucket upper bounds in ns, 128 ns to about 1 s: stages range from
+# a UTF-8 decode to a blocked socket write
+STAGE_BUCKETS_NS = tuple(2 ** i for i in range(7, 31))
+
+# Stage name and what it covers, in pipeline order
+STAGES = (
+    ('send', "send_chat: encode, outbox and queue one message"),
+    ('encode', "UTF-8 encode, compress and encrypt"),
+    ('compress', "compression"),
+    ('encrypt', "encryption"),
+    ('queue', "hand a frame to the send queue (includes waiting for space)"),
+    ('write', "send queue writer: one batch to the socket"),
+    ('read', "one recv() from the socket"),
+    ('handle', "handle one received message"),
+    ('decode', "decrypt, decompress and UTF-8 decode"),
+    ('decrypt', "decryption"),
+    ('decompress', "decompression"),
+    ('render', "show the message (terminal output or JSON line)"),
+    ('history', "store the message in the history log"),
+    ('draw', "renderer: one screen redraw"),
+)
+
+def add_arguments(parser):
+    """Add the profiling options to an entry point's parser"""
+    parser.add_argument('--profile', nargs='?', const='stages', metavar='MODES',
+                        help=f"time each message stage; MODES is a comma list of {', '.join(PROFILE_MODES)} "
+                             f"(default: stages, or $BTCHAT_PROFILE)")
+    parser.add_argument('--profile-output', metavar='FILE',
+                        help="also write the profile report to FILE (default: $BTCHAT_PROFILE_OUTPUT)")
+
+def parse_modes(text):
+    """Set of profiling modes from a comma list. '1'/'on' mean stages"""
+    modes = set()
+    for mode in (text or '').lower().split(','):
+        mode = mode.strip()
+        if mode in ('', '0', 'off', 'no', 'false'):
+            continue
+        if mode in ('1', 'on', 'yes', 'true'):
+            mode = 'stages'
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Unknown profile mode {mode!r}, expected {', '.join(PROFILE_MODES)}")
+        modes.add(mode)
+    if modes:
+        modes.add('stages')
+    return modes
+
+def configure(args):
+    """Apply --profile/--profile-output over the environment settings"""
+    global PROFILE, PROFILE_OUTPUT
+    if args.profile:
+        PROFILE = args.profile
+    if args.profile_output:
+        PROFILE_OUTPUT = args.profile_output
+        PROFILE = PROFILE or 'stages'
+    try:
+        parse_modes(PROFILE)
+    except ValueError as e:
+        raise SystemExit(str(e))
+
+def session_profiler():
+    """A SessionProfiler if profiling is on, else None"""
+    modes = parse_modes(PROFILE)
+    return SessionProfiler(modes, PROFILE_OUTPUT) if modes else None
+
+class StageTimer:
+    """Timings of one stage: count, total, max and a log2 histogram.
+
+    Decryption is timed on every DecryptPool worker at once, so observe() locks.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self.counts = [0] * (len(STAGE_BUCKETS_NS) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def observe(self, elapsed):
+        index = min(max(elapsed.bit_length() - 7, 0), len(STAGE_BUCKETS_NS))
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += elapsed
+            if elapsed > self.max:
+                self.max = elapsed
+
+    def percentile(self, fraction):
+        """Upper bound in ns of the bucket holding the given fraction of samples"""
+        target = fraction * self.count
+        seen = 0
+        for bound, count in zip(STAGE_BUCKETS_NS, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return self.max
+
+def _timed(method, timer):
+    perf_counter_ns = time.perf_counter_ns
+
+    def timed(*args, **kwargs):
+        started = perf_counter_ns()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            timer.observe(perf_counter_ns() - started)
+    timed.profiled = True
+    return timed
+
+def _format_ns(value):
+    if value >= 1000000:
+        return f"{value / 1e6:.2f} ms"
+    if value >= 1000:
+        return f"{value / 1000:.1f} µs"
+    return f"{value:.0f} ns"
+
+class SessionProfiler:
+    """Stage timers and optional cProfile/tracemalloc for one session"""
+
+    def __init__(self, modes, output=None):
+        self.modes = modes
+        self.output = output
+        self.timers = {name: StageTimer(name) for name, _ in STAGES}
+        self._cprofile = None
+        self._tracing = False
+        self._started = None
+        self._elapsed = 0.0
+
+    def _wrap(self, owner, name, stage):
+        if owner is None:
+            return
+        method = getattr(owner, name)
+        if getattr(method, 'profiled', False):
+            return      # Shared object already wrapped (the encryption survives reconnects)
+        setattr(owner, name, _timed(method, self.timers[stage]))
+
+    def instrument(self, session):
+        """Time the stages of a session's current link. Called again after each reconnect"""
+        self._wrap(session, 'send_chat', 'send')
+        self._wrap(session, 'handle_payload', 'handle')
+        self._wrap(session, 'show_incoming', 'render')
+        self._wrap(session, 'record', 'history')
+        self._wrap(session.codec, 'encode', 'encode')
+        self._wrap(session.codec, 'decode', 'decode')
+        self._wrap(session.codec.compressor, 'compress', 'compress')
+        self._wrap(session.codec.compressor, 'decompress', 'decompress')
+        self._wrap(session.encryption, 'encrypt_bytes', 'encrypt')
+        self._wrap(session.encryption, 'decrypt_bytes', 'decrypt')
+        self._wrap(session.writer, 'send', 'queue')
+        self._wrap(session.writer, '_write_buffers', 'write')
+        self._wrap(session.reader, 'recv_once', 'read')
+        self._wrap(session.renderer, '_draw', 'draw')
+
+    def start(self):
+        """Begin whole-loop profiling on the calling thread"""
+        self._started = time.perf_counter()
+        if 'tracemalloc' in self.modes:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._tracing = True
+        if 'cprofile' in self.modes:
+            import cProfile
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+
+    def stop(self):
+        if self._cprofile is not None:
+            self._cprofile.disable()
+        if self._started is not None:
+            self._elapsed += time.perf_counter() - self._started
+            self._started = None
+
+    def stage_report(self):
+        lines = [f"{'stage':<11} {'count':>9} {'total':>10} {'mean':>10} {'p50':>10} {'p99':>10} {'max':>10}"]
+        for name, description in STAGES:
+            timer = self.timers[name]
+            if not timer.count:
+                continue
+            lines.append(f"{name:<11} {timer.count:>9} {_format_ns(timer.total):>10} "
+                         f"{_format_ns(timer.total / timer.count):>10} {'≤' + _format_ns(timer.percentile(0.5)):>10} "
+                         f"{'≤' + _format_ns(timer.percentile(0.99)):>10} {_format_ns(timer.max):>10}")
+        if len(lines) == 1:
+            lines.append("(no messages)")
+        return lines
+
+    def report(self):
+        """The full report as text. Stops tracemalloc if this profiler started it"""
+        sections = [f"Stage timings over {self._elapsed:.1f}s of chat "
+                    f"(stages nest: send > encode > compress/encrypt, handle > decode > decrypt/decompress)",
+                    *self.stage_report()]
+        if self._cprofile is not None:
+            import io
+            import pstats
+            text = io.StringIO()
+            pstats.Stats(self._cprofile, stream=text).sort_stats('cumulative').print_stats(TOP_FUNCTIONS)
+            sections += ["", f"cProfile, session loop, top {TOP_FUNCTIONS} by cumulative time:", text.getvalue().strip()]
+        if self._tracing:
+            import tracemalloc
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            self._tracing = False
+            sections += ["", f"tracemalloc: {current / 1024:.0f} KB held, peak {peak / 1024:.0f} KB; "
+                             f"top {TOP_ALLOCATIONS} allocation sites:"]
+            sections += [str(stat) for stat in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]]
+        return '\n'.join(sections) + '\n'
+
+    def write(self, text):
+        """Write the report (and raw cProfile data) to the output file, if one was given"""
+        if not self.output:
+            return None
+        with open(self.output, 'w') as f:
+            f.write(text)
+        if self._cprofile is not None:
+            self._cprofile.dump_stats(self.output + '.pstats')
+        return self.output
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Message Types for Bluetooth Chat
+Every frame payload starts with a one-byte message type followed by the
+message body, so chat text and control traffic such as file transfers can
+share one connection. Receivers dispatch on the type alone and ignore types
+they don't know, so new message types don't break older peers.
+
+Every connection starts with a HELLO from each side: a JSON object of the
+sender's protocol version and capabilities (cipher, compression codecs,
+largest frame it accepts, plus optional features such as the outbox and
+heartbeat). Each side uses the lower of the two versions. A peer that sends
+no version is version 1, which ends a session by sending the plaintext chat
+message "quit" instead of a CONTROL BYE.
+"""
+
+import json
+import struct
+
+MSG_CHAT = 0x01
+MSG_HELLO = 0x02    # First message on every connection: JSON session settings
+MSG_CHAT_SEQ = 0x03     # Chat message with an outbox sequence number in front of the body
+MSG_CHAT_ACK = 0x04     # Highest chat sequence number received so far
+MSG_PING = 0x05         # Heartbeat request; the body is echoed back in the pong
+MSG_PONG = 0x06
+MSG_CONTROL = 0x07      # Session control: one control code, then a code-specific body
+
+CONTROL_BYE = 0x01      # The sender is leaving; don't reconnect
+
+MSG_FILE_OFFER = 0x10
+MSG_FILE_ACCEPT = 0x11
+MSG_FILE_REJECT = 0x12
+MSG_FILE_BEGIN = 0x13
+MSG_FILE_DATA = 0x14
+MSG_FILE_END = 0x15
+MSG_FILE_ACK = 0x16
+
+FILE_MESSAGES = frozenset((
+    MSG_FILE_OFFER, MSG_FILE_ACCEPT, MSG_FILE_REJECT,
+    MSG_FILE_BEGIN, MSG_FILE_DATA, MSG_FILE_END, MSG_FILE_ACK,
+))
+
+PROTOCOL_VERSION = 2
+LEGACY_VERSION = 1      # Peers whose HELLO has no version
+LEGACY_QUIT = ('quit', 'exit')      # Plaintext chat that ends a version 1 session
+
+CONTROL = struct.Struct('!B')
+
+HANDSHAKE_TIMEOUT = 15.0
+
+_TYPE_BYTES = [bytes((kind,)) for kind in range(256)]
+
+class ProtocolError(ConnectionError):
+    """Raised when a peer sends a message that cannot be parsed"""
+
+def type_byte(kind):
+    """One-byte prefix for a message type"""
+    return _TYPE_BYTES[kind]
+
+def pack_message(kind, body=b''):
+    """Build a frame payload for a message"""
+    return _TYPE_BYTES[kind] + body
+
+def unpack_message(payload):
+    """Split a frame payload into (type, body)"""
+    if not payload:
+        raise ProtocolError("Empty message")
+    return payload[0], memoryview(payload)[1:]
+
+def send_message(writer, kind, *parts, droppable=False, control=False, key=None, wait=True):
+    """Send a message as a single frame. False if the writer dropped it, or found no room with wait=False.
+
+    control=True never waits for queue space (see send_queue.py); use it for
+    anything the session loop sends in reply to the peer.
+    """
+    return writer.send(_TYPE_BYTES[kind], *parts, droppable=droppable, control=control, key=key, wait=wait)
+
+def peer_version(peer):
+    """Protocol version to use with a peer, from its HELLO settings"""
+    try:
+        version = int(peer.get('version', LEGACY_VERSION))
+    except (TypeError, ValueError):
+        raise ProtocolError("Malformed protocol version in HELLO") from None
+    return max(LEGACY_VERSION, min(version, PROTOCOL_VERSION))
+
+def check_cipher(local, peer):
+    """Refuse a peer that encrypts differently. Version 1 peers don't say, so they pass"""
+    remote = peer.get('cipher')
+    if remote is not None and remote != local:
+        raise ProtocolError(f"Peer uses encryption '{remote}' but this side uses '{local}'")
+
+def send_bye(writer, version, codec, control=False):
+    """Tell the peer we are leaving, the way its protocol version understands"""
+    if version >= 2:
+        send_message(writer, MSG_CONTROL, CONTROL.pack(CONTROL_BYE), control=control)
+    else:
+        send_message(writer, MSG_CHAT, codec.encode(LEGACY_QUIT[0], encrypt=False), control=control)
+
+def exchange_hello(writer, reader, settings, timeout=HANDSHAKE_TIMEOUT):
+    """Send our HELLO and wait for the peer's. Returns the peer's settings dict"""
+    send_message(writer, MSG_HELLO, json.dumps(settings).encode('utf-8'))
+
+    sock = reader.sock
+    previous_timeout = sock.gettimeout() if hasattr(sock, 'gettimeout') else None
+    if hasattr(sock, 'settimeout'):
+        sock.settimeout(timeout)
+    try:
+        payload = reader.read_frame()
+    finally:
+        if hasattr(sock, 'settimeout'):
+            sock.settimeout(previous_timeout)
+
+    if payload is None:
+        raise ProtocolError("Connection closed during handshake")
+    kind, body = unpack_message(payload)
+    if kind != MSG_HELLO:
+        raise ProtocolError(f"Expected HELLO, got message type {kind}")
+    try:
+        return json.loads(bytes(body).decode('utf-8'))
+    except ValueError:
+        raise ProtocolError("Malformed HELLO") from None
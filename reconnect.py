@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""
+Reconnect Policy for Bluetooth Chat
+When a link drops without the peer quitting, the session keeps running and
+tries to get the same peer back: the client dials it again and the server
+accepts it again. Nothing is rediscovered and the password is not asked for
+again, since the session still holds the derived key.
+
+Attempts back off exponentially with jitter, so two sides that lost the link
+together don't retry in lockstep. The first attempt is made at once, which
+makes a short blip cost one connect and one handshake.
+
+BTCHAT_RECONNECT=off turns this off; BTCHAT_RECONNECT_TIMEOUT is how many
+seconds to keep trying (default 120).
+"""
+
+import os
+import random
+
+RECONNECT = os.environ.get('BTCHAT_RECONNECT', 'on').lower() not in ('0', 'off', 'no', 'false')
+RECONNECT_TIMEOUT = float(os.environ.get('BTCHAT_RECONNECT_TIMEOUT', '120'))
+CONNECT_TIMEOUT = 5.0       # Per-attempt limit for dialling the peer
+
+BACKOFF_INITIAL = 0.05
+BACKOFF_MAX = 5.0
+BACKOFF_FACTOR = 2.0
+
+class Backoff:
+    """Delays between reconnect attempts: 0, then exponential with jitter"""
+
+    def __init__(self, initial=BACKOFF_INITIAL, maximum=BACKOFF_MAX, factor=BACKOFF_FACTOR):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.attempts = 0
+
+    def next_delay(self):
+        """Seconds to wait before the next attempt"""
+        attempts = self.attempts
+        self.attempts += 1
+        if attempts == 0:
+            return 0.0
+        ceiling = min(self.maximum, self.initial * self.factor ** (attempts - 1))
+        # Half fixed, half random: spreads retries without collapsing to zero
+        return ceiling / 2 + random.uniform(0, ceiling / 2)
+
+    def reset(self):
+        self.attempts = 0
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Multi-Process Relay for the Chat Simulation
+Runs the asyncio relay (async_server.py) in N worker processes. All of them
+listen on the same port with SO_REUSEPORT, so the kernel spreads new
+connections across them and each worker keeps its own core busy.
+
+Every pair of workers is joined by a Unix socket pair. A frame from a client
+is relayed to the other clients on its own worker and written once to every
+other worker, which relays it to its own clients. Frames keep their length
+prefix, so the links between workers carry the same bytes as the client
+connections.
+
+Each worker prints its own totals when the relay stops (Ctrl+C, or SIGTERM
+to the parent process).
+"""
+
+import asyncio
+import multiprocessing
+import signal
+import socket
+from colorama import Fore, Style
+from async_server import AsyncChatSimServer
+from framing import HEADER
+
+def reuse_port_supported():
+    return hasattr(socket, 'SO_REUSEPORT')
+
+class WorkerRelay(AsyncChatSimServer):
+    """One worker's relay: its own clients plus links to the other workers"""
+
+    def __init__(self, worker_id, links, host, port, **kwargs):
+        super().__init__(host, port, reuse_port=True, **kwargs)
+        self.worker_id = worker_id
+        self.link_sockets = links
+        self.links = []             # Stream writers to the other workers
+        self.frames_forwarded = 0   # Client frames written to the other workers
+        self.frames_routed_in = 0   # Frames that came from another worker
+
+    async def start(self):
+        for sock in self.link_sockets:
+            reader, writer = await asyncio.open_unix_connection(sock=sock)
+            self.links.append(writer)
+            asyncio.ensure_future(self.read_link(reader))
+        return await super().start()
+
+    async def read_link(self, reader):
+        """Relay frames from another worker to this worker's clients"""
+        try:
+            while True:
+                header = await reader.readexactly(HEADER.size)
+                (length,) = HEADER.unpack(header)
+                payload = await reader.readexactly(length)
+                self.frames_routed_in += 1
+                super().broadcast(None, header + payload)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass    # That worker stopped
+
+    async def serve(self):
+        """Relay until SIGINT or SIGTERM, then disconnect everyone and return"""
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)
+        await self.start()
+        async with self.server:
+            await stop.wait()
+        for peer in list(self.peers.values()):
+            peer.writer.close()
+        for link in self.links:
+            link.close()
+        # Let the client and link tasks see their connections close and finish
+        tasks = asyncio.all_tasks() - {asyncio.current_task()}
+        if tasks:
+            await asyncio.wait(tasks, timeout=1.0)
+
+    def broadcast(self, sender, frame):
+        super().broadcast(sender, frame)
+        for link in self.links:
+            link.write(frame)
+            self.frames_forwarded += 1
+
+    def print_stats(self):
+        # Every worker prints at once: the newline goes before the colour reset so
+        # colorama writes the whole line in one write and lines don't interleave
+        print(f"{Fore.CYAN}Worker {self.worker_id}: {self.next_peer_id - 1} client(s) served, "
+              f"{len(self.peers)} online; relayed {self.frames_relayed} frames ({self.bytes_relayed} bytes), "
+              f"{self.frames_forwarded} sent to and {self.frames_routed_in} received from other workers, "
+              f"{self.slow_disconnects} slow client(s) dropped\n{Style.RESET_ALL}", end='', flush=True)
+
+def run_worker(worker_id, links, host, port):
+    """Entry point of one worker process"""
+    relay = WorkerRelay(worker_id, links, host, port, verbose=False)
+    try:
+        asyncio.run(relay.serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        relay.print_stats()
+
+def run_relay_workers(host, port, workers, verbose=True):
+    """Run the relay in worker processes until interrupted"""
+    if not reuse_port_supported():
+        raise SystemExit("--workers needs SO_REUSEPORT, which this platform doesn't have")
+
+    # Hold the port (and pick one if port is 0) until the workers are gone.
+    # A bound socket that doesn't listen is never given connections
+    family = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)[0][0]
+    reserved = socket.socket(family, socket.SOCK_STREAM)
+    reserved.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    reserved.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    reserved.bind((host, port))
+    port = reserved.getsockname()[1]
+
+    links = [[] for _ in range(workers)]
+    for a in range(workers):
+        for b in range(a + 1, workers):
+            left, right = socket.socketpair()
+            links[a].append(left)
+            links[b].append(right)
+
+    processes = [multiprocessing.Process(target=run_worker, args=(worker_id + 1, links[worker_id], host, port),
+                                         name=f"relay-worker-{worker_id + 1}", daemon=True)
+                 for worker_id in range(workers)]
+    for process in processes:
+        process.start()
+    for sock in (sock for worker_links in links for sock in worker_links):
+        sock.close()
+    if verbose:
+        print(f"{Fore.GREEN}Async relay listening on {host}:{port} with {workers} worker processes...{Style.RESET_ALL}")
+        print(f"{Fore.MAGENTA}Messages from each client are relayed to all other clients.{Style.RESET_ALL}")
+
+    def terminate(signum, frame):
+        for process in processes:
+            process.terminate()
+
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        if verbose:
+            print(f"\n{Fore.YELLOW}Shutting down server...{Style.RESET_ALL}")
+        for process in processes:   # The workers got the Ctrl+C as well
+            process.join()
+    finally:
+        reserved.close()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Terminal Renderer for Bluetooth Chat
+Chat output is handed to a Renderer instead of being printed directly. A
+drawing thread writes everything that arrived since the last frame with one
+stdout write, at most BTCHAT_RENDER_FPS times a second, so a flood of
+messages costs a few large writes and the receive loop never waits on the
+terminal. Recent lines are kept in a fixed-size ring buffer for redraws, and
+when the line being typed is known it is drawn again below new output
+instead of being overwritten.
+"""
+
+import os
+import sys
+import threading
+import time
+from collections import deque
+from colorama import Fore, Style
+
+DEFAULT_FPS = float(os.environ.get('BTCHAT_RENDER_FPS', '30'))
+SCROLLBACK_LINES = 1000
+PROMPT = '> '
+
+CLEAR_LINE = '\r\033[K'
+CLEAR_SCREEN = '\033[2J\033[H'
+
+class Renderer:
+    """Batches output lines and draws them at a capped frame rate.
+
+    Also usable as sys.stdout (see capture()), so print() calls from any part
+    of the program are drawn in order with chat messages.
+    """
+
+    def __init__(self, stream=None, fps=DEFAULT_FPS, scrollback=SCROLLBACK_LINES):
+        self.stream = stream or sys.stdout
+        self.interval = 1.0 / fps if fps > 0 else 0.0
+        self.scrollback = deque(maxlen=scrollback)
+        self.input_line = None   # Line being typed, or None if the terminal echoes input itself
+        self.frames = 0
+        self.lines = 0
+        self.skipped = 0
+        self._pending = deque()
+        self._max_pending = scrollback
+        self._skipped_pending = 0
+        self._partial = ''
+        self._input_dirty = False
+        self._redraw = False
+        self._closed = False
+        self._last_frame = 0.0
+        self._prompt_shown = False
+        self._saved_stdout = None
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='renderer', daemon=True)
+        self._thread.start()
+
+    def line(self, text):
+        """Queue one line of output"""
+        with self._cond:
+            self._add_line(text)
+            self._cond.notify()
+
+    def _add_line(self, text):
+        self.scrollback.append(text)
+        if len(self._pending) >= self._max_pending:
+            # More lines than fit in the scrollback arrived within one frame;
+            # the oldest would scroll away unseen, so they are not drawn at all
+            self._pending.popleft()
+            self._skipped_pending += 1
+            self.skipped += 1
+        self._pending.append(text)
+        self.lines += 1
+
+    def set_input(self, text):
+        """Show text as the line currently being typed"""
+        with self._cond:
+            self.input_line = text
+            self._input_dirty = True
+            self._cond.notify()
+
+    def redraw(self):
+        """Clear the screen and draw the scrollback again"""
+        with self._cond:
+            self._redraw = True
+            self._cond.notify()
+
+    # File-like interface for print()
+
+    def write(self, text):
+        with self._cond:
+            lines = (self._partial + text).split('\n')
+            self._partial = lines.pop()
+            for line in lines:
+                self._add_line(line)
+            if lines:
+                self._cond.notify()
+        return len(text)
+
+    def flush(self):
+        """Output is drawn by the next frame; never waits for the terminal"""
+
+    def isatty(self):
+        return self.stream.isatty()
+
+    def fileno(self):
+        return self.stream.fileno()
+
+    @property
+    def encoding(self):
+        return getattr(self.stream, 'encoding', 'utf-8')
+
+    def capture(self):
+        """Route sys.stdout through the renderer until close()"""
+        if self._saved_stdout is None:
+            self._saved_stdout = sys.stdout
+            sys.stdout = self
+
+    def close(self):
+        """Draw what is left, stop the drawing thread and restore sys.stdout"""
+        with self._cond:
+            if self._closed:
+                return
+            if self._partial:
+                self._add_line(self._partial)
+                self._partial = ''
+            self.input_line = None
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        if self._saved_stdout is not None:
+            sys.stdout = self._saved_stdout
+            self._saved_stdout = None
+
+    def summary(self):
+        per_frame = self.lines / self.frames if self.frames else 0.0
+        return f"{self.lines} lines in {self.frames} frames ({per_frame:.1f}/frame), skipped {self.skipped}"
+
+    # Drawing thread
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not (self._pending or self._input_dirty or self._redraw or self._closed):
+                    self._cond.wait()
+                closing = self._closed
+            if not closing:
+                delay = self._last_frame + self.interval - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            self._draw(closing)
+            if closing:
+                return
+
+    def _draw(self, closing=False):
+        with self._cond:
+            if self._redraw:
+                lines = list(self.scrollback)
+                self._pending.clear()
+            else:
+                lines = list(self._pending)
+                self._pending.clear()
+            redraw = self._redraw
+            skipped = self._skipped_pending
+            input_line = self.input_line
+            input_dirty = self._input_dirty
+            self._redraw = self._input_dirty = False
+            self._skipped_pending = 0
+
+        if not (lines or redraw or input_dirty or closing):
+            return
+        parts = []
+        if redraw:
+            parts.append(CLEAR_SCREEN)
+        elif input_line is not None or self._prompt_shown:
+            parts.append(CLEAR_LINE)
+        if skipped and not redraw:
+            parts.append(f"{Fore.YELLOW}... {skipped} lines not shown ...{Style.RESET_ALL}\n")
+        for line in lines:
+            parts.append(line)
+            parts.append('\n')
+        if input_line is not None:
+            parts.append(PROMPT + input_line)
+        self._prompt_shown = input_line is not None
+
+        try:
+            self.stream.write(''.join(parts))
+            self.stream.flush()
+        except (OSError, ValueError):
+            pass
+        self.frames += 1
+        self._last_frame = time.monotonic()
@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+"""
+Full-Text Search for Bluetooth Chat History
+An inverted index from words to the numbers of the history messages that
+contain them. It is kept next to the history (in <history dir>/search) and
+updated by the history writer as messages are stored, so searching never
+rescans the log.
+
+New messages are indexed in memory. Every TAIL_LIMIT messages, and when the
+session ends, the in-memory part is written out as an immutable segment file:
+a sorted table of fixed-width term entries followed by the posting lists,
+memory-mapped for lookups. Segments are merged once there are more than
+MAX_SEGMENTS of them.
+
+Queries match messages containing every word; a word ending in * matches any
+word starting with it. Results are newest first.
+
+Usage:
+  python search_index.py [--dir DIR] [--limit N] QUERY...
+"""
+
+import argparse
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from colorama import init, Fore, Style
+from history import HistoryStore, HISTORY_DIR, format_record
+
+TAIL_LIMIT = 50000          # Messages indexed in memory before a segment is written
+MAX_SEGMENTS = 8
+MAX_TERM_LENGTH = 64
+PREFIX_MIN = 2              # Shortest prefix accepted in a query
+SEARCH_LIMIT = 20
+
+SEGMENT_MAGIC = b'BTSIDX01'
+SEGMENT_HEADER = struct.Struct('!8sQQI')    # magic, first message, end message, term count
+TERM_ENTRY = struct.Struct('!QHQI')         # term offset, term length, postings offset, postings count
+STATE_NAME = 'state.json'
+
+TOKEN_RE = re.compile(r'\w+')
+QUERY_RE = re.compile(r'\w+\*?')
+
+def tokenize(text):
+    """Distinct index terms in a message"""
+    return {token for token in TOKEN_RE.findall(text.lower()) if len(token) <= MAX_TERM_LENGTH}
+
+def parse_query(query):
+    """(term, is_prefix) pairs for a query string"""
+    terms = []
+    for token in QUERY_RE.findall(query.lower()):
+        if token.endswith('*'):
+            if len(token) - 1 >= PREFIX_MIN:
+                terms.append((token[:-1], True))
+        else:
+            terms.append((token, False))
+    return terms
+
+def _uint32_array(values):
+    """Message numbers as little-endian 32-bit integers"""
+    postings = array('I', values)
+    if sys.byteorder == 'big':
+        postings.byteswap()
+    return postings
+
+class IndexSegment:
+    """An immutable, memory-mapped part of the index covering a range of messages"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.first, self.end, self.term_count = SEGMENT_HEADER.unpack_from(self._map)
+        if magic != SEGMENT_MAGIC:
+            self._map.close()
+            raise ValueError(f"{path} is not a search index segment")
+        self._view = memoryview(self._map)
+
+    def _entry(self, position):
+        return TERM_ENTRY.unpack_from(self._map, SEGMENT_HEADER.size + position * TERM_ENTRY.size)
+
+    def _term(self, position):
+        offset, length, _, _ = self._entry(position)
+        return self._map[offset:offset + length]
+
+    def _search(self, key):
+        """First term position not less than key"""
+        low, high = 0, self.term_count
+        while low < high:
+            middle = (low + high) // 2
+            if self._term(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _postings_at(self, position):
+        _, _, offset, count = self._entry(position)
+        view = self._view[offset:offset + 4 * count]
+        if sys.byteorder == 'big':
+            postings = array('I', view.tobytes())
+            postings.byteswap()
+            return postings
+        return view.cast('I')
+
+    def postings(self, term):
+        """Sorted message numbers containing term, or None"""
+        key = term.encode('utf-8')
+        position = self._search(key)
+        if position < self.term_count and self._term(position) == key:
+            return self._postings_at(position)
+        return None
+
+    def prefix_postings(self, prefix):
+        """Posting lists of every term starting with prefix"""
+        key = prefix.encode('utf-8')
+        position = self._search(key)
+        while position < self.term_count and self._term(position).startswith(key):
+            yield self._postings_at(position)
+            position += 1
+
+    def items(self):
+        """Every (term, postings) pair in term order"""
+        for position in range(self.term_count):
+            yield self._term(position).decode('utf-8'), self._postings_at(position)
+
+    def close(self):
+        try:
+            self._view.release()
+            self._map.close()
+        except BufferError:
+            pass    # A caller still holds postings; the map is freed with them
+
+    @staticmethod
+    def write(path, first, end, postings):
+        """Write a segment from a dict of term -> sorted message numbers"""
+        terms = sorted((term.encode('utf-8'), numbers) for term, numbers in postings.items())
+        strings_offset = SEGMENT_HEADER.size + len(terms) * TERM_ENTRY.size
+        strings_size = sum(len(term) for term, _ in terms)
+        postings_offset = (strings_offset + strings_size + 3) & ~3
+
+        entries = []
+        term_offset = strings_offset
+        offset = postings_offset
+        for term, numbers in terms:
+            entries.append(TERM_ENTRY.pack(term_offset, len(term), offset, len(numbers)))
+            term_offset += len(term)
+            offset += 4 * len(numbers)
+
+        temporary = path + '.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, first, end, len(terms)))
+            f.write(b''.join(entries))
+            f.write(b''.join(term for term, _ in terms))
+            f.write(b'\0' * (postings_offset - strings_offset - strings_size))
+            for _, numbers in terms:
+                f.write(_uint32_array(numbers).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+
+class Postings:
+    """Message numbers for one query term, as sorted chunks in message order"""
+
+    def __init__(self, chunks):
+        self.chunks = [chunk for chunk in chunks if len(chunk)]
+
+    def __len__(self):
+        return sum(len(chunk) for chunk in self.chunks)
+
+    def __contains__(self, number):
+        for chunk in self.chunks:
+            if chunk[0] <= number <= chunk[-1]:
+                position = bisect_left(chunk, number)
+                return position < len(chunk) and chunk[position] == number
+        return False
+
+    def newest_first(self):
+        for chunk in reversed(self.chunks):
+            for position in range(len(chunk) - 1, -1, -1):
+                yield chunk[position]
+
+class SearchIndex:
+    """Inverted index over a HistoryStore. Safe to share between threads"""
+
+    def __init__(self, store, path=None, tail_limit=TAIL_LIMIT, persist=True):
+        self.store = store
+        self.path = path or os.path.join(store.path, 'search')
+        self.tail_limit = tail_limit
+        self.persist = persist
+        self.segments = []
+        self._tail = {}
+        self._tail_first = 0
+        self._end = 0
+        self._lock = threading.Lock()
+        if persist:
+            os.makedirs(self.path, mode=0o700, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        try:
+            with open(os.path.join(self.path, STATE_NAME)) as f:
+                state = json.load(f)
+            self.segments = [IndexSegment(os.path.join(self.path, name)) for name in state['segments']]
+        except (OSError, ValueError, KeyError):
+            self.segments = []
+        indexed = self.segments[-1].end if self.segments else 0
+        if indexed > len(self.store):
+            # The history lost messages this index already covers
+            for segment in self.segments:
+                segment.close()
+            self.segments = []
+            indexed = 0
+        self._tail_first = self._end = indexed
+
+    def __len__(self):
+        """Number of history messages indexed so far"""
+        return self._end
+
+    # Updating
+
+    def catch_up(self):
+        """Index messages stored since the index was last written"""
+        for number, record in self.store.iter_from(self._end):
+            self.add(number, [record])
+
+    def add(self, first_number, records):
+        """Index records stored as message numbers first_number onwards"""
+        if first_number > self._end:
+            # Some messages were stored without being indexed; read them back
+            self.catch_up()
+            return
+        with self._lock:
+            for offset, record in enumerate(records):
+                number = first_number + offset
+                if number < self._end:
+                    continue
+                for term in tokenize(record.text):
+                    postings = self._tail.get(term)
+                    if postings is None:
+                        self._tail[term] = postings = array('I')
+                    postings.append(number)
+                self._end = number + 1
+            if self.persist and self._end - self._tail_first >= self.tail_limit:
+                self._write_tail()
+
+    def _write_tail(self):
+        if self._end == self._tail_first:
+            return
+        # Never let the index claim messages that are not safely in the log
+        self.store.sync()
+        name = f"segment-{self._tail_first:010d}.idx"
+        IndexSegment.write(os.path.join(self.path, name), self._tail_first, self._end, self._tail)
+        self.segments.append(IndexSegment(os.path.join(self.path, name)))
+        self._tail = {}
+        self._tail_first = self._end
+        if len(self.segments) > MAX_SEGMENTS:
+            self._merge()
+        self._save_state()
+
+    def _merge(self):
+        """Combine all segments into one"""
+        merged = {}
+        for segment in self.segments:
+            for term, numbers in segment.items():
+                postings = merged.get(term)
+                if postings is None:
+                    merged[term] = postings = array('I')
+                postings.extend(numbers)
+        first, end = self.segments[0].first, self.segments[-1].end
+        name = f"segment-{first:010d}-{end:010d}.idx"
+        IndexSegment.write(os.path.join(self.path, name), first, end, merged)
+        old = self.segments
+        self.segments = [IndexSegment(os.path.join(self.path, name))]
+        self._save_state()
+        for segment in old:
+            segment.close()
+            os.remove(segment.path)
+
+    def _save_state(self):
+        state = {'segments': [os.path.basename(segment.path) for segment in self.segments]}
+        temporary = os.path.join(self.path, STATE_NAME + '.tmp')
+        with open(temporary, 'w') as f:
+            json.dump(state, f)
+        os.replace(temporary, os.path.join(self.path, STATE_NAME))
+
+    # Searching
+
+    def _postings(self, term, prefix):
+        chunks = []
+        if prefix:
+            for segment in self.segments:
+                matches = set()
+                for numbers in segment.prefix_postings(term):
+                    matches.update(numbers)
+                chunks.append(sorted(matches))
+            matches = set()
+            for tail_term, numbers in self._tail.items():
+                if tail_term.startswith(term):
+                    matches.update(numbers)
+            chunks.append(sorted(matches))
+        else:
+            for segment in self.segments:
+                numbers = segment.postings(term)
+                if numbers is not None:
+                    chunks.append(numbers)
+            chunks.append(self._tail.get(term, ()))
+        return Postings(chunks)
+
+    def search(self, query, limit=SEARCH_LIMIT):
+        """Numbers of the newest messages matching query"""
+        terms = parse_query(query)
+        if not terms:
+            return []
+        with self._lock:
+            lists = sorted((self._postings(term, prefix) for term, prefix in terms), key=len)
+            results = []
+            for number in lists[0].newest_first():
+                if all(number in postings for postings in lists[1:]):
+                    results.append(number)
+                    if len(results) >= limit:
+                        break
+        return results
+
+    def close(self):
+        """Write the in-memory part of the index and release the segments"""
+        with self._lock:
+            if self.persist:
+                self._write_tail()
+            for segment in self.segments:
+                segment.close()
+            self.segments = []
+
+def print_results(store, numbers, elapsed):
+    """Print search results oldest to newest, as they appeared in the chat"""
+    for number in reversed(numbers):
+        print(format_record(store.get(number)))
+    print(f"{Fore.CYAN}{len(numbers)} result(s) in {elapsed * 1000:.1f} ms{Style.RESET_ALL}")
+
+def main():
+    """Search chat history from the command line"""
+    init()
+    parser = argparse.ArgumentParser(prog='search_index.py', description="Search chat history")
+    parser.add_argument('query', nargs='+', help="words to find; end a word with * to match a prefix")
+    parser.add_argument('--dir', default=HISTORY_DIR, help="history directory (default: $BTCHAT_HISTORY_DIR)")
+    parser.add_argument('--limit', type=int, default=SEARCH_LIMIT, help=f"maximum results (default: {SEARCH_LIMIT})")
+    args = parser.parse_args()
+
+    if not args.dir:
+        print(f"{Fore.RED}No history directory. Use --dir or set BTCHAT_HISTORY_DIR.{Style.RESET_ALL}")
+        return 1
+    path = os.path.expanduser(args.dir)
+    # Read-only: a running chat may own this history and its index
+    try:
+        store = HistoryStore(path, read_only=True)
+    except OSError as e:
+        print(f"{Fore.RED}No history in {path}: {e.strerror}{Style.RESET_ALL}")
+        return 1
+    index = SearchIndex(store, persist=False)
+    try:
+        index.catch_up()
+        started = time.perf_counter()
+        numbers = index.search(' '.join(args.query), args.limit)
+        print_results(store, numbers, time.perf_counter() - started)
+    finally:
+        index.close()
+        store.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+"""
+Outbound Send Queue for Bluetooth Chat
+A dedicated writer thread owns the socket's send side. Producers (the input
+loop, file transfers, acknowledgements from the receive loop) enqueue frames
+into a bounded queue and return immediately; the writer drains whatever has
+accumulated and writes it with as few system calls as possible.
+
+When the queue is full the configured policy decides what happens:
+  block - the producer waits for space (default)
+  drop  - droppable frames (chat messages) are discarded and counted
+  warn  - like block, but a warning is printed so a stalled link is visible
+Frames that must not be lost, such as file data, always block regardless of
+policy.
+
+Control frames (acknowledgements, heartbeats, file transfer replies) are sent
+by the session loop, which is also the only reader of the socket. If it
+waited for queue space while the peer was waiting for it to read, neither
+side would ever read again. So control frames go through a separate,
+unbounded lane that never blocks, and the writer sends them before the
+queued data. A control frame with a key replaces an unsent one with the same
+key, so a flood of acknowledgements collapses to the latest. Data the session
+loop sends is queued with wait=False, which returns False on a full queue
+instead of waiting; the session keeps it and tries again on a later pass.
+"""
+
+import os
+import socket
+import threading
+import time
+from collections import deque
+from colorama import Fore, Style
+from framing import HEADER, COALESCE_LIMIT, sendall
+
+POLICIES = ('block', 'drop', 'warn')
+DEFAULT_QUEUE_SIZE = int(os.environ.get('BTCHAT_SEND_QUEUE', '256'))
+DEFAULT_POLICY = os.environ.get('BTCHAT_SEND_POLICY', 'block').strip().lower()
+MAX_BATCH_BYTES = 256 * 1024     # Upper bound on one coalesced write
+FLUSH_TIMEOUT = 5.0
+WARN_INTERVAL = 5.0
+
+class FileRegion:
+    """A queued frame whose body is sent from a file with os.sendfile"""
+
+    def __init__(self, head, fd, offset, count):
+        self.head = head
+        self.fd = fd
+        self.offset = offset
+        self.count = count
+
+class SendQueueStats:
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+        self.writes = 0          # Coalesced batches handed to the socket
+        self.dropped = 0
+        self.full_events = 0     # Times a producer found the queue full
+        self.wait_time = 0.0     # Seconds producers spent blocked on a full queue
+        self.max_depth = 0
+
+    def summary(self, depth=0):
+        per_write = self.frames / self.writes if self.writes else 0.0
+        return (f"{self.frames} frames in {self.writes} writes ({per_write:.1f}/write), "
+                f"depth {depth} (max {self.max_depth}), "
+                f"waited {self.wait_time * 1000:.0f} ms, dropped {self.dropped}")
+
+class OutboundQueue:
+    """Bounded, coalescing frame writer. Drop-in replacement for FrameWriter"""
+
+    def __init__(self, sock, maxsize=DEFAULT_QUEUE_SIZE, policy=DEFAULT_POLICY, max_batch=MAX_BATCH_BYTES):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown send queue policy {policy!r}, expected one of {', '.join(POLICIES)}")
+        self.sock = sock
+        self.maxsize = max(1, maxsize)
+        self.policy = policy
+        self.max_batch = max_batch
+        self.stats = SendQueueStats()
+        self.error = None
+        self.on_space = None     # Called by the writer thread when a full queue gets space again
+        self.sendfile = True     # False sends file data from memory even where os.sendfile would work
+        self._items = deque()
+        self._control = deque()     # (key, buffers) of control frames, written first
+        self._cond = threading.Condition()
+        self._closing = False
+        self._stopped = False
+        self._in_flight = 0
+        self._last_warning = 0.0
+        self._sendmsg = getattr(sock, 'sendmsg', None)
+        self._thread = threading.Thread(target=self._run, name='outbound-writer', daemon=True)
+        self._thread.start()
+
+    def depth(self):
+        """Frames waiting to be written"""
+        return len(self._items) + len(self._control)
+
+    def full(self):
+        """True if a blocking send would wait right now"""
+        return len(self._items) >= self.maxsize
+
+    # Producer side
+
+    def send(self, *parts, droppable=False, control=False, key=None, wait=True):
+        """Queue the concatenation of parts as one frame. False if it was dropped.
+
+        control=True sends it through the control lane, which never waits;
+        key then replaces a control frame with the same key not yet sent.
+        wait=False returns False instead of waiting when the queue is full.
+        """
+        length = sum(len(part) for part in parts)
+        header = HEADER.pack(length)
+        if length <= COALESCE_LIMIT:
+            buffers = (header + b''.join(parts),)
+        else:
+            buffers = (header,) + parts
+        if control:
+            return self._put_control(buffers, key)
+        return self._put(buffers, droppable, wait)
+
+    def can_sendfile(self):
+        """True if file regions can be handed to the kernel with os.sendfile"""
+        return self.sendfile and hasattr(os, 'sendfile') and isinstance(self.sock, socket.socket)
+
+    def send_file_region(self, prefix, fd, offset, count):
+        """Queue a frame of prefix plus count bytes of fd at offset.
+
+        fd must stay open until flush() returns.
+        """
+        head = HEADER.pack(len(prefix) + count) + prefix
+        return self._put(FileRegion(head, fd, offset, count), False)
+
+    def _check_open(self):
+        if self.error is not None:
+            raise ConnectionError(f"Send failed: {self.error}") from self.error
+        if self._closing:
+            raise ConnectionError("Send queue is closed")
+
+    def _put(self, item, droppable, wait=True):
+        with self._cond:
+            self._check_open()
+            if len(self._items) >= self.maxsize:
+                self.stats.full_events += 1
+                if self.policy == 'drop' and droppable:
+                    self.stats.dropped += 1
+                    return False
+                if self.policy == 'warn':
+                    self._warn_full()
+                if not wait:
+                    return False
+
+                started = time.perf_counter()
+                while len(self._items) >= self.maxsize and self.error is None and not self._closing:
+                    self._cond.wait()
+                self.stats.wait_time += time.perf_counter() - started
+                self._check_open()
+
+            self._items.append(item)
+            if len(self._items) > self.stats.max_depth:
+                self.stats.max_depth = len(self._items)
+            self._cond.notify_all()
+        return True
+
+    def _put_control(self, buffers, key):
+        with self._cond:
+            self._check_open()
+            if key is not None:
+                for index, (queued_key, _) in enumerate(self._control):
+                    if queued_key == key:
+                        self._control[index] = (key, buffers)
+                        return True
+            self._control.append((key, buffers))
+            self._cond.notify_all()
+        return True
+
+    def _warn_full(self):
+        now = time.monotonic()
+        if now - self._last_warning >= WARN_INTERVAL:
+            self._last_warning = now
+            print(f"{Fore.YELLOW}⚠️  Send queue full ({self.maxsize} frames) - "
+                  f"the link is slower than you are sending{Style.RESET_ALL}")
+
+    def flush(self, timeout=None):
+        """Wait until everything queued so far has been written. False on timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while (self._items or self._control or self._in_flight) and self.error is None and not self._stopped:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return not self._items and not self._control and not self._in_flight
+
+    def close(self, timeout=FLUSH_TIMEOUT):
+        """Flush pending frames and stop the writer. True the first time it is called"""
+        with self._cond:
+            if self._closing:
+                return False
+        self.flush(timeout)
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        return True
+
+    def summary(self):
+        return self.stats.summary(self.depth())
+
+    # Writer thread
+
+    def _next_batch(self):
+        """Pop all control frames and queued frames up to max_batch bytes, or a single file region"""
+        batch = []
+        frames = 0
+        while self._control:
+            batch.extend(self._control.popleft()[1])
+            frames += 1
+        if not frames:
+            first = self._items.popleft()
+            if isinstance(first, FileRegion):
+                return first
+            batch.extend(first)
+            frames = 1
+        size = sum(len(buffer) for buffer in batch)
+        while self._items and size < self.max_batch and not isinstance(self._items[0], FileRegion):
+            item = self._items.popleft()
+            batch.extend(item)
+            size += sum(len(buffer) for buffer in item)
+            frames += 1
+        return batch, frames
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._items and not self._control and not self._closing:
+                    self._cond.wait()
+                if not self._items and not self._control:
+                    self._stopped = True
+                    self._cond.notify_all()
+                    return
+                was_full = len(self._items) >= self.maxsize
+                batch = self._next_batch()
+                self._in_flight = 1
+                self._cond.notify_all()    # Space freed for blocked producers
+            if was_full and self.on_space is not None:
+                self.on_space()
+
+            try:
+                if isinstance(batch, FileRegion):
+                    written, frames = self._write_region(batch), 1
+                else:
+                    buffers, frames = batch
+                    written = self._write_buffers(buffers)
+            except OSError as e:
+                batch = buffers = None
+                with self._cond:
+                    self.error = e
+                    self._items.clear()
+                    self._control.clear()
+                    self._in_flight = 0
+                    self._stopped = True
+                    self._cond.notify_all()
+                return
+
+            # Frames can be views of a caller's buffer (file data from mmap): once
+            # flush() returns the caller may release it, so hold no references past here
+            batch = buffers = None
+            with self._cond:
+                self._in_flight = 0
+                self.stats.frames += frames
+                self.stats.bytes += written
+                self.stats.writes += 1
+                self._cond.notify_all()
+
+    def _write_buffers(self, buffers):
+        """Write a batch of frames, coalescing small buffers and passing large ones through"""
+        total = sum(len(buffer) for buffer in buffers)
+        chunks = []
+        small = []
+        for buffer in buffers:
+            if len(buffer) <= COALESCE_LIMIT:
+                small.append(buffer)
+                continue
+            if small:
+                chunks.append(b''.join(small))
+                small = []
+            chunks.append(buffer)
+        if small:
+            chunks.append(b''.join(small))
+
+        if self._sendmsg is not None and len(chunks) > 1:
+            # Scatter-gather write: one system call for the whole batch
+            pending = deque(memoryview(chunk) for chunk in chunks)
+            while pending:
+                sent = self._sendmsg(pending)
+                while sent:
+                    if sent >= len(pending[0]):
+                        sent -= len(pending.popleft())
+                    else:
+                        pending[0] = pending[0][sent:]
+                        sent = 0
+        else:
+            for chunk in chunks:
+                sendall(self.sock, chunk)
+        return total
+
+    def _write_region(self, region):
+        sendall(self.sock, region.head)
+        offset, count = region.offset, region.count
+        while count:
+            sent = os.sendfile(self.sock.fileno(), region.fd, offset, count)
+            if sent == 0:
+                raise ConnectionError("sendfile wrote no data")
+            offset += sent
+            count -= sent
+        return len(region.head) + region.count
+
+def print_send_queue_stats(queue):
+    """Report send queue behaviour for a finished session"""
+    if queue is not None and queue.stats.frames:
+        print(f"{Fore.CYAN}Send queue: {queue.summary()}{Style.RESET_ALL}")
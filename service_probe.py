@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Chat Service Probing for Bluetooth Chat
+After an inquiry, every discovered device is asked over SDP whether it runs
+the chat service, several at a time, so the client can offer only real chat
+servers with their RFCOMM channels already known. A device that doesn't
+answer within the probe timeout is skipped instead of holding up the rest.
+
+The bluetooth module is passed in, so the probing can be exercised with a
+stand-in that has find_service().
+"""
+
+import os
+import threading
+
+CHAT_SERVICE_UUID = "94f39d29-7d6d-437d-973b-fba39e49d4ee"
+PROBE_WORKERS = int(os.environ.get('BTCHAT_PROBE_WORKERS', '8'))
+PROBE_TIMEOUT = float(os.environ.get('BTCHAT_PROBE_TIMEOUT', '10'))
+
+class ServiceMatch:
+    """A device that advertises the chat service"""
+
+    def __init__(self, address, name, port, service_name):
+        self.address = address
+        self.name = name
+        self.port = port
+        self.service_name = service_name
+
+class ProbeResult:
+    """Outcome of probing one device: a match, nothing, a timeout or an error"""
+
+    def __init__(self, address, name, match=None, error=None, timed_out=False):
+        self.address = address
+        self.name = name
+        self.match = match
+        self.error = error
+        self.timed_out = timed_out
+
+def find_chat_service(bluetooth, address, uuid=CHAT_SERVICE_UUID, timeout=PROBE_TIMEOUT):
+    """SDP lookup for the chat service on one device. Returns the service records.
+
+    find_service() has no timeout of its own, so it runs on a daemon thread
+    that is abandoned if it doesn't finish in time.
+    """
+    outcome = []
+
+    def lookup():
+        try:
+            outcome.append(bluetooth.find_service(uuid=uuid, address=address))
+        except Exception as e:
+            outcome.append(e)
+
+    thread = threading.Thread(target=lookup, name=f"sdp-{address}", daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if not outcome:
+        raise TimeoutError(f"No SDP answer from {address} within {timeout:g}s")
+    if isinstance(outcome[0], Exception):
+        raise outcome[0]
+    return outcome[0]
+
+def _probe_one(bluetooth, address, name, uuid, timeout):
+    try:
+        services = find_chat_service(bluetooth, address, uuid, timeout)
+    except TimeoutError:
+        return ProbeResult(address, name, timed_out=True)
+    except Exception as e:
+        return ProbeResult(address, name, error=e)
+    for service in services:
+        if service.get('port') is not None:
+            return ProbeResult(address, name, ServiceMatch(address, name, service['port'], service.get('name')))
+    return ProbeResult(address, name)
+
+def probe_devices(devices, bluetooth=None, workers=PROBE_WORKERS, timeout=PROBE_TIMEOUT, uuid=CHAT_SERVICE_UUID):
+    """Probe (address, name) pairs concurrently. Returns a ProbeResult per device, in order"""
+    from concurrent.futures import ThreadPoolExecutor
+    if bluetooth is None:
+        import bluetooth
+    if not devices:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(devices))),
+                            thread_name_prefix='sdp-probe') as pool:
+        futures = [pool.submit(_probe_one, bluetooth, address, name, uuid, timeout) for address, name in devices]
+        return [future.result() for future in futures]
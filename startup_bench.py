@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Startup Time Benchmark for Bluetooth Chat
+Launches each entry point in a fresh interpreter and measures the wall-clock
+time until it shows its first prompt (or exits, for commands that only print
+something), then runs it once more under `python -X importtime` to show
+which imports the time goes to.
+
+The median of each entry point is checked against a budget; the exit status
+is 1 if any of them is over it, so scripts and CI can catch a change that
+makes startup slower.
+
+Usage:
+  python startup_bench.py [--runs N] [--budget MS] [--top N] [--output FILE]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from colorama import init, Fore, Style
+
+STARTUP_BUDGET_MS = float(os.environ.get('BTCHAT_STARTUP_BUDGET_MS', '150'))
+STARTUP_RUNS = 5
+PROMPT_TIMEOUT = 10.0
+TOP_IMPORTS = 8
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PASSWORD_PROMPT = b'Enter your choice'
+
+# name, script and arguments, output that marks the first prompt (None: wait for exit)
+ENTRY_POINTS = [
+    ('simulation usage', ['chat_simulation.py'], None),
+    ('simulation server', ['chat_simulation.py', 'server'], PASSWORD_PROMPT),
+    ('simulation client', ['chat_simulation.py', 'client'], PASSWORD_PROMPT),
+    ('bluetooth server', ['bt_chat_server.py'], PASSWORD_PROMPT),
+    ('bluetooth client', ['bt_chat_client.py'], PASSWORD_PROMPT),
+    ('history search', ['search_index.py', '--help'], None),
+]
+
+def launch(arguments, marker, python_options=()):
+    """Start an entry point and wait for marker (or exit). Returns (seconds, stderr)"""
+    command = [sys.executable, *python_options, *arguments]
+    started = time.perf_counter()
+    # A configured password would skip the prompt being timed
+    env = {name: value for name, value in os.environ.items()
+           if name not in ('BTCHAT_PASSWORD', 'BTCHAT_PASSWORD_FILE')}
+    process = subprocess.Popen(command, cwd=HERE, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE, env=dict(env, PYTHONUNBUFFERED='1'))
+    if marker is None:
+        try:
+            _, stderr = process.communicate(timeout=PROMPT_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.communicate()
+            raise
+        return time.perf_counter() - started, stderr
+
+    output = b''
+    try:
+        deadline = started + PROMPT_TIMEOUT
+        while marker not in output:
+            chunk = os.read(process.stdout.fileno(), 4096)
+            if not chunk or time.perf_counter() > deadline:
+                raise RuntimeError(f"{' '.join(arguments)} exited or stalled before its prompt")
+            output += chunk
+        elapsed = time.perf_counter() - started
+    finally:
+        process.kill()
+        _, stderr = process.communicate()
+    return elapsed, stderr
+
+def import_breakdown(stderr, top=TOP_IMPORTS):
+    """The slowest imports made directly by the entry point, from -X importtime output"""
+    imports = []
+    for line in stderr.decode('utf-8', 'replace').splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue    # The header line
+        name = fields[2]
+        if name.startswith('  '):
+            continue    # Nested import, already counted in its parent's cumulative time
+        imports.append({'module': name.strip(), 'self_ms': int(fields[0]) / 1000,
+                        'cumulative_ms': int(fields[1]) / 1000})
+    imports.sort(key=lambda entry: entry['cumulative_ms'], reverse=True)
+    return imports[:top]
+
+def measure(name, arguments, marker, runs, top):
+    """Median time to first prompt over runs, plus the import breakdown"""
+    launch(arguments, marker)   # Warm up: compile bytecode and fill the OS cache
+    times = [launch(arguments, marker)[0] * 1000 for _ in range(runs)]
+    _, stderr = launch(arguments, marker, ('-X', 'importtime'))
+    return {
+        'name': name,
+        'command': ' '.join(arguments),
+        'median_ms': statistics.median(times),
+        'min_ms': min(times),
+        'max_ms': max(times),
+        'imports': import_breakdown(stderr, top),
+    }
+
+def print_result(result, budget):
+    over = result['median_ms'] > budget
+    color = Fore.RED if over else Fore.GREEN
+    print(f"{color}{result['name']:<20} {result['median_ms']:7.1f} ms  "
+          f"(min {result['min_ms']:.1f}, max {result['max_ms']:.1f})"
+          f"{'  OVER BUDGET' if over else ''}{Style.RESET_ALL}")
+    for entry in result['imports']:
+        print(f"{Style.DIM}    {entry['cumulative_ms']:7.1f} ms  {entry['module']}{Style.RESET_ALL}")
+
+def main():
+    """Measure every entry point and check the startup budget"""
+    init()
+    parser = argparse.ArgumentParser(prog='startup_bench.py', description="Measure entry point startup time")
+    parser.add_argument('--runs', type=int, default=STARTUP_RUNS,
+                        help=f"timed launches per entry point (default: {STARTUP_RUNS})")
+    parser.add_argument('--budget', type=float, default=STARTUP_BUDGET_MS,
+                        help=f"maximum median ms to first prompt (default: $BTCHAT_STARTUP_BUDGET_MS "
+                             f"or {STARTUP_BUDGET_MS:g})")
+    parser.add_argument('--top', type=int, default=TOP_IMPORTS,
+                        help=f"imports listed per entry point (default: {TOP_IMPORTS})")
+    parser.add_argument('--output', metavar='FILE', help="write the results as JSON to FILE")
+    args = parser.parse_args()
+
+    print(f"{Fore.CYAN}Startup time to first prompt, median of {args.runs} runs "
+          f"(budget {args.budget:g} ms){Style.RESET_ALL}")
+    results = []
+    failed = []
+    for name, arguments, marker in ENTRY_POINTS:
+        try:
+            result = measure(name, arguments, marker, args.runs, args.top)
+        except (RuntimeError, subprocess.TimeoutExpired) as e:
+            print(f"{Fore.RED}{name:<20} failed: {e}{Style.RESET_ALL}")
+            failed.append(name)
+            continue
+        results.append(result)
+        print_result(result, args.budget)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'budget_ms': args.budget, 'python': sys.version.split()[0], 'results': results}, f, indent=2)
+        print(f"{Fore.GREEN}Results written to {args.output}{Style.RESET_ALL}")
+
+    over = failed + [result['name'] for result in results if result['median_ms'] > args.budget]
+    if over:
+        print(f"{Fore.RED}Over budget: {', '.join(over)}{Style.RESET_ALL}")
+        return 1
+    print(f"{Fore.GREEN}All entry points within budget.{Style.RESET_ALL}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
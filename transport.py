@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Transports for Bluetooth Chat
+A transport is a connected stream to the peer. The chat engine only needs the
+socket-like object it wraps (recv_into/recv, send/sendall, fileno, close), so
+the same session code runs over Bluetooth RFCOMM, TCP, Unix domain sockets or
+an in-process socket pair used for benchmarking.
+"""
+
+import os
+import socket
+
+class Transport:
+    """A connected, stream-oriented link to the peer"""
+
+    kind = 'stream'
+
+    def __init__(self, sock, peer=None):
+        self.sock = sock
+        self.peer = peer
+        self.closed = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        """Close the underlying socket (safe to call more than once)"""
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+    def peer_address(self):
+        """The peer's address without port or channel, for labelling stored messages"""
+        peer = self.peer[0] if isinstance(self.peer, tuple) else self.peer
+        return str(peer) if peer else self.kind
+
+    def describe(self):
+        return f"{self.kind} {self.peer}" if self.peer else self.kind
+
+class TransportListener:
+    """A listening socket that accepts connections as transports"""
+
+    def __init__(self, sock, transport_class, address):
+        self.sock = sock
+        self.transport_class = transport_class
+        self.address = address
+
+    def accept(self, timeout=None):
+        """Wait for the next peer, raising socket.timeout after timeout seconds if given"""
+        self.sock.settimeout(timeout)
+        conn, peer = self.sock.accept()
+        conn.settimeout(None)
+        return self.transport_class(conn, peer)
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+class TCPTransport(Transport):
+    kind = 'tcp'
+
+    def __init__(self, sock, peer=None):
+        super().__init__(sock, peer)
+        # Small chat messages should not wait for Nagle; the send queue already coalesces
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError:
+            pass
+
+    @classmethod
+    def connect(cls, host, port, timeout=None):
+        sock = socket.create_connection((host, port), timeout)
+        sock.settimeout(None)
+        return cls(sock, (host, port))
+
+    @classmethod
+    def listen(cls, host, port, backlog=1):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+        sock.listen(backlog)
+        return TransportListener(sock, cls, sock.getsockname())
+
+class UnixTransport(Transport):
+    kind = 'unix'
+
+    @classmethod
+    def connect(cls, path, timeout=None):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(timeout)
+            sock.connect(path)
+            sock.settimeout(None)
+        except Exception:
+            sock.close()
+            raise
+        return cls(sock, path)
+
+    @classmethod
+    def listen(cls, path, backlog=1):
+        # Remove a socket file left behind by a previous run
+        if os.path.exists(path):
+            os.unlink(path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+        sock.listen(backlog)
+        return TransportListener(sock, cls, path)
+
+class RFCOMMTransport(Transport):
+    kind = 'rfcomm'
+
+    @classmethod
+    def connect(cls, address, port, timeout=None):
+        import bluetooth
+        sock = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
+        try:
+            sock.settimeout(timeout)
+            sock.connect((address, port))
+            sock.settimeout(None)
+        except Exception:
+            sock.close()
+            raise
+        return cls(sock, (address, port))
+
+    @classmethod
+    def listen(cls, address=None, backlog=1):
+        """Listen on any free RFCOMM channel of the local adapter"""
+        import bluetooth
+        if address is None:
+            address = bluetooth.read_local_bdaddr()[0]
+        sock = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
+        sock.bind((address, bluetooth.PORT_ANY))
+        sock.listen(backlog)
+        return TransportListener(sock, cls, sock.getsockname())
+
+class MemoryTransport(Transport):
+    """One end of an in-process socket pair.
+
+    Both ends live in the same process, so the full framing, crypto and
+    rendering pipeline can be exercised without network stacks or radios.
+    """
+
+    kind = 'memory'
+
+    @classmethod
+    def pair(cls):
+        left, right = socket.socketpair()
+        return cls(left, 'memory:a'), cls(right, 'memory:b')